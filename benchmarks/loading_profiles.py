@@ -0,0 +1,77 @@
+"""Benchmarks listing queries for Party and User models under the available
+loading profiles.
+
+usage: PYTHONPATH=. python benchmarks/loading_profiles.py [num-records] [collection-size]
+"""
+import sys
+import timeit
+from sqlalchemy import event
+from elixr.sax import utils
+from elixr.sax.auth import AuthEmail, Role, User
+from elixr.sax.party import Person, PhoneContact
+from elixr.sax.query import apply_profile
+
+
+
+PAGE_SIZE = 50
+REPEAT = 20
+
+
+def populate(db, count, size):
+    roles = [Role(name='role-%s' % i) for i in range(size)]
+    for i in range(count):
+        person = Person(name='person-%s' % i)
+        for j in range(size):
+            person.contacts.append(PhoneContact(number='%05d%05d' % (i, j)))
+        user = User(username='user-%s' % i, roles=roles)
+        for j in range(size):
+            user.emails.append(AuthEmail(address='u%s.%s@x.ea' % (i, j)))
+        db.add_all([person, user])
+    db.commit()
+
+
+def list_page(db, model, profile, touch):
+    query = db.query(model).order_by(model.id).limit(PAGE_SIZE)
+    if profile is not None:
+        query = apply_profile(query, profile)
+    items = query.all()
+    if touch:
+        for item in items:
+            if model is Person:
+                len(item.contacts)
+            else:
+                len(item.roles) + len(item.emails)
+    db.expunge_all()
+    return items
+
+
+def main(count, size):
+    resx = utils.make_session()
+    db = resx.session
+    populate(db, count, size)
+
+    fetched = []
+    @event.listens_for(resx.engine, 'after_cursor_execute')
+    def _count(conn, cursor, statement, parameters, context, executemany):
+        fetched.append(statement)
+
+    print('%-8s %-10s %-6s %10s %10s' % ('model', 'profile', 'touch',
+                                         'ms/page', 'statements'))
+    for model in (Person, User):
+        for profile in ('joined', 'selectin', 'lean'):
+            for touch in (False, True):
+                if profile == 'lean' and touch:
+                    continue
+                del fetched[:]
+                list_page(db, model, profile, touch)
+                statements = len(fetched)
+                elapsed = timeit.timeit(
+                    lambda: list_page(db, model, profile, touch), number=REPEAT)
+                print('%-8s %-10s %-6s %10.2f %10d' % (
+                    model.__name__, profile, touch,
+                    elapsed * 1000 / REPEAT, statements))
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:3]]
+    main(*(args + [1000, 5][len(args):]))
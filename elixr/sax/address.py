@@ -1,14 +1,18 @@
 """Defines models which ease defining, storing and working with Addresses within
 an application.
 """
+import re
+import uuid
+import hashlib
 from collections import namedtuple
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy import Column, Float, ForeignKey, Integer, String, \
-        UniqueConstraint
+from sqlalchemy import Column, Float, ForeignKey, Index, Integer, String, \
+        UniqueConstraint, bindparam, case, event, false, func, inspect, literal, \
+        or_, select
 from sqlalchemy.orm import relationship
 from elixr.base import AttrDict, Coordinates
 from .mixins import EntityWithDeletedMixin
-from . import meta, types
+from . import meta, spatial, types
 
 
 
@@ -40,17 +44,27 @@ class State(meta.Model, EntityWithDeletedMixin):
     country = relationship("Country", back_populates="states")
 
     def __str__(self):
-        value = self.name
-        if self.country:
-            if value:
-                value += ', '
-            value += self.country.name
-        return value
+        return _state_to_str(self)
+
+
+def _state_to_str(state):
+    value = state.name
+    if state.country:
+        if value:
+            value += ', '
+        value += state.country.name
+    return value
 
 
 class AddressMixin(object):
     """A mixin which defines address fields for use within other models.
+
+    Normalized tokens of the address fields are maintained within the address
+    token index which backs `search_address` for models having a uuid field.
     """
+    TOKEN_FIELDS = ('addr_raw', 'addr_street', 'addr_town', 'addr_landmark',
+                    'postal_code')
+
     addr_raw = Column(String(200))
     addr_street = Column(String(100))
     addr_town = Column(String(50))
@@ -73,6 +87,13 @@ class AddressMixin(object):
     def address_str(self):
         return self.to_str(self)
 
+    @classmethod
+    def search_address(cls, dbsession, text, query=None):
+        """Returns a query for entities having addresses with all the terms
+        within the provided text.
+        """
+        return search_addresses(dbsession, cls, text, query)
+
     @staticmethod
     def to_dict(addr):
         addr_dict = dict(
@@ -116,12 +137,19 @@ class AddressMixin(object):
 
 class CoordinatesMixin(object):
     """A mixin which defines coordinate fields for use within other models.
+
+    The geohash of the coordinates is maintained in an indexed field which
+    serves as spatial key for bounding box, radius and nearest lookups.
     """
     longitude = Column(Float)
     latitude = Column(Float)
     altitude = Column(Float)
     gps_error = Column(Integer)
 
+    @declared_attr
+    def geohash(cls):
+        return Column(String(12), index=True)
+
     @property
     def coordinates(self):
         return Coordinates(
@@ -130,6 +158,37 @@ class CoordinatesMixin(object):
             alt=self.altitude,
             error=self.gps_error)
 
+    @classmethod
+    def within_bbox(cls, dbsession, bbox, query=None):
+        """Returns a query for entities within the bounding box provided as
+        `(min_lat, min_lng, max_lat, max_lng)`.
+        """
+        return spatial.within_bbox(dbsession, cls, bbox, query)
+
+    @classmethod
+    def within_radius(cls, dbsession, lat, lng, km, query=None):
+        """Returns `(entity, distance)` pairs for entities within `km`
+        kilometres of a point ordered by distance.
+        """
+        return spatial.within_radius(dbsession, cls, lat, lng, km, query)
+
+    @classmethod
+    def nearest(cls, dbsession, lat, lng, k=1, query=None):
+        """Returns `(entity, distance)` pairs for the `k` entities nearest to
+        a point ordered by distance.
+        """
+        return spatial.nearest(dbsession, cls, lat, lng, k, query=query)
+
+
+@event.listens_for(CoordinatesMixin, 'before_insert', propagate=True)
+@event.listens_for(CoordinatesMixin, 'before_update', propagate=True)
+def _update_geohash(mapper, connection, target):
+    if target.latitude is None or target.longitude is None:
+        target.geohash = None
+    else:
+        target.geohash = spatial.encode_geohash(target.latitude,
+                                                target.longitude)
+
 
 class LocatableMixin(AddressMixin, CoordinatesMixin):
     """A convenience mixin which combines the fields defined by both the
@@ -140,8 +199,12 @@ class LocatableMixin(AddressMixin, CoordinatesMixin):
 
 class Address(meta.Model, EntityWithDeletedMixin, CoordinatesMixin):
     """A model for storing Address data.
+
+    A fingerprint of the normalized street, town, postal code and state is
+    maintained in an indexed field which serves to detect duplicates.
     """
     __tablename__ = 'addresses'
+    TOKEN_FIELDS = ('raw', 'street', 'town', 'landmark', 'postal_code')
 
     raw = Column(String(200), nullable=False)
     street = Column(String(100))
@@ -150,6 +213,18 @@ class Address(meta.Model, EntityWithDeletedMixin, CoordinatesMixin):
     postal_code = Column(String(10))
     state_id = Column(types.UUID, ForeignKey("states.uuid"), nullable=True)
     state = relationship("State", backref="addresses")
+    fingerprint = Column(String(40), index=True)
+
+    def as_view(self):
+        return AddressView(self.raw, self.street, self.town, self.landmark,
+                           self.postal_code, self.state)
+
+    @classmethod
+    def search_address(cls, dbsession, text, query=None):
+        """Returns a query for addresses with all the terms within the provided
+        text.
+        """
+        return search_addresses(dbsession, cls, text, query)
 
     def as_attrd(self):
         return AttrDict({
@@ -162,7 +237,358 @@ class Address(meta.Model, EntityWithDeletedMixin, CoordinatesMixin):
         })
 
     def as_dict(self):
-        return AddressMixin.to_dict(self.as_attrd())
+        return AddressMixin.to_dict(self.as_view())
 
     def __str__(self):
-        return AddressMixin.to_str(self.as_attrd())
+        return AddressMixin.to_str(self.as_view())
+
+
+## ADDRESS FORMATTING
+AddressView = namedtuple('AddressView', [
+    'addr_raw', 'addr_street', 'addr_town', 'addr_landmark', 'postal_code',
+    'addr_state'
+])
+
+CountryRef = namedtuple('CountryRef', ['name', 'code'])
+
+_missing = object()
+
+
+class StateRef(namedtuple('StateRef', ['name', 'code', 'country'])):
+    """A lightweight stand-in for State used when formatting addresses.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return _state_to_str(self)
+
+
+class AddressFormatter(object):
+    """Formats addresses for a list of addressable entities or raw rows while
+    avoiding lazy loads of their states and countries. States referenced are
+    resolved using a cache, or a single `IN` query per batch, and the output
+    produced is identical to that of `AddressMixin.to_str` and `to_dict`.
+
+    Items can be models derived from `AddressMixin`, `Address` models or rows
+    and mappings having the fields of either. Where provided, the reference
+    data snapshot (see `elixr.sax.refdata`) is consulted for states first.
+    """
+    BATCH_SIZE = 500
+
+    def __init__(self, dbsession, cache=None, refdata=None):
+        self._dbsession = dbsession
+        self._states = cache if cache is not None else {}
+        self._refdata = refdata
+
+    @staticmethod
+    def _get(item, name, default=None):
+        value = getattr(item, name, _missing)
+        if value is _missing:
+            try:
+                value = item[name]
+            except (KeyError, IndexError, TypeError):
+                value = default
+        return value
+
+    def _prefix(self, item):
+        if isinstance(item, AddressMixin):
+            return 'addr_'
+        if isinstance(item, Address):
+            return ''
+        return 'addr_' if self._get(item, 'addr_raw', _missing) is not _missing \
+                       else ''
+
+    def resolve_states(self, state_ids):
+        """Resolves states with the provided ids which are not yet cached and
+        returns the cache of `StateRef` objects keyed by state id.
+        """
+        missing = list(set(sid for sid in state_ids
+                           if sid is not None and sid not in self._states))
+        if self._refdata is not None and missing:
+            missing = [sid for sid in missing if not self._from_refdata(sid)]
+
+        for idx in range(0, len(missing), self.BATCH_SIZE):
+            batch = missing[idx:idx + self.BATCH_SIZE]
+            query = self._dbsession.query(
+                        State.uuid, State.name, State.code,
+                        Country.name, Country.code) \
+                        .outerjoin(State.country) \
+                        .filter(State.uuid.in_(batch))
+            for state_id, name, code, cname, ccode in query:
+                country = CountryRef(cname, ccode) if cname is not None else None
+                self._states[state_id] = StateRef(name, code, country)
+        return self._states
+
+    def _from_refdata(self, state_id):
+        state = self._refdata.find(State, uuid=state_id)
+        if state is None:
+            return False
+
+        country = self._refdata.find(Country, uuid=state.country_id)
+        if country is not None:
+            country = CountryRef(country.name, country.code)
+        self._states[state_id] = StateRef(state.name, state.code, country)
+        return True
+
+    def views(self, items):
+        """Returns an `AddressView` for each of the provided items.
+        """
+        fields = []
+        for item in items:
+            prefix = self._prefix(item)
+            values = [self._get(item, prefix + name) for name in
+                      ('raw', 'street', 'town', 'landmark', 'state_id')]
+            values.insert(4, self._get(item, 'postal_code'))
+            state_id = values[-1]
+            if state_id is not None and not isinstance(state_id, uuid.UUID):
+                values[-1] = uuid.UUID(str(state_id))
+            fields.append(values)
+
+        states = self.resolve_states([values[-1] for values in fields])
+        return [AddressView(*(values[:-1] + [states.get(values[-1])]))
+                for values in fields]
+
+    def to_str_many(self, items):
+        """Returns the address string for each of the provided items.
+        """
+        return [AddressMixin.to_str(view) for view in self.views(items)]
+
+    def to_dict_many(self, items):
+        """Returns the address dict for each of the provided items.
+        """
+        return [AddressMixin.to_dict(view) for view in self.views(items)]
+
+
+## ADDRESS TOKEN INDEX
+ABBREVIATIONS = {
+    'ave': 'avenue', 'av': 'avenue', 'blvd': 'boulevard', 'cl': 'close',
+    'cres': 'crescent', 'dr': 'drive', 'est': 'estate', 'expy': 'expressway',
+    'hwy': 'highway', 'ln': 'lane', 'rd': 'road', 'sq': 'square',
+    'st': 'street', 'str': 'street',
+}
+
+_TOKEN_SPLITTER = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def tokenize_address(*values):
+    """Returns the distinct normalized tokens within provided values, case
+    folded and with common abbreviations expanded, in order of appearance.
+    """
+    tokens = []
+    for value in values:
+        if not value:
+            continue
+        for token in _TOKEN_SPLITTER.split(value.lower()):
+            token = ABBREVIATIONS.get(token, token)[:50]
+            if token and token not in tokens:
+                tokens.append(token)
+    return tokens
+
+
+class AddressToken(meta.Model):
+    """A model for storing the address token index which maps normalized tokens
+    to the uuids of entities, identified by their base table name, having the
+    tokens within their addresses.
+    """
+    __tablename__ = 'address_tokens'
+    __table_args__ = (
+        Index('ix_address_tokens_entity_id', 'entity_id'),
+    )
+
+    entity_type = Column(String(50), primary_key=True)
+    token = Column(String(50), primary_key=True)
+    entity_id = Column(types.UUID, primary_key=True)
+
+
+def _entity_type(model):
+    return inspect(model).base_mapper.local_table.name
+
+
+def _index_tokens(connection, entity_type, entity_ids, tokens_list):
+    table = AddressToken.__table__
+    connection.execute(table.delete().where(table.c.entity_id.in_(entity_ids)))
+    rows = [dict(entity_type=entity_type, token=token, entity_id=entity_id)
+            for entity_id, tokens in zip(entity_ids, tokens_list)
+            for token in tokens]
+    if rows:
+        connection.execute(table.insert(), rows)
+
+
+def _token_values(target):
+    return [getattr(target, name) for name in target.TOKEN_FIELDS]
+
+
+@event.listens_for(AddressMixin, 'after_insert', propagate=True)
+@event.listens_for(Address, 'after_insert', propagate=True)
+def _insert_address_tokens(mapper, connection, target):
+    if not mapper.has_property('uuid'):
+        return
+    _index_tokens(connection, mapper.base_mapper.local_table.name,
+                  [target.uuid], [tokenize_address(*_token_values(target))])
+
+
+@event.listens_for(AddressMixin, 'after_update', propagate=True)
+@event.listens_for(Address, 'after_update', propagate=True)
+def _update_address_tokens(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[name].history.has_changes()
+           for name in target.TOKEN_FIELDS):
+        _insert_address_tokens(mapper, connection, target)
+
+
+@event.listens_for(AddressMixin, 'after_delete', propagate=True)
+@event.listens_for(Address, 'after_delete', propagate=True)
+def _delete_address_tokens(mapper, connection, target):
+    if not mapper.has_property('uuid'):
+        return
+    table = AddressToken.__table__
+    connection.execute(table.delete().where(table.c.entity_id == target.uuid))
+
+
+def search_addresses(dbsession, model, text, query=None):
+    """Returns a query for entities of model having all the tokens within the
+    provided text in their addresses. The posting lists of the tokens are
+    intersected within the token index before entities are looked up.
+    """
+    query = query if query is not None else dbsession.query(model)
+    tokens = tokenize_address(text)
+    if not tokens:
+        return query
+
+    table = AddressToken.__table__
+    matches = select([table.c.entity_id]) \
+                .where(table.c.entity_type == _entity_type(model)) \
+                .where(table.c.token.in_(tokens)) \
+                .group_by(table.c.entity_id) \
+                .having(func.count(table.c.token) == len(tokens))
+    return query.filter(model.uuid.in_(matches))
+
+
+def rebuild_address_tokens(dbsession, model, batch_size=1000):
+    """Rebuilds the address token index for entities of model, e.g. after bulk
+    loads which bypass the ORM. Returns the number of entities indexed.
+    """
+    entity_type = _entity_type(model)
+    columns = [getattr(model, name) for name in model.TOKEN_FIELDS]
+    query = dbsession.query(model.uuid, *columns).order_by(model.uuid)
+
+    count, rows = 0, query.limit(batch_size).all()
+    while rows:
+        _index_tokens(dbsession.connection(), entity_type,
+                      [row[0] for row in rows],
+                      [tokenize_address(*row[1:]) for row in rows])
+        count += len(rows)
+        rows = query.filter(model.uuid > rows[-1][0]).limit(batch_size).all()
+    return count
+
+
+## ADDRESS DEDUPLICATION
+DEDUPE_BATCH_SIZE = 500
+
+
+def address_fingerprint(street, town, postal_code, state_id):
+    """Returns the fingerprint of an address computed from its normalized
+    street, town, postal code and state or None if none of the street, town
+    and postal code is provided.
+    """
+    parts = [' '.join(tokenize_address(street)),
+             ' '.join(tokenize_address(town)),
+             ''.join(tokenize_address(postal_code))]
+    if not any(parts):
+        return None
+
+    parts.append(state_id.hex if isinstance(state_id, uuid.UUID) else
+                 (state_id or ''))
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+@event.listens_for(Address, 'before_insert', propagate=True)
+@event.listens_for(Address, 'before_update', propagate=True)
+def _update_fingerprint(mapper, connection, target):
+    state_id = target.state_id
+    if state_id is None and target.state is not None:
+        state_id = target.state.uuid
+    target.fingerprint = address_fingerprint(target.street, target.town,
+                                             target.postal_code, state_id)
+
+
+def update_address_fingerprints(dbsession, batch_size=DEDUPE_BATCH_SIZE):
+    """Computes and stores the fingerprint for addresses which have got none,
+    e.g. those created before fingerprints were introduced or by bulk loads
+    which bypass the ORM, using batched updates. Returns the number of
+    addresses updated.
+    """
+    table = Address.__table__
+    query = dbsession.query(Address.id, Address.street, Address.town,
+                            Address.postal_code, Address.state_id) \
+                     .filter(Address.fingerprint.is_(None)) \
+                     .order_by(Address.id)
+    stmt = table.update().where(table.c.id == bindparam('_id')) \
+                         .values(fingerprint=bindparam('_fingerprint'))
+
+    count, rows = 0, query.limit(batch_size).all()
+    while rows:
+        params = [dict(_id=row[0], _fingerprint=address_fingerprint(*row[1:]))
+                  for row in rows]
+        params = [p for p in params if p['_fingerprint'] is not None]
+        if params:
+            dbsession.execute(stmt, params)
+            count += len(params)
+        rows = query.filter(Address.id > rows[-1][0]).limit(batch_size).all()
+    return count
+
+
+def _repoint_references(dbsession, table, mapping):
+    """Updates all references to rows of table, keyed by uuid within mapping,
+    to refer to the mapped rows instead using a single update per foreign key.
+    """
+    for ref_table, fk in meta.referencing_foreign_keys(table):
+        if fk.column.name != 'uuid':
+            continue
+        column = fk.parent
+        target = case([(column == old, literal(new, column.type))
+                       for old, new in mapping.items()], else_=column)
+        dbsession.execute(ref_table.update()
+                                   .where(column.in_(list(mapping)))
+                                   .values({column.name: target}))
+
+
+def dedupe_addresses(dbsession, batch_size=DEDUPE_BATCH_SIZE):
+    """Merges addresses not marked as deleted which share a fingerprint. The
+    earliest created address of each group is kept, references to the others
+    re-pointed to it in bulk and the others marked as deleted. Missing
+    fingerprints are computed first (see `update_address_fingerprints`).
+    Changes are committed per batch of fingerprints. Returns the number of
+    addresses merged.
+    """
+    update_address_fingerprints(dbsession, batch_size)
+    dbsession.commit()
+
+    live = or_(Address.deleted == false(), Address.deleted.is_(None))
+    query = dbsession.query(Address.fingerprint) \
+                     .filter(live, Address.fingerprint.isnot(None)) \
+                     .group_by(Address.fingerprint) \
+                     .having(func.count() > 1)
+    fingerprints = [fingerprint for (fingerprint,) in query]
+    count = 0
+    for idx in range(0, len(fingerprints), batch_size):
+        batch = fingerprints[idx:idx + batch_size]
+        query = dbsession.query(Address.fingerprint, Address.uuid) \
+                         .filter(live, Address.fingerprint.in_(batch)) \
+                         .order_by(Address.fingerprint, Address.date_created,
+                                   Address.id)
+        merges, survivors = [], {}
+        for fingerprint, uuid_ in query:
+            if fingerprint in survivors:
+                merges.append((uuid_, survivors[fingerprint]))
+            else:
+                survivors[fingerprint] = uuid_
+
+        # keeps the number of parameters per statement bounded
+        size = Address.BULK_BATCH_SIZE
+        for start in range(0, len(merges), size):
+            _repoint_references(dbsession, Address.__table__,
+                                dict(merges[start:start + size]))
+        count += Address.soft_delete(dbsession, [old for old, _ in merges])
+        dbsession.commit()
+    return count
@@ -0,0 +1,118 @@
+"""Provides jobs which move records marked as deleted out of the live tables
+into archive tables so that the live tables remain small.
+
+A record is considered for archival when marked as deleted and not modified
+for a given number of days; as `TimestampMixin.last_updated` gets stamped when
+a record is marked as deleted, it serves as the date of deletion.
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import Column, DateTime, MetaData, Table, and_, exists, \
+        select, true
+from sqlalchemy.sql import func
+from . import meta
+
+
+
+# archive tables are kept out of `meta.metadata` so that they aren't created
+# along with the live tables nor affect their ordering
+archive_metadata = MetaData(naming_convention=meta.NAMING_CONVENTION)
+
+ARCHIVE_SUFFIX = '_archive'
+DEFAULT_BATCH_SIZE = 500
+
+
+def archive_table(table):
+    """Returns the archive table for the provided live table. The archive table
+    has all the columns of the live table, without constraints, along with a
+    `date_archived` column.
+    """
+    name = table.name + ARCHIVE_SUFFIX
+    if name in archive_metadata.tables:
+        return archive_metadata.tables[name]
+
+    columns = [Column(c.name, c.type) for c in table.c]
+    columns.append(Column('date_archived', DateTime, default=func.now()))
+    return Table(name, archive_metadata, *columns)
+
+
+def _is_attached(ref_table, fk):
+    """Indicates whether rows of `ref_table` referencing a record through `fk`
+    are archived along with the record. This holds for tables without the
+    deleted field which either extend the record (joined inheritance), link
+    it (association tables) or are owned by it (non-nullable reference).
+    Other referencing rows block archival of the record while they exist.
+    """
+    if 'deleted' in ref_table.c or fk.column.table is ref_table:
+        return False
+    return (fk.parent.primary_key or not fk.parent.nullable or
+            not ref_table.primary_key.columns)
+
+
+def _blocking_criteria(table, alias, links):
+    """Yields NOT EXISTS criteria for rows referencing records of `table` or
+    of the tables attached to it. `links` holds the join conditions back to
+    the table being archived for attached tables.
+    """
+    for ref_table, fk in meta.referencing_foreign_keys(table):
+        ref_alias = ref_table.alias()
+        link = ref_alias.c[fk.parent.name] == alias.c[fk.column.name]
+        if _is_attached(ref_table, fk):
+            for criterion in _blocking_criteria(ref_table, ref_alias,
+                                                links + [link]):
+                yield criterion
+        else:
+            yield ~exists().where(and_(link, *links))
+
+
+def _move(dbsession, table, criterion):
+    """Moves rows of `table` matching criterion along with their attached rows
+    into the archive tables and returns the number of rows moved.
+    """
+    for ref_table, fk in meta.referencing_foreign_keys(table):
+        if _is_attached(ref_table, fk):
+            referred = select([table.c[fk.column.name]]).where(criterion)
+            _move(dbsession, ref_table, ref_table.c[fk.parent.name].in_(referred))
+
+    archive = archive_table(table)
+    archive.create(dbsession.connection(), checkfirst=True)
+    names = [c.name for c in table.c]
+    dbsession.execute(archive.insert().from_select(
+        names, select([table.c[n] for n in names]).where(criterion)))
+    return dbsession.execute(table.delete().where(criterion)).rowcount
+
+
+def purge_deleted(dbsession, days, batch_size=DEFAULT_BATCH_SIZE,
+                  table_names=None):
+    """Moves records marked as deleted more than `days` ago into the archive
+    tables in batches of `batch_size`, committing after each batch. Tables are
+    processed in dependency order, children before parents, and records still
+    referenced by rows in live tables are left in place.
+
+    Returns a dict of table names and number of records archived.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    results = {}
+    for table in reversed(meta.metadata.sorted_tables):
+        if table_names and table.name not in table_names:
+            continue
+        if 'deleted' not in table.c or 'date_created' not in table.c:
+            continue
+
+        pk = table.primary_key.columns.values()[0]
+        date_deleted = func.coalesce(table.c.last_updated, table.c.date_created)
+        query = select([pk]) \
+                    .where(table.c.deleted == true()) \
+                    .where(date_deleted < cutoff) \
+                    .order_by(pk).limit(batch_size)
+        for criterion in _blocking_criteria(table, table, []):
+            query = query.where(criterion)
+
+        count = 0
+        while True:
+            ids = [row[0] for row in dbsession.execute(query)]
+            if not ids:
+                break
+            count += _move(dbsession, table, pk.in_(ids))
+            dbsession.commit()
+        results[table.name] = count
+    return results
@@ -1,10 +1,32 @@
 import bcrypt
+from concurrent.futures import Future
 from datetime import datetime
-from sqlalchemy.orm import exc as orm_exc
+from sqlalchemy import or_
+from . import models as _models
 from .models import (
-    _check_password, _hash_password,
-    User, Role, AuthEmail
+    _check_password, _hash_password, _hash_rounds, _verify_password,
+    calibrate_rounds, User, Role, AuthEmail
 )
+from .provisioning import hash_passwords, provision_users
+
+
+def _chain(source, target, resolve):
+    """Resolves the target future to the value returned by `resolve`, passed
+    the rehashed password if any, once the source future holding the outcome
+    of `_verify_password` completes with a successful check or to None
+    otherwise. `resolve` runs within the thread completing the source future.
+    """
+    def done(future):
+        if future.cancelled():
+            target.cancel()
+            return
+        try:
+            valid, new_hash = future.result()
+            target.set_result(resolve(new_hash) if valid else None)
+        except Exception as ex:
+            target.set_exception(ex)
+    source.add_done_callback(done)
+    return target
 
 
 class Authenticator(object):
@@ -12,34 +34,143 @@ class Authenticator(object):
     object. This seamlessly fits into whatever Session management strategy in
     use, and effectively `side-steps` whatever complexity that could arise from
     having to create a Session object locally.
+
+    Password checks, which are CPU bound by design, can be offloaded to an
+    `executor` (`concurrent.futures` thread or process pool) such that they
+    run in parallel across calling threads; bcrypt releases the GIL while
+    hashing so a thread pool suffices in most cases. Database lookups always
+    use the provided Session within the calling thread.
+
+    Where `rehash` is set, the password of a user whose hash has got a cost
+    factor other than `BCRYPT_ROUNDS` gets rehashed on successful login. The
+    new hash is set on the loaded user such that it gets written along with
+    the next flush of the Session rather than within an extra round-trip; it
+    is only ever set within the thread owning the Session.
     """
-    def __init__(self, db_session, accept_email_as_username=False):
+    def __init__(self, db_session, accept_email_as_username=False,
+                 executor=None, rehash=True):
         if not db_session:
             raise ValueError('db_session is required.')
 
         self._db_session = db_session
         self._accept_email_as_username = accept_email_as_username
+        self._executor = executor
+        self._rehash = rehash
 
-    def authenticate(self, username, password):
+    def _credentials_query(self, username):
+        """Returns the query selecting the credentials of users matching the
+        provided username, or email address where accepted as username. Each
+        branch of the email lookup is a search over the index of its column.
+        """
         db = self._db_session
+        query = db.query(User.id, User.username, User.password, User.is_active)
         if self._accept_email_as_username and '@' in username:
-            try:
-                email = db.query(AuthEmail).filter_by(address=username).first()
-                user = email.user if email and email.user and email.user.is_active else None
-                if user and _check_password(password, user.password):
-                    return user
-                return None
-            except orm_exc.NoResultFound:
-                pass
+            user_ids = db.query(AuthEmail.user_id) \
+                         .filter(AuthEmail.address == username)
+            return query.filter(or_(User.username == username,
+                                    User.uuid.in_(user_ids.subquery()))) \
+                        .limit(2)
+        return query.filter(User.username == username)
+
+    def _find_credentials(self, username):
+        """Returns the `(id, password)` of the active user with the provided
+        username, or email address where accepted as username, or None. Only
+        these columns are selected within a single query.
+        """
+        query = self._credentials_query(username)
+
+        # an exact username match takes precedence over an email match
+        rows = sorted(query.all(), key=lambda row: row.username != username)
+        if not rows or not rows[0].is_active or not rows[0].password:
             return None
+        return rows[0].id, rows[0].password
+
+    def _load_user(self, user_id, new_hash=None):
+        user = self._db_session.query(User).get(user_id)
+        return self.apply_hash(user, new_hash)
+
+    @staticmethod
+    def apply_hash(user, new_hash):
+        """Sets the rehashed password, if any, on the user and returns the user.
+        To be called within the thread owning the Session.
+        """
+        if user is not None and new_hash is not None:
+            user.password = new_hash
+        return user
+
+    def _verify_args(self, password, password_hash):
+        rounds = _models.BCRYPT_ROUNDS if self._rehash else None
+        return (_verify_password, password, password_hash, rounds)
+
+    def authenticate(self, username, password):
+        credentials = self._find_credentials(username)
+        if credentials is None:
+            return None
+
+        user_id, password_hash = credentials
+        verify_args = self._verify_args(password, password_hash)
+        if self._executor is not None:
+            valid, new_hash = self._executor.submit(*verify_args).result()
+        else:
+            valid, new_hash = verify_args[0](*verify_args[1:])
+        return self._load_user(user_id, new_hash) if valid else None
+
+    def authenticate_future(self, username, password):
+        """Returns a `concurrent.futures.Future` which resolves to a tuple of
+        `(user, new_hash)` on success or None. The password check is submitted
+        to the executor, or performed within the calling thread where none was
+        provided.
+
+        :hint: as the future resolves within a worker thread, the user is
+        loaded upfront within the calling thread which owns the Session and
+        left untouched by the worker. A password rehashed with the current
+        cost factor is returned as `new_hash`, for the caller to set within
+        its own thread using `apply_hash`; it is None where there is nothing
+        to apply.
+        """
+        credentials = self._find_credentials(username)
+        result = Future()
+        if credentials is None:
+            result.set_result(None)
+            return result
+
+        user_id, password_hash = credentials
+        verify_args = self._verify_args(password, password_hash)
+        if self._executor is None:
+            valid, new_hash = verify_args[0](*verify_args[1:])
+            user = self._load_user(user_id, new_hash) if valid else None
+            result.set_result((user, None) if user else None)
+            return result
+
+        user = self._load_user(user_id)
+        future = self._executor.submit(*verify_args)
+        return _chain(future, result, lambda new_hash: (user, new_hash))
+
+    def authenticate_async(self, username, password, loop=None):
+        """Returns an asyncio future which resolves to the user or None. The
+        password check is run within the executor, or the default executor of
+        the event loop where none was provided, so the loop never blocks. The
+        user is loaded, and any rehashed password set, within the thread
+        running the loop which is expected to own the Session. `loop` defaults
+        to the running event loop.
+        """
+        import asyncio
+        if loop is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except AttributeError:    # python < 3.7
+                loop = asyncio.get_event_loop()
+        credentials = self._find_credentials(username)
+        result = loop.create_future()
+        if credentials is None:
+            result.set_result(None)
+            return result
 
-        # if code gets this far it could be `accept_email_as_username=False` or
-        # treatment of username as email failed thus need to treat username as 
-        # just a username
-        user = db.query(User).filter_by(username=username, is_active=True).first()
-        if user and _check_password(password, user.password):
-            return user
-        return None
+        user_id, password_hash = credentials
+        future = loop.run_in_executor(
+            self._executor, *self._verify_args(password, password_hash))
+        return _chain(future, result,
+                      lambda new_hash: self._load_user(user_id, new_hash))
 
     def __call__(self, username, password):
         """Convenience method for calling `authenticate`.
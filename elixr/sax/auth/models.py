@@ -2,6 +2,7 @@
 base on which to implement a simple role based security for an applicatin.
 """
 import bcrypt
+import timeit
 from sqlalchemy import (
     Column, Boolean, DateTime, ForeignKey, Integer,
     String, Table
@@ -15,6 +16,12 @@ from .. import meta, types
 
 
 
+# cost factor for password hashes; see `calibrate_rounds`
+BCRYPT_ROUNDS = 12
+MIN_BCRYPT_ROUNDS = 4
+MAX_BCRYPT_ROUNDS = 16
+
+
 ## FUNCS
 def generate_confirmation_hash():
     return generate_random_digest(num_bytes=14)
@@ -25,16 +32,60 @@ def _check_password(passwd, passwd_hash):
     return bcrypt.checkpw(passwd.encode('utf8'), expected_hash)
 
 
-def _hash_password(passwd):
-    pwhash = bcrypt.hashpw(passwd.encode('utf8'), bcrypt.gensalt())
+def _hash_password(passwd, rounds=None):
+    salt = bcrypt.gensalt(rounds or BCRYPT_ROUNDS)
+    pwhash = bcrypt.hashpw(passwd.encode('utf8'), salt)
     return pwhash.decode('utf8')
 
 
+def _hash_rounds(passwd_hash):
+    """Returns the cost factor of a bcrypt hash, i.e. `$2b$<rounds>$...`, or
+    None if it cannot be determined.
+    """
+    try:
+        return int(passwd_hash.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def _verify_password(passwd, passwd_hash, rounds=None):
+    """Checks a password against its hash and returns `(valid, new_hash)`
+    where `new_hash` is the password hashed afresh if valid and its hash has
+    got a cost factor other than `rounds`, otherwise None.
+    """
+    if not _check_password(passwd, passwd_hash):
+        return False, None
+    if rounds is None or _hash_rounds(passwd_hash) == rounds:
+        return True, None
+    return True, _hash_password(passwd, rounds)
+
+
+def calibrate_rounds(target_seconds=0.25, min_rounds=MIN_BCRYPT_ROUNDS,
+                     max_rounds=MAX_BCRYPT_ROUNDS, repeat=3):
+    """Benchmarks bcrypt on the host and returns the highest cost factor, from
+    `min_rounds` up to `max_rounds`, whose hashing takes no more than the
+    target latency. As each extra round doubles the hashing time, the search
+    stops once the next cost factor is expected to exceed the target.
+    """
+    passwd = b'calibration'
+    rounds = min_rounds
+    while rounds < max_rounds:
+        salt = bcrypt.gensalt(rounds)
+        elapsed = min(timeit.repeat(lambda: bcrypt.hashpw(passwd, salt),
+                                    number=1, repeat=repeat))
+        if elapsed > target_seconds:
+            return max(min_rounds, rounds - 1)
+        if elapsed * 2 > target_seconds:
+            break
+        rounds += 1
+    return rounds
+
+
 ## MODELS
 # many-to-many relation between users and roles
 auth_users_roles_table = Table(
     'auth_users_roles', meta.metadata,
-    Column('user_id', types.UUID, ForeignKey('auth_users.uuid')),
+    Column('user_id', types.UUID, ForeignKey('auth_users.uuid'), index=True),
     Column('role_id', types.UUID, ForeignKey('auth_roles.uuid'))
 )
 
@@ -51,8 +102,8 @@ class User(meta.Model, EntityWithDeletedMixin):
     is_active = Column(Boolean(create_constraint=False), nullable=False, default=False)
     date_joined = Column(DateTime, nullable=False, default=func.now())
     last_login = Column(DateTime, nullable=True)
-    roles = relationship("Role", secondary="auth_users_roles", lazy="joined")
-    emails = relationship("AuthEmail", lazy="joined", back_populates="user")
+    roles = relationship("Role", secondary="auth_users_roles", lazy="selectin")
+    emails = relationship("AuthEmail", lazy="selectin", back_populates="user")
 
     @property
     def is_admin(self):
@@ -118,7 +169,8 @@ class AuthEmail(meta.Model, IdsMixin):
     __tablename__ = 'auth_emails'
 
     address = Column(String(150), nullable=False, unique=True)
-    user_id = Column(types.UUID, ForeignKey('auth_users.uuid'), nullable=False)
+    user_id = Column(types.UUID, ForeignKey('auth_users.uuid'), nullable=False,
+                     index=True)
     confirmation_hash = Column(String(32), default=generate_confirmation_hash)
     is_confirmed = Column(Boolean(create_constraint=False), default=False)
     is_preferred = Column(Boolean(create_constraint=False), default=False)
@@ -0,0 +1,112 @@
+"""Provides bulk provisioning of users along with their emails and roles, for
+onboarding large numbers of users at once.
+
+Passwords are hashed across a process pool as bcrypt is CPU bound by design,
+then users, emails and role links are inserted using batched statements.
+"""
+import multiprocessing
+import uuid
+from functools import partial
+from elixr.base._compat import string_types
+
+from . import models as _models
+from .models import _hash_password, auth_users_roles_table, AuthEmail, Role, User
+
+
+
+INSERT_BATCH_SIZE = 1000
+
+USER_FIELDS = ('username', 'first_name', 'last_name', 'is_active')
+
+
+def hash_passwords(passwords, processes=None, rounds=None):
+    """Returns the hashes of the provided passwords, or None for those which
+    are None, computed using a pool of `processes` processes, defaulting to
+    the number of CPUs, or within the current process if 1. Hashes have got
+    a cost factor of `rounds`, defaulting to `BCRYPT_ROUNDS`.
+    """
+    passwords = list(passwords)
+    found = [p for p in passwords if p is not None]
+    # resolved here as pool processes may not share the module state
+    hash_password = partial(_hash_password,
+                            rounds=rounds or _models.BCRYPT_ROUNDS)
+    if processes == 1 or len(found) < 2:
+        hashes = [hash_password(p) for p in found]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            hashes = pool.map(hash_password, found, chunksize=16)
+        finally:
+            pool.close()
+            pool.join()
+
+    hashes = iter(hashes)
+    return [None if p is None else next(hashes) for p in passwords]
+
+
+def _email_dicts(emails):
+    for email in emails or ():
+        if isinstance(email, string_types):
+            email = {'address': email}
+        yield email
+
+
+def _resolve_roles(dbsession, records):
+    names = set(name for record in records for name in record.get('roles') or ())
+    if not names:
+        return {}
+
+    role_ids = dict(dbsession.query(Role.name, Role.uuid)
+                             .filter(Role.name.in_(list(names))))
+    missing = names - set(role_ids)
+    if missing:
+        raise ValueError('Unknown roles: %s' % ', '.join(sorted(missing)))
+    return role_ids
+
+
+def _insert(dbsession, table, rows, batch_size):
+    for idx in range(0, len(rows), batch_size):
+        dbsession.execute(table.insert(), rows[idx:idx + batch_size])
+
+
+def provision_users(dbsession, records, processes=None,
+                    batch_size=INSERT_BATCH_SIZE):
+    """Creates users from the provided records and returns their uuids in the
+    same order. Records are dicts holding `username` along with an optional
+    `password`, `first_name`, `last_name`, `is_active`, list of `roles` names
+    and list of `emails` as addresses or dicts of `AuthEmail` fields.
+
+    Passwords are hashed using a pool of `processes` processes (see
+    `hash_passwords`) and roles are resolved by name within a single query;
+    a ValueError is raised for unknown roles or duplicate usernames.
+    """
+    records = list(records)
+    usernames = [record['username'] for record in records]
+    if len(set(usernames)) != len(usernames):
+        raise ValueError('Usernames provided must be unique.')
+
+    role_ids = _resolve_roles(dbsession, records)
+    hashes = hash_passwords([r.get('password') for r in records], processes)
+
+    user_rows, email_rows, role_rows = [], [], []
+    for record, password in zip(records, hashes):
+        user_id = uuid.uuid4()
+        row = dict((f, record.get(f)) for f in USER_FIELDS)
+        row.update(uuid=user_id, password=password,
+                   is_active=bool(row['is_active']))
+        user_rows.append(row)
+
+        for email in _email_dicts(record.get('emails')):
+            email_rows.append({
+                'uuid': uuid.uuid4(), 'user_id': user_id,
+                'address': email['address'],
+                'is_confirmed': bool(email.get('is_confirmed')),
+                'is_preferred': bool(email.get('is_preferred')),
+            })
+        for name in record.get('roles') or ():
+            role_rows.append({'user_id': user_id, 'role_id': role_ids[name]})
+
+    _insert(dbsession, User.__table__, user_rows, batch_size)
+    _insert(dbsession, AuthEmail.__table__, email_rows, batch_size)
+    _insert(dbsession, auth_users_roles_table, role_rows, batch_size)
+    return [row['uuid'] for row in user_rows]
@@ -0,0 +1,197 @@
+"""Provides offline assignment of states to models derived from `LocatableMixin`
+using their coordinates and state boundary polygons loaded from a local GeoJSON
+file. Polygons are indexed on a regular grid such that a point is only tested
+against polygons whose bounding boxes overlap the grid cell it falls into.
+"""
+import json
+import math
+from sqlalchemy import inspect
+from elixr.base._compat import string_types
+
+from .address import Country, State
+
+
+
+DEFAULT_CELL_SIZE = 0.5   # in degrees
+DEFAULT_BATCH_SIZE = 1000
+
+
+def _ring_contains(ring, lng, lat):
+    """Ray casting test for a point within a ring of `[lng, lat]` positions.
+    """
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i][0], ring[i][1]
+        xj, yj = ring[j][0], ring[j][1]
+        if (yi > lat) != (yj > lat) and \
+                lng < (xj - xi) * (lat - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+def _bbox(ring):
+    xs = [p[0] for p in ring]
+    ys = [p[1] for p in ring]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+class Boundary(object):
+    """A polygon, with holes, for an area identified by key.
+    """
+    __slots__ = ('key', 'rings', 'bbox')
+
+    def __init__(self, key, rings):
+        self.key = key
+        self.rings = rings
+        self.bbox = _bbox(rings[0])
+
+    def contains(self, lng, lat):
+        min_x, min_y, max_x, max_y = self.bbox
+        if not (min_x <= lng <= max_x and min_y <= lat <= max_y):
+            return False
+        if not _ring_contains(self.rings[0], lng, lat):
+            return False
+        return not any(_ring_contains(hole, lng, lat) for hole in self.rings[1:])
+
+
+class BoundaryIndex(object):
+    """A grid index over boundary polygons which locates the boundary a point
+    falls within.
+    """
+
+    def __init__(self, boundaries, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        self.keys = set()
+        self._grid = {}
+        for boundary in boundaries:
+            self.keys.add(boundary.key)
+            min_x, min_y, max_x, max_y = boundary.bbox
+            for ix in range(self._cell(min_x), self._cell(max_x) + 1):
+                for iy in range(self._cell(min_y), self._cell(max_y) + 1):
+                    self._grid.setdefault((ix, iy), []).append(boundary)
+
+    def _cell(self, value):
+        return int(math.floor(value / self.cell_size))
+
+    @classmethod
+    def from_geojson(cls, source, key_property='name',
+                     cell_size=DEFAULT_CELL_SIZE):
+        """Creates an index from a GeoJSON FeatureCollection of Polygon or
+        MultiPolygon features provided as a file path or file object. Each
+        feature is identified by the value of its `key_property` property.
+        """
+        if isinstance(source, string_types):
+            with open(source) as f:
+                data = json.load(f)
+        else:
+            data = json.load(source)
+
+        boundaries = []
+        for feature in data.get('features', []):
+            key = (feature.get('properties') or {}).get(key_property)
+            geometry = feature.get('geometry') or {}
+            if key is None:
+                continue
+            if geometry.get('type') == 'Polygon':
+                polygons = [geometry['coordinates']]
+            elif geometry.get('type') == 'MultiPolygon':
+                polygons = geometry['coordinates']
+            else:
+                continue
+            boundaries.extend(Boundary(key, rings) for rings in polygons if rings)
+        return cls(boundaries, cell_size)
+
+    def locate(self, lat, lng):
+        """Returns the key of the boundary containing the point or None.
+        """
+        cell = (self._cell(lng), self._cell(lat))
+        for boundary in self._grid.get(cell, ()):
+            if boundary.contains(lng, lat):
+                return boundary.key
+        return None
+
+
+class StateLocator(object):
+    """Locates the state, as its id, for coordinates using a `BoundaryIndex`
+    with boundaries keyed by values of a State field (name or code).
+    """
+
+    def __init__(self, index, state_ids):
+        self.index = index
+        self.state_ids = state_ids
+
+    @classmethod
+    def create(cls, dbsession, index, key_field='name', country_code=None):
+        """Creates a locator by resolving the keys of the boundaries within the
+        index to ids of states having matching `key_field` values, optionally
+        within the country with provided code.
+        """
+        key_column = getattr(State, key_field)
+        query = dbsession.query(key_column, State.uuid) \
+                         .filter(key_column.in_(list(index.keys)))
+        if country_code:
+            query = query.join(State.country).filter(Country.code == country_code)
+        return cls(index, dict(query.all()))
+
+    def locate(self, lat, lng):
+        if lat is None or lng is None:
+            return None
+        return self.state_ids.get(self.index.locate(lat, lng))
+
+
+def _located_rows(dbsession, model, locator, query=None):
+    """Yields `(identity, current_state_id, located_state_id)` for entities
+    of model having coordinates.
+    """
+    mapper = inspect(model)
+    state_column = model.addr_state_id.property.columns[0]
+    pk = state_column.table.primary_key.columns.values()[0]
+    identity = getattr(model, mapper.get_property_by_column(pk).key)
+
+    if query is None:
+        query = dbsession.query(identity, model.latitude, model.longitude,
+                                model.addr_state_id)
+    query = query.filter(model.latitude.isnot(None),
+                         model.longitude.isnot(None))
+    for ident, lat, lng, state_id in query:
+        yield ident, state_id, locator.locate(lat, lng)
+
+
+def assign_states(dbsession, model, locator, overwrite=False,
+                  batch_size=DEFAULT_BATCH_SIZE):
+    """Assigns the located state to entities of a `LocatableMixin` model using
+    set-based updates grouped by state. Entities with a state already assigned
+    are only updated if `overwrite` is set. Returns number of entities updated.
+    """
+    updates = {}
+    for ident, current, located in _located_rows(dbsession, model, locator):
+        if located is None or located == current:
+            continue
+        if current is not None and not overwrite:
+            continue
+        updates.setdefault(located, []).append(ident)
+
+    state_column = model.addr_state_id.property.columns[0]
+    table = state_column.table
+    pk = table.primary_key.columns.values()[0]
+    count = 0
+    for state_id, idents in updates.items():
+        for idx in range(0, len(idents), batch_size):
+            batch = idents[idx:idx + batch_size]
+            stmt = table.update().where(pk.in_(batch)) \
+                        .values({state_column.name: state_id})
+            count += dbsession.execute(stmt).rowcount
+
+    dbsession.expire_all()
+    return count
+
+
+def validate_states(dbsession, model, locator):
+    """Returns `(identity, current_state_id, located_state_id)` for entities
+    of a `LocatableMixin` model whose assigned state differs from the state
+    located from their coordinates, where one could be located.
+    """
+    return [row for row in _located_rows(dbsession, model, locator)
+            if row[2] is not None and row[1] != row[2]]
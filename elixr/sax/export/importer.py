@@ -82,14 +82,23 @@ class XRefResolver(object):
 
     It helps with cases where records are identified by a unique human-friendly
     value order than their respectively numeric id values. For performance,
-    results are cached for reuse.
+    results are cached for reuse and where provided, the reference data
+    snapshot (see `elixr.sax.refdata`) and the organization prefix index (see
+    `elixr.sax.orgindex`) are consulted before the database.
     """
-    def __init__(self, dbsession):
+    def __init__(self, dbsession, refdata=None, org_index=None):
         self.__dbsession = dbsession
+        self.__sources = [s for s in (refdata, org_index) if s is not None]
         self.__cache = {}
 
     def resolve(self, model_type, only_id=True, **filters):
         key = self.generate_key(model_type, only_id=only_id, **filters)
+        if key not in self.__cache and only_id:
+            for source in self.__sources:
+                record = source.find(model_type, **filters)
+                if record is not None:
+                    self.__cache[key] = record.uuid
+                    break
         if key not in self.__cache:
             fnquery = self.__dbsession.query
             query = fnquery(model_type.uuid if only_id else model_type) \
@@ -1,17 +1,55 @@
 """API functions with business logic for creating objects within Elixr.Sax.
 """
+import uuid
 import colander
-from sqlalchemy import exc, orm
+from sqlalchemy import exc, or_, orm
 from elixr.base import to_bool
 from elixr.sax import logic
 from . import schemas, validators as _val
 from .. import address as addr, party
+from ..refdata import to_entity
+
+
+
+PERSON_SEARCH_LIMIT = 10
+PERSON_SEARCH_MAX_LIMIT = 100
 
 
 
 ## ++++++++++
 ## UTIL FUNCS
 
+def _to_int(value):
+    if isinstance(value, uuid.UUID):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_uuid(value):
+    if isinstance(value, uuid.UUID):
+        return value
+    try:
+        return uuid.UUID(value)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def _get_organization_type(context, type_id):
+    """Returns the organization type entity with provided id, looked up from
+    the reference data snapshot in context if any before hitting the database.
+    """
+    refdata = context.get('refdata')
+    if refdata is not None:
+        found = refdata.get(party.OrganizationType, type_id)
+        if found is not None:
+            return to_entity(context['dbsession'], party.OrganizationType,
+                             found)
+    return organization_type_show(context['dbsession'], {'id': type_id})
+
+
 def _perform_organization_type_persistence_precheck(dbsession, data_dict):
     """Performs checks when `allow_multiroot=False` to ensure multiple root
     organization types don't get created during a create or update operation.
@@ -138,7 +176,7 @@ def organization_create(context, data_dict):
         raise logic.ValidationError({'type_id': 'Required'})
 
     # extensive checks required only if not to allow_multiroot
-    org_type = organization_type_show(dbsession, {'id': type_id})
+    org_type = _get_organization_type(context, type_id)
     context['type'] = org_type
 
     _perform_organization_persistence_precheck(context, data_dict)
@@ -189,6 +227,22 @@ def organization_show(dbsession, data_dict):
     return _entity_show(dbsession, party.Organization, data_dict)
 
 
+def person_search(dbsession, data_dict):
+    """Returns persons with names matching the terms within `data_dict['q']`
+    as prefixes, ranked by match quality and limited to `data_dict['limit']`
+    results, which defaults to `PERSON_SEARCH_LIMIT`.
+    """
+    text = (data_dict.get('q') or '').strip()
+    if not text:
+        raise logic.ValidationError({'q': 'Required'})
+
+    limit = _to_int(data_dict.get('limit', PERSON_SEARCH_LIMIT))
+    if limit is None or not 0 < limit <= PERSON_SEARCH_MAX_LIMIT:
+        raise logic.ValidationError({
+            'limit': 'Expected a number from 1 to %s' % PERSON_SEARCH_MAX_LIMIT})
+    return party.Person.search_name(dbsession, text, limit).all()
+
+
 def organization_type_show(dbsession, data_dict):
     """Returns the details of an organization type.
     """
@@ -260,9 +314,128 @@ def organization_update(context, data_dict):
         raise logic.ValidationError({'type_id': 'Required'})
 
     # extensive checks required only if not to allow_multiroot
-    org_type = organization_type_show(dbsession, {'id': type_id})
+    org_type = _get_organization_type(context, type_id)
     context['type'] = org_type
 
     _perform_organization_persistence_precheck(context, data_dict)
     schema = schemas.default_organization_schema(org_type.is_root)
     return _entity_update(dbsession, organization_show, schema, data_dict)
+
+
+## ++++++++++++++++++
+## ENTITY REPARENTING
+
+def _resolve_organizations(dbsession, refs):
+    """Returns a dict mapping each provided reference, an id or uuid, to the
+    `(uuid, parent_id, is_root_type, deleted)` of the matching organization
+    using a single query.
+    """
+    ids = set(v for v in map(_to_int, refs) if v is not None)
+    uuids = set(v for v in map(_to_uuid, refs) if v is not None)
+
+    model = party.Organization
+    criteria = []
+    if ids:
+        criteria.append(model.id.in_(ids))
+    if uuids:
+        criteria.append(model.uuid.in_(uuids))
+    if not criteria:
+        return {}
+
+    query = dbsession.query(model.id, model.uuid, model.parent_id,
+                            party.OrganizationType.is_root, model.deleted) \
+                     .join(model.type) \
+                     .filter(or_(*criteria))
+    found = {}
+    for id_, uuid_, parent_id, is_root, deleted in query:
+        found[id_] = found[uuid_] = (uuid_, parent_id, is_root, deleted)
+
+    resolved = {}
+    for ref in refs:
+        for key in (_to_int(ref), _to_uuid(ref)):
+            if key is not None and key in found:
+                resolved[ref] = found[key]
+                break
+    return resolved
+
+
+def organization_reparent_many(context, data_dict):
+    """Moves many organizations, along with their subtrees, under new parents
+    and returns the number of organizations moved.
+
+    `data_dict['moves']` is a list of dicts with the `id` of the organization
+    to move and the `parent_id` of its new parent. All parents are validated
+    and cycles detected in memory before the moves get applied using set-based
+    updates, within the current transaction, along with the hierarchy paths
+    where their maintenance is enabled. Parent references of organizations are
+    loaded once and shared by both the cycle detection and the paths rebuild.
+    """
+    assert 'dbsession' in context
+    dbsession = context['dbsession']
+    model = party.Organization
+
+    moves = data_dict.get('moves') or []
+    errors = {}
+    for idx, move in enumerate(moves):
+        if not move.get('id') or not move.get('parent_id'):
+            errors['moves.%s' % idx] = 'id and parent_id are required'
+    if errors:
+        raise logic.ValidationError(errors)
+
+    refs = [m['id'] for m in moves] + [m['parent_id'] for m in moves]
+    resolved = _resolve_organizations(dbsession, refs)
+    missing = [ref for ref in refs if ref not in resolved]
+    if missing:
+        raise logic.NotFoundError('Organization(s) not found: %s' %
+                                  ', '.join(str(ref) for ref in missing))
+
+    targets = {}
+    for idx, move in enumerate(moves):
+        org_id, _, is_root, _ = resolved[move['id']]
+        parent_id, _, _, parent_deleted = resolved[move['parent_id']]
+        if is_root:
+            errors['moves.%s' % idx] = 'Root organization cannot have a parent'
+        elif parent_deleted:
+            errors['moves.%s' % idx] = 'Parent organization is deleted'
+        elif org_id in targets and targets[org_id] != parent_id:
+            errors['moves.%s' % idx] = 'Organization moved more than once'
+        targets[org_id] = parent_id
+    if errors:
+        raise logic.ValidationError(errors)
+
+    # detect cycles against the hierarchy as it would be after the moves
+    parents = dict(dbsession.query(model.uuid, model.parent_id))
+    parents.update(targets)
+    for org_id in targets:
+        node, seen = parents.get(org_id), set([org_id])
+        while node is not None:
+            if node in seen:
+                raise logic.ValidationError({
+                    'moves': 'Moving organization %s creates a cycle' % org_id})
+            seen.add(node)
+            node = parents.get(node)
+
+    grouped = {}
+    for org_id, parent_id in targets.items():
+        grouped.setdefault(parent_id, []).append(org_id)
+
+    try:
+        dbsession.flush()
+        table = model.__table__
+        for parent_id, org_ids in grouped.items():
+            for idx in range(0, len(org_ids), model.BULK_BATCH_SIZE):
+                batch = org_ids[idx:idx + model.BULK_BATCH_SIZE]
+                dbsession.execute(table.update()
+                                       .where(table.c.uuid.in_(batch))
+                                       .values(parent_id=parent_id))
+        if party.organization_paths_enabled():
+            party.rebuild_organization_paths(dbsession, list(targets),
+                                             parents=parents)
+    except exc.IntegrityError as ex:
+        raise logic.ActionError(str(ex))
+
+    # expire loaded organizations so that their hierarchy is refreshed on access
+    for obj in list(dbsession.identity_map.values()):
+        if isinstance(obj, model):
+            dbsession.expire(obj, ['parent_id', 'parent', 'children'])
+    return len(targets)
@@ -0,0 +1,197 @@
+"""Provides a job which detects likely duplicate Person records.
+
+Persons are grouped into blocks sharing a blocking key, made up of the phonetic
+code of the last name, year of birth and state of origin, such that only pairs
+within a block get compared. Blocks are scored in parallel using a process pool
+and pairs scoring at or above a threshold are stored, ranked by score, within
+the candidates table.
+"""
+import difflib
+import multiprocessing
+from collections import namedtuple
+from sqlalchemy import Column, Float, ForeignKey, Index, Table
+from sqlalchemy.orm import aliased
+from . import meta, types
+from .party import Person, normalize_name
+
+
+
+DEFAULT_THRESHOLD = 0.85
+MAX_BLOCK_SIZE = 200
+INSERT_BATCH_SIZE = 1000
+
+
+PersonRecord = namedtuple('PersonRecord', [
+    'uuid', 'name', 'middle_name', 'last_name', 'gender', 'date_born',
+    'state_origin_id'
+])
+
+
+# ranked pairs of persons detected as likely duplicates of each other; the
+# person of a pair is the one with the lower uuid
+person_duplicate_candidates_table = Table(
+    'person_duplicate_candidates',
+    meta.metadata,
+    Column('person_id', types.UUID, ForeignKey('people.uuid'), primary_key=True),
+    Column('candidate_id', types.UUID, ForeignKey('people.uuid'),
+           primary_key=True),
+    Column('score', Float, nullable=False),
+    Index('ix_person_duplicate_candidates_score', 'score'),
+    Index('ix_person_duplicate_candidates_candidate_id', 'candidate_id')
+)
+
+
+_SOUNDEX_CODES = dict((c, str(code)) for code, letters in enumerate(
+    ['aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r']) for c in letters)
+
+
+def soundex(value):
+    """Returns the American Soundex code of the provided value or an empty
+    string if it has got no letters.
+    """
+    letters = [c for c in normalize_name(value) if c in _SOUNDEX_CODES]
+    if not letters:
+        return ''
+
+    code, last = [letters[0].upper()], _SOUNDEX_CODES[letters[0]]
+    for c in letters[1:]:
+        digit = _SOUNDEX_CODES[c]
+        if digit != '0' and digit != last:
+            code.append(digit)
+        if c not in 'hw':
+            last = digit
+    return (''.join(code) + '000')[:4]
+
+
+def blocking_key(record):
+    """Returns the blocking key of a person record or None if the record has
+    got no last name.
+    """
+    code = soundex(record.last_name)
+    if not code:
+        return None
+    year = record.date_born.year if record.date_born else None
+    return (code, year, record.state_origin_id)
+
+
+def _ratio(a, b):
+    a, b = normalize_name(a), normalize_name(b)
+    if not a or not b:
+        return None
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+def default_similarity(a, b):
+    """Returns the similarity, from 0 to 1, of two person records as the
+    weighted similarity of their names and date of birth. Fields missing from
+    either record are left out.
+    """
+    weights = ((_ratio(a.last_name, b.last_name), 0.35),
+               (_ratio(a.name, b.name), 0.35),
+               (_ratio(a.middle_name, b.middle_name), 0.1))
+    if a.date_born and b.date_born:
+        weights += ((1.0 if a.date_born == b.date_born else 0.0, 0.2),)
+
+    total = sum(weight for value, weight in weights if value is not None)
+    score = sum(value * weight for value, weight in weights if value is not None)
+    if a.gender and b.gender and a.gender != b.gender:
+        score *= 0.5
+    return score / total if total else 0.0
+
+
+def score_block(args):
+    """Scores all pairs of records within a block and returns the list of
+    `(score, person_id, candidate_id)` for pairs scoring at or above the
+    threshold. Arguments are packed in a tuple for use with a process pool.
+    """
+    records, similarity, threshold = args
+    pairs = []
+    for i, a in enumerate(records):
+        for b in records[i + 1:]:
+            score = similarity(a, b)
+            if score >= threshold:
+                first, second = sorted([a.uuid, b.uuid])
+                pairs.append((score, first, second))
+    return pairs
+
+
+def load_records(dbsession, query=None):
+    """Loads the fields of persons used for matching as `PersonRecord`s.
+    """
+    if query is None:
+        query = dbsession.query(*[getattr(Person, f) for f in PersonRecord._fields])
+    return [PersonRecord(*row) for row in query]
+
+
+def build_blocks(records, max_block_size=MAX_BLOCK_SIZE):
+    """Returns the lists of records sharing blocking keys, having at least two
+    records. Blocks larger than `max_block_size` are split by the phonetic
+    code of the first name.
+    """
+    blocks = {}
+    for record in records:
+        key = blocking_key(record)
+        if key is not None:
+            blocks.setdefault(key, []).append(record)
+
+    found = []
+    for key, block in blocks.items():
+        if len(block) > max_block_size:
+            split = {}
+            for record in block:
+                split.setdefault(soundex(record.name), []).append(record)
+            found.extend(split.values())
+        else:
+            found.append(block)
+    return [block for block in found if len(block) > 1]
+
+
+def find_duplicate_people(dbsession, similarity=default_similarity,
+                          threshold=DEFAULT_THRESHOLD, processes=None,
+                          max_block_size=MAX_BLOCK_SIZE, query=None):
+    """Detects pairs of persons likely to be duplicates, replaces the contents
+    of the candidates table with them and returns them ranked as a list of
+    `(score, person_id, candidate_id)`.
+
+    `similarity` is a picklable function which scores two `PersonRecord`s
+    from 0 to 1. Blocks get scored using a pool of `processes` processes,
+    defaulting to the number of CPUs, or within the current process if 1.
+    """
+    blocks = build_blocks(load_records(dbsession, query), max_block_size)
+    tasks = [(block, similarity, threshold) for block in blocks]
+    if processes == 1 or len(tasks) < 2:
+        results = [score_block(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(score_block, tasks, chunksize=16)
+        finally:
+            pool.close()
+            pool.join()
+
+    pairs = sorted((pair for pairs in results for pair in pairs),
+                   key=lambda pair: (-pair[0], pair[1], pair[2]))
+
+    table = person_duplicate_candidates_table
+    dbsession.execute(table.delete())
+    for idx in range(0, len(pairs), INSERT_BATCH_SIZE):
+        dbsession.execute(table.insert(), [
+            dict(score=score, person_id=first, candidate_id=second)
+            for score, first, second in pairs[idx:idx + INSERT_BATCH_SIZE]])
+    return pairs
+
+
+def duplicate_candidates(dbsession, limit=None, min_score=None):
+    """Returns a query for `(score, person, candidate)` from the candidates
+    table ordered by score, highest first.
+    """
+    table = person_duplicate_candidates_table
+    candidate = aliased(Person)
+    query = dbsession.query(table.c.score, Person, candidate) \
+                     .join(Person, Person.uuid == table.c.person_id) \
+                     .join(candidate, candidate.uuid == table.c.candidate_id)
+    if min_score is not None:
+        query = query.filter(table.c.score >= min_score)
+    query = query.order_by(table.c.score.desc(), table.c.person_id,
+                           table.c.candidate_id)
+    return query.limit(limit) if limit else query
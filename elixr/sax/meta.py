@@ -18,3 +18,13 @@ NAMING_CONVENTION = {
 metadata = MetaData(naming_convention=NAMING_CONVENTION)
 BASE  = declarative_base(metadata=metadata)
 Model = BASE   # Alias
+
+
+def referencing_foreign_keys(table):
+    """Yields `(referencing_table, foreign_key)` pairs for all foreign keys
+    within the metadata which refer to the provided table.
+    """
+    for ref_table in table.metadata.sorted_tables:
+        for fk in ref_table.foreign_keys:
+            if fk.column.table is table:
+                yield ref_table, fk
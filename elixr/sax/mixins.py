@@ -1,9 +1,11 @@
 import uuid
 from sqlalchemy import Column, Boolean, DateTime, Integer, Sequence, String
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.sql import func
-from sqlalchemy import exc, or_
-from . import types
+from sqlalchemy.schema import Index, UniqueConstraint
+from sqlalchemy.sql import false, func, true
+from sqlalchemy import event, exc, inspect, or_
+from elixr.base._compat import string_types
+from . import query as _query, types
 
 
 
@@ -73,10 +75,152 @@ class EntityMixin(IdsMixin, TimestampMixin):
 
         return found
 
+    @classmethod
+    def paginate(cls, dbsession, limit=25, after=None, before=None,
+                 order_by=None, descending=False, include_deleted=False,
+                 query=None):
+        """Returns a `query.Page` of entities using keyset (seek) pagination.
+
+        Entities are ordered by `(date_created, id)` by default otherwise by
+        the names or columns provided in `order_by`; `id` is appended where
+        missing to ensure a total ordering. Records marked as deleted are
+        excluded unless `include_deleted` is set. A prepared query can be
+        provided in order to apply extra filters.
+        """
+        columns = [getattr(cls, c) if isinstance(c, string_types) else c
+                   for c in (order_by or ('date_created', 'id'))]
+        if not any(c.key == 'id' for c in columns):
+            columns.append(cls.id)
+
+        if query is None:
+            query = dbsession.query(cls)
+        if not include_deleted:
+            query = _query.exclude_deleted(query)
+
+        # deleted records have been handled explicitly at this point
+        query = query.execution_options(**{_query.INCLUDE_DELETED: True})
+        return _query.paginate(query, columns, limit, after, before, descending)
+
+    @classmethod
+    def stream(cls, dbsession, batch_size=_query.DEFAULT_STREAM_BATCH_SIZE,
+               rows_only=False, columns=None, include_deleted=False,
+               query=None):
+        """Iterates over all entities in batches of `batch_size` with bounded
+        memory use. Collections configured for joined loading are loaded
+        per batch using selectin loading instead.
+
+        With `rows_only` set, tuples holding values of the mapped columns, or
+        of the names or columns provided in `columns`, are returned in place
+        of entities.
+        """
+        if query is None:
+            if rows_only or columns:
+                columns = [getattr(cls, c) if isinstance(c, string_types) else c
+                           for c in (columns or [p.key for p in
+                                                 inspect(cls).column_attrs])]
+                query = dbsession.query(*columns)
+            else:
+                query = dbsession.query(cls)
+                query = query.options(*_query.streaming_options(cls))
+        if not include_deleted:
+            query = _query.exclude_deleted(query)
+
+        query = query.execution_options(**{_query.INCLUDE_DELETED: True})
+        return _query.stream(query, batch_size)
+
 
 class EntityWithDeletedMixin(EntityMixin, DeletedMixin):
     """A mixin which defines the minimum fields required of an Entity model and
     supports marking of record as deleted as opposed to the actual deletion from
     the database.
     """
-    pass
+    BULK_BATCH_SIZE = 500
+
+    @classmethod
+    def soft_delete(cls, dbsession, uuids, batch_size=None):
+        """Marks entities with the provided UUIDs as deleted using set-based
+        updates and returns the number of entities affected.
+        """
+        return cls._set_deleted(dbsession, uuids, True, batch_size)
+
+    @classmethod
+    def restore(cls, dbsession, uuids, batch_size=None):
+        """Clears the deleted mark for entities with the provided UUIDs using
+        set-based updates and returns the number of entities affected.
+        """
+        return cls._set_deleted(dbsession, uuids, False, batch_size)
+
+    @classmethod
+    def _set_deleted(cls, dbsession, uuids, deleted, batch_size=None):
+        # the deleted field lives on the table for the base model thus updates
+        # are issued against it, restricted to the polymorphic identities for
+        # the model in use where inheritance is involved
+        mapper = inspect(cls)
+        base = mapper.base_mapper.class_
+        criteria = [base.deleted == true()] if not deleted else \
+                   [or_(base.deleted == false(), base.deleted.is_(None))]
+        if mapper.polymorphic_on is not None and mapper is not mapper.base_mapper:
+            identities = [m.polymorphic_identity for m in mapper.self_and_descendants]
+            criteria.append(mapper.polymorphic_on.in_(identities))
+
+        uuids = list(uuids)
+        batch_size = batch_size or cls.BULK_BATCH_SIZE
+        count = 0
+        for idx in range(0, len(uuids), batch_size):
+            batch = uuids[idx:idx + batch_size]
+            query = dbsession.query(base).filter(base.uuid.in_(batch), *criteria)
+            count += query.update({base.deleted: deleted},
+                                  synchronize_session=False)
+
+        # expire loaded entities so that their state is refreshed on access
+        targets = set(u if isinstance(u, uuid.UUID) else uuid.UUID(str(u))
+                      for u in uuids)
+        for obj in list(dbsession.identity_map.values()):
+            if isinstance(obj, cls) and obj.uuid in targets:
+                dbsession.expire(obj, ['deleted', 'last_updated'])
+        return count
+
+
+@event.listens_for(EntityMixin, 'instrument_class', propagate=True)
+def _declare_keyset_indexes(mapper, cls):
+    """Declares the composite indexes which support keyset pagination over
+    `(date_created, id)` for tables of models derived from `EntityMixin`.
+    For models with the `deleted` field, an extra index prefixed with it is
+    declared to support listings which exclude deleted records.
+    """
+    table = mapper.local_table
+    if mapper.inherits is not None or 'date_created' not in table.c:
+        return
+
+    keysets = [[table.c.date_created, table.c.id]]
+    if 'deleted' in table.c:
+        keysets.append([table.c.deleted] + keysets[0])
+    for columns in keysets:
+        name = 'ix_%s_%s' % (table.name, '_'.join(c.name for c in columns))
+        Index(name, *columns)
+
+
+@event.listens_for(DeletedMixin, 'instrument_class', propagate=True)
+def _declare_natural_key_indexes(mapper, cls):
+    """Declares partial indexes covering only records not marked as deleted
+    over the natural keys (unique constraints on fields other than `id` and
+    `uuid`) for tables of models derived from `DeletedMixin`. Partial indexes
+    are rendered for SQLite and PostgreSQL.
+    """
+    table = mapper.local_table
+    if 'deleted' not in table.c:
+        return
+
+    # single-table inheritance models add their columns to the parent table
+    # thus existing indexes are skipped
+    live = table.c.deleted == false()
+    existing = set(i.name for i in table.indexes)
+    for constraint in list(table.constraints):
+        if not isinstance(constraint, UniqueConstraint):
+            continue
+        names = [c.name for c in constraint.columns]
+        name = 'ix_%s_%s_live' % (table.name, '_'.join(names))
+        if set(names) & set(['id', 'uuid']) or name in existing:
+            continue
+        Index(name, *constraint.columns, sqlite_where=live,
+              postgresql_where=live)
@@ -0,0 +1,145 @@
+"""Provides an immutable in-memory prefix index over the code and short name of
+organizations, which are unique human-entered identifiers, for completion as
+users type and for lookups by `XRefResolver` without querying the database.
+
+Keys are held case folded within sorted arrays such that the keys sharing a
+prefix occupy a contiguous range located by binary search.
+"""
+from bisect import bisect_left
+from collections import namedtuple
+from elixr.base._compat import text_type
+
+from .orgtree import OrganizationSnapshotService
+from .party import Organization
+
+
+
+DEFAULT_LIMIT = 10
+
+
+OrganizationKeyRecord = namedtuple('OrganizationKeyRecord', [
+    'uuid', 'code', 'short_name', 'name'
+])
+
+
+def _fold(value):
+    return text_type(value).strip().lower()
+
+
+def _query(dbsession, org_ids=None):
+    query = dbsession.query(Organization.uuid, Organization.code,
+                            Organization.short_name, Organization.name,
+                            Organization.deleted)
+    if org_ids is not None:
+        query = query.filter(Organization.uuid.in_(list(org_ids)))
+    return query
+
+
+class OrganizationPrefixIndex(object):
+    """An immutable prefix index over the `FIELDS` of organizations not marked
+    as deleted.
+    """
+    FIELDS = ('code', 'short_name')
+
+    def __init__(self, records=()):
+        self._records = dict((r.uuid, r) for r in records)
+        self._keys, self._entries = {}, {}
+        for field in self.FIELDS:
+            entries = sorted(((_fold(getattr(r, field)), getattr(r, field), r)
+                              for r in self._records.values()
+                              if getattr(r, field) is not None),
+                             key=lambda e: e[:2])
+            self._keys[field] = [e[0] for e in entries]
+            self._entries[field] = [e[2] for e in entries]
+
+    @classmethod
+    def load(cls, dbsession):
+        """Creates an index over organizations not marked as deleted using a
+        single query.
+        """
+        return cls(OrganizationKeyRecord(*row[:-1]) for row in _query(dbsession)
+                   if not row[-1])
+
+    def updated(self, dbsession, org_ids):
+        """Returns a new index with the records of organizations with provided
+        ids reloaded; organizations not found or marked as deleted are left out
+        of the new index.
+        """
+        records = dict(self._records)
+        org_ids = list(org_ids)
+        for org_id in org_ids:
+            records.pop(org_id, None)
+        for idx in range(0, len(org_ids), Organization.BULK_BATCH_SIZE):
+            batch = org_ids[idx:idx + Organization.BULK_BATCH_SIZE]
+            for row in _query(dbsession, batch):
+                if not row[-1]:
+                    records[row[0]] = OrganizationKeyRecord(*row[:-1])
+        return OrganizationPrefixIndex(records.values())
+
+    def __len__(self):
+        return len(self._records)
+
+    def _matches(self, field, prefix):
+        keys, entries = self._keys[field], self._entries[field]
+        position = bisect_left(keys, prefix)
+        while position < len(keys) and keys[position].startswith(prefix):
+            yield keys[position], entries[position]
+            position += 1
+
+    def complete(self, prefix, field=None, limit=DEFAULT_LIMIT):
+        """Returns records of organizations whose `field`, or any of `FIELDS`
+        if not provided, starts with the provided prefix ignoring case. Records
+        are ordered by the matching key.
+        """
+        fields = self.FIELDS if field is None else (field,)
+        prefix = _fold(prefix)
+        found = []
+        for field in fields:
+            for i, match in enumerate(self._matches(field, prefix)):
+                if i == limit:
+                    break
+                found.append(match)
+
+        found.sort(key=lambda match: match[0])
+        seen, results = set(), []
+        for key, record in found:
+            if record.uuid not in seen:
+                seen.add(record.uuid)
+                results.append(record)
+        return results[:limit]
+
+    def find(self, model, **filters):
+        """Returns the record of the organization whose field matches the value
+        of a single filter on one of `FIELDS`, or None if not found or filters
+        are not supported. The signature matches that of `RefDataSnapshot.find`
+        so the index can be consulted by `XRefResolver`.
+        """
+        if not (isinstance(model, type) and issubclass(model, Organization)) \
+                or len(filters) != 1:
+            return None
+        field, value = list(filters.items())[0]
+        if field not in self.FIELDS or value is None:
+            return None
+        key = _fold(value)
+        for match_key, record in self._matches(field, key):
+            if match_key != key:
+                break
+            if getattr(record, field) == value:
+                return record
+        return None
+
+
+class OrganizationIndexService(OrganizationSnapshotService):
+    """Maintains the current `OrganizationPrefixIndex` snapshot.
+    """
+    SNAPSHOT_CLASS = OrganizationPrefixIndex
+
+    @property
+    def index(self):
+        return self.snapshot
+
+    def complete(self, prefix, field=None, limit=DEFAULT_LIMIT):
+        return self.snapshot.complete(prefix, field, limit)
+
+    def find(self, model, **filters):
+        return self.snapshot.find(model, **filters)
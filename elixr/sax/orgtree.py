@@ -0,0 +1,262 @@
+"""Provides an immutable in-memory snapshot of the Organization hierarchy with
+precomputed subtree sizes and per type counts of descendants, for dashboards
+which render the whole tree or aggregates over it.
+
+Nodes are held in pre-order within flat arrays such that the subtree of a node
+occupies the contiguous range of positions following it.
+"""
+import json
+import threading
+from array import array
+from collections import namedtuple
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from .party import Organization
+
+
+
+NodeRecord = namedtuple('NodeRecord', [
+    'uuid', 'parent_id', 'type_id', 'code', 'name'
+])
+
+
+def _query(dbsession, org_ids=None):
+    query = dbsession.query(Organization.uuid, Organization.parent_id,
+                            Organization.type_id, Organization.code,
+                            Organization.name, Organization.deleted)
+    if org_ids is not None:
+        query = query.filter(Organization.uuid.in_(list(org_ids)))
+    return query
+
+
+class OrganizationTree(object):
+    """An immutable snapshot of the organization hierarchy. Organizations whose
+    parent is not part of the snapshot (e.g. deleted) are treated as roots.
+    """
+
+    def __init__(self, records=()):
+        self._records = dict((r.uuid, r) for r in records)
+        self.type_ids = sorted(set(r.type_id for r in self._records.values()),
+                               key=str)
+        self._build()
+
+    def _build(self):
+        children = {}
+        for record in self._records.values():
+            parent_id = record.parent_id
+            if parent_id not in self._records:
+                parent_id = None
+            children.setdefault(parent_id, []).append(record)
+        for nodes in children.values():
+            nodes.sort(key=lambda r: (r.code, str(r.uuid)))
+
+        # lay nodes out in pre-order using an explicit stack
+        self.nodes, parents = [], []
+        stack = [(r, -1) for r in reversed(children.get(None, []))]
+        while stack:
+            record, parent = stack.pop()
+            position = len(self.nodes)
+            self.nodes.append(record)
+            parents.append(parent)
+            stack.extend((r, position) for r in
+                         reversed(children.get(record.uuid, [])))
+
+        count, num_types = len(self.nodes), len(self.type_ids)
+        type_index = dict((t, i) for i, t in enumerate(self.type_ids))
+        self.positions = dict((r.uuid, i) for i, r in enumerate(self.nodes))
+        self.parents = array('i', parents)
+        self.sizes = array('i', [1] * count)
+        self.counts = array('i', [0] * (count * num_types))
+
+        # aggregates are accumulated from the last node backwards, as every
+        # node follows its parent in pre-order
+        for position in range(count - 1, 0, -1):
+            parent = self.parents[position]
+            if parent < 0:
+                continue
+            self.sizes[parent] += self.sizes[position]
+            offset, parent_offset = position * num_types, parent * num_types
+            for i in range(num_types):
+                self.counts[parent_offset + i] += self.counts[offset + i]
+            kind = type_index[self.nodes[position].type_id]
+            self.counts[parent_offset + kind] += 1
+
+    @classmethod
+    def load(cls, dbsession):
+        """Creates a snapshot of organizations not marked as deleted using a
+        single query.
+        """
+        return cls(NodeRecord(*row[:-1]) for row in _query(dbsession)
+                   if not row[-1])
+
+    def updated(self, dbsession, org_ids):
+        """Returns a new snapshot with the records of organizations with the
+        provided ids reloaded; organizations not found or marked as deleted
+        are left out of the new snapshot.
+        """
+        records = dict(self._records)
+        org_ids = list(org_ids)
+        for org_id in org_ids:
+            records.pop(org_id, None)
+        for idx in range(0, len(org_ids), Organization.BULK_BATCH_SIZE):
+            batch = org_ids[idx:idx + Organization.BULK_BATCH_SIZE]
+            for row in _query(dbsession, batch):
+                if not row[-1]:
+                    records[row[0]] = NodeRecord(*row[:-1])
+        return OrganizationTree(records.values())
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, org_id):
+        return org_id in self.positions
+
+    def roots(self):
+        return [r for i, r in enumerate(self.nodes) if self.parents[i] < 0]
+
+    def children(self, org_id):
+        """Returns the records of the children of an organization.
+        """
+        position = self.positions[org_id]
+        found, child = [], position + 1
+        while child < position + self.sizes[position]:
+            found.append(self.nodes[child])
+            child += self.sizes[child]
+        return found
+
+    def descendants(self, org_id):
+        """Returns the records of the descendants of an organization in
+        pre-order.
+        """
+        position = self.positions[org_id]
+        return self.nodes[position + 1:position + self.sizes[position]]
+
+    def descendant_count(self, org_id):
+        return self.sizes[self.positions[org_id]] - 1
+
+    def type_counts(self, org_id):
+        """Returns the number of descendants of an organization per type id,
+        for types having any.
+        """
+        num_types = len(self.type_ids)
+        offset = self.positions[org_id] * num_types
+        return dict((t, self.counts[offset + i])
+                    for i, t in enumerate(self.type_ids)
+                    if self.counts[offset + i])
+
+    def to_dict(self, org_id=None):
+        """Returns the nested representation of the subtree of an organization,
+        or a list of those of all roots where no id is provided.
+        """
+        if org_id is None:
+            return [self.to_dict(r.uuid) for r in self.roots()]
+
+        position = self.positions[org_id]
+        num_types = len(self.type_ids)
+        results = []
+        # parents precede their children in pre-order, children thus get
+        # appended to their serialized parent in order
+        for node in range(position, position + self.sizes[position]):
+            record = self.nodes[node]
+            counts = self.counts[node * num_types:(node + 1) * num_types]
+            results.append({
+                'id': str(record.uuid),
+                'code': record.code,
+                'name': record.name,
+                'type_id': str(record.type_id),
+                'descendant_count': self.sizes[node] - 1,
+                'type_counts': dict((str(t), c) for t, c in
+                                    zip(self.type_ids, counts) if c),
+                'children': [],
+            })
+            if node != position:
+                parent = results[self.parents[node] - position]
+                parent['children'].append(results[-1])
+        return results[0]
+
+    def to_json(self, org_id=None):
+        return json.dumps(self.to_dict(org_id), separators=(',', ':'))
+
+
+class OrganizationSnapshotService(object):
+    """Maintains the current snapshot, of `SNAPSHOT_CLASS`, built over
+    organizations. The snapshot is loaded on first access and, for sessions
+    being watched, updated on access after changes to organizations get
+    committed by reloading only the organizations changed.
+
+    Changes which bypass the ORM, e.g. `organization_reparent_many`, are to
+    be reported with `invalidate`.
+    """
+    SNAPSHOT_CLASS = None
+
+    def __init__(self, session_factory):
+        self._session_factory = session_factory
+        self._snapshot = None
+        self._changed = set()
+        self._lock = threading.Lock()
+
+    @property
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None or self._changed:
+            snapshot = self.refresh()
+        return snapshot
+
+    def refresh(self):
+        """Updates the snapshot with pending changes, or loads it if not loaded,
+        and returns the new snapshot.
+        """
+        with self._lock:
+            changed, self._changed = self._changed, set()
+            dbsession = self._session_factory()
+            try:
+                if self._snapshot is None or None in changed:
+                    snapshot = self.SNAPSHOT_CLASS.load(dbsession)
+                else:
+                    snapshot = self._snapshot.updated(dbsession, changed)
+            except Exception:
+                self._changed |= changed
+                raise
+            finally:
+                dbsession.close()
+            self._snapshot = snapshot
+            return snapshot
+
+    def invalidate(self, org_ids=None):
+        """Marks organizations with provided ids, or all if none provided, as
+        changed so the snapshot gets updated on access.
+        """
+        self._changed |= set([None] if org_ids is None else org_ids)
+
+    def watch(self, target=Session):
+        """Watches sessions, a Session class or sessionmaker, for committed
+        changes to organizations to update the snapshot.
+        """
+        event.listen(target, 'after_flush', self._after_flush)
+        event.listen(target, 'after_commit', self._after_commit)
+        event.listen(target, 'after_rollback', self._after_rollback)
+
+    def _after_flush(self, dbsession, flush_context):
+        changed = set(obj.uuid for obj in list(dbsession.new) +
+                      list(dbsession.dirty) + list(dbsession.deleted)
+                      if isinstance(obj, Organization))
+        if changed:
+            dbsession.info.setdefault(self, set()).update(changed)
+
+    def _after_commit(self, dbsession):
+        changed = dbsession.info.pop(self, None)
+        if changed:
+            self.invalidate(changed)
+
+    def _after_rollback(self, dbsession):
+        dbsession.info.pop(self, None)
+
+
+class OrganizationTreeService(OrganizationSnapshotService):
+    """Maintains the current `OrganizationTree` snapshot.
+    """
+    SNAPSHOT_CLASS = OrganizationTree
+
+    @property
+    def tree(self):
+        return self.snapshot
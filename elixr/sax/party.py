@@ -2,15 +2,20 @@
 structures within an application.
 """
 import enum
+import unicodedata
 from sqlalchemy import (
-    Column, Boolean, Date, ForeignKey, Integer, String, Table, UniqueConstraint
+    Column, Boolean, Date, ForeignKey, Index, Integer, String, Table,
+    UniqueConstraint, and_, bindparam, case, event, false, func, inspect,
+    literal, or_, select
 )
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import aliased, relationship, backref, defer, \
+        selectinload, with_polymorphic
 
+from elixr.base._compat import text_type
 from .mixins import EntityMixin, EntityWithDeletedMixin
 from .address import AddressMixin, CoordinatesMixin
-from . import meta, types
+from . import meta, query as _query, types
 
 
 
@@ -45,13 +50,17 @@ class MaritalStatus(enum.Enum):
 parties_contact_details_table = Table(
     'parties_contact_details',
     meta.metadata,
-    Column('party_id', types.UUID, ForeignKey('parties.uuid')),
-    Column('contact_detail_id', types.UUID, ForeignKey('contact_details.uuid'))
+    Column('party_id', types.UUID, ForeignKey('parties.uuid'), index=True),
+    Column('contact_detail_id', types.UUID, ForeignKey('contact_details.uuid'),
+           index=True)
 )
 
 
 class ContactDetail(meta.Model, EntityWithDeletedMixin):
     """A Single-Table Inheritance model for storing all forms of contact details.
+
+    Email addresses and phone numbers are also stored normalized, within the
+    indexed `address_key` and `number_key` fields, for lookups.
     """
     __tablename__ = 'contact_details'
 
@@ -72,6 +81,7 @@ class EmailContact(ContactDetail):
         'polymorphic_identity': ContactType.EMAIL
     }
     address = Column(String(150), unique=True)
+    address_key = Column(String(150), index=True)
 
 
 class PhoneContact(ContactDetail):
@@ -81,9 +91,77 @@ class PhoneContact(ContactDetail):
         'polymorphic_identity': ContactType.PHONE
     }
     number = Column(String(15), unique=True)
+    # sized for numbers in national format prefixed with a 3 digit calling code
+    number_key = Column(String(18), index=True)
     extension = Column(String(10))
 
 
+# calling code used to normalize phone numbers in national format (leading 0)
+# into the E.164 format; such numbers are only stripped of formatting if None
+PHONE_CALLING_CODE = None
+
+
+def normalize_email(address):
+    """Returns the case folded email address stripped of surrounding spaces.
+    """
+    if address is None:
+        return None
+    return address.strip().lower() or None
+
+
+def normalize_phone(number, calling_code=None):
+    """Returns the phone number in E.164 style, i.e. `+` followed by digits,
+    where its country can be determined, otherwise just its digits. Numbers
+    in national format get prefixed with the calling code if provided or
+    `PHONE_CALLING_CODE`.
+    """
+    if number is None:
+        return None
+    number = number.strip()
+    digits = ''.join(c for c in number if c.isdigit())
+    calling_code = calling_code or PHONE_CALLING_CODE
+    if not digits:
+        return None
+    if number.startswith('+'):
+        return '+' + digits
+    if digits.startswith('00'):
+        return '+' + digits[2:]
+    if calling_code and digits.startswith('0'):
+        return '+%s%s' % (calling_code, digits[1:])
+    return digits
+
+
+@event.listens_for(EmailContact, 'before_insert', propagate=True)
+@event.listens_for(EmailContact, 'before_update', propagate=True)
+def _update_address_key(mapper, connection, target):
+    target.address_key = normalize_email(target.address)
+
+
+@event.listens_for(PhoneContact, 'before_insert', propagate=True)
+@event.listens_for(PhoneContact, 'before_update', propagate=True)
+def _update_number_key(mapper, connection, target):
+    target.number_key = normalize_phone(target.number)
+
+
+def update_contact_keys(dbsession):
+    """Computes and stores the normalized keys for contacts which have got no
+    key, e.g. after bulk loads which bypass the ORM. Returns the number of
+    contacts updated.
+    """
+    count = 0
+    for model, field, key_field, normalize in (
+            (EmailContact, 'address', 'address_key', normalize_email),
+            (PhoneContact, 'number', 'number_key', normalize_phone)):
+        query = dbsession.query(model).filter(
+            getattr(model, key_field).is_(None),
+            getattr(model, field).isnot(None))
+        for contact in query:
+            setattr(contact, key_field, normalize(getattr(contact, field)))
+            count += 1
+    dbsession.flush()
+    return count
+
+
 class Party(meta.Model, EntityWithDeletedMixin, AddressMixin):
     """A Joined Table inheritance model for storing the named parts of a Party
     derived inheritance model relationship.
@@ -99,12 +177,80 @@ class Party(meta.Model, EntityWithDeletedMixin, AddressMixin):
 
     name = Column(String(50), nullable=False)
     subtype = Column(types.Choice(PartyType), nullable=False)
-    contacts = relationship("ContactDetail", lazy="joined",
+    contacts = relationship("ContactDetail", lazy="selectin",
                             secondary="parties_contact_details")
 
+    @classmethod
+    def find_by_emails(cls, dbsession, addresses):
+        """Returns a dict mapping each provided email address to the list of
+        parties having it as contact; addresses are matched normalized.
+        """
+        return cls._find_by_contacts(dbsession, EmailContact.address_key,
+                                     addresses, normalize_email)
+
+    @classmethod
+    def find_by_phones(cls, dbsession, numbers):
+        """Returns a dict mapping each provided phone number to the list of
+        parties having it as contact; numbers are matched normalized.
+        """
+        return cls._find_by_contacts(dbsession, PhoneContact.number_key,
+                                     numbers, normalize_phone)
+
+    @classmethod
+    def _find_by_contacts(cls, dbsession, key_column, values, normalize):
+        keys = dict((value, normalize(value)) for value in values)
+        unique_keys = list(set(k for k in keys.values() if k is not None))
+        found = {}
+        for idx in range(0, len(unique_keys), cls.BULK_BATCH_SIZE):
+            batch = unique_keys[idx:idx + cls.BULK_BATCH_SIZE]
+            query = dbsession.query(key_column, cls) \
+                             .join(cls.contacts) \
+                             .filter(key_column.in_(batch))
+            for key, entity in query:
+                found.setdefault(key, []).append(entity)
+        return dict((value, found.get(key, [])) for value, key in keys.items())
+
+    @classmethod
+    def polymorphic_query(cls, dbsession, subtypes=None, columns=None):
+        """Returns a query for parties which loads the fields of all or the
+        provided subtypes (e.g. Person, Organization) along with the base
+        fields in a single statement, using outer joins to subtype tables.
+
+        `columns` optionally maps subtypes to names of the subtype fields to
+        load; other fields of a mapped subtype are deferred. As the subtype
+        tables are joined without aliasing, criteria can be expressed using
+        the subtype models directly, e.g. `Person.last_name == 'Doe'`.
+        """
+        mapper = inspect(cls)
+        if subtypes is None:
+            subtypes = [m.class_ for m in mapper.self_and_descendants
+                        if m is not mapper]
+
+        entity = with_polymorphic(cls, list(subtypes))
+        query = dbsession.query(entity)
+        if mapper.polymorphic_on is not None and subtypes:
+            identities = [m.polymorphic_identity for model in subtypes
+                          for m in inspect(model).self_and_descendants]
+            query = query.filter(mapper.polymorphic_on.in_(identities))
+
+        options = []
+        for model, names in (columns or {}).items():
+            submapper = inspect(model)
+            subentity = getattr(entity, model.__name__)
+            for column in submapper.local_table.columns:
+                if column.primary_key:
+                    continue
+                key = submapper.get_property_by_column(column).key
+                if key not in names:
+                    options.append(defer(getattr(subentity, key)))
+        return query.options(*options) if options else query
+
 
 class Person(Party):
     """A model for storing Person details.
+
+    Names are also stored normalized, case folded and stripped of accents,
+    within indexed key fields which back prefix searches with `search_name`.
     """
     __tablename__ = 'people'
     __mapper_args__ = {
@@ -122,6 +268,11 @@ class Person(Party):
     state_origin = relationship("State")
     nationality_id = Column(types.UUID, ForeignKey("countries.uuid"))
     nationality = relationship("Country")
+    name_key = Column(String(50), index=True)
+    middle_name_key = Column(String(50), index=True)
+    last_name_key = Column(String(50), index=True)
+    NAME_KEY_FIELDS = (('name', 'name_key'), ('middle_name', 'middle_name_key'),
+                       ('last_name', 'last_name_key'))
 
     @property
     def first_name(self):
@@ -131,6 +282,90 @@ class Person(Party):
     def set_first_name(self, value):
         self.name = value
 
+    @classmethod
+    def search_name(cls, dbsession, text, limit=10, query=None):
+        """Returns a query for persons with names matching all the terms within
+        the provided text, each as a prefix of a first, middle or last name.
+        Results are ranked with exact matches of terms, then matches on last
+        names, placed first and limited to `limit` persons.
+        """
+        query = query if query is not None else dbsession.query(cls)
+        terms = normalize_name(text).split()
+        if not terms:
+            return query.filter(false())
+
+        keys = [cls.last_name_key, cls.name_key, cls.middle_name_key]
+        scores = []
+        for term in terms[:MAX_NAME_TERMS]:
+            # a prefix match is expressed as a range so the indexes are usable
+            upper = term[:-1] + _unichr(ord(term[-1]) + 1)
+            matches = [and_(key >= term, key < upper) for key in keys]
+            query = query.filter(or_(*matches))
+            scores.append(case([(keys[0] == term, 4),
+                                (or_(keys[1] == term, keys[2] == term), 3),
+                                (matches[0], 2)], else_=1))
+        score = sum(scores[1:], scores[0])
+        return query.order_by(score.desc(), cls.last_name_key, cls.name_key,
+                              cls.id).limit(limit)
+
+
+# the maximum number of terms considered when searching names
+MAX_NAME_TERMS = 4
+
+try:
+    _unichr = unichr
+except NameError:
+    _unichr = chr
+
+
+def normalize_name(value):
+    """Returns the name case folded, stripped of accents and punctuation with
+    its parts separated by single spaces.
+    """
+    if not value:
+        return ''
+    value = unicodedata.normalize('NFKD', text_type(value))
+    value = ''.join(c for c in value if not unicodedata.combining(c))
+    value = ''.join(c if c.isalnum() else ' ' for c in value.lower())
+    return ' '.join(value.split())
+
+
+@event.listens_for(Person, 'before_insert', propagate=True)
+@event.listens_for(Person, 'before_update', propagate=True)
+def _update_name_keys(mapper, connection, target):
+    for field, key_field in target.NAME_KEY_FIELDS:
+        setattr(target, key_field, normalize_name(getattr(target, field))[:50]
+                                   or None)
+
+
+def update_name_keys(dbsession, batch_size=1000):
+    """Computes and stores the name keys for persons which have got no first
+    name key, e.g. those created before name keys were introduced or by bulk
+    loads which bypass the ORM, using batched updates. Returns the number of
+    persons updated.
+    """
+    fields = [field for field, _ in Person.NAME_KEY_FIELDS]
+    query = dbsession.query(Person.uuid, *[getattr(Person, f) for f in fields]) \
+                     .filter(Person.name_key.is_(None)) \
+                     .order_by(Person.uuid)
+    table = Person.__table__
+    stmt = table.update().where(table.c.uuid == bindparam('_uuid')) \
+                         .values(dict((key_field, bindparam('_' + key_field))
+                                      for _, key_field in Person.NAME_KEY_FIELDS))
+
+    count, rows = 0, query.limit(batch_size).all()
+    while rows:
+        params = []
+        for row in rows:
+            param = {'_uuid': row[0]}
+            for (_, key_field), value in zip(Person.NAME_KEY_FIELDS, row[1:]):
+                param['_' + key_field] = normalize_name(value)[:50] or None
+            params.append(param)
+        dbsession.execute(stmt, params)
+        count += len(rows)
+        rows = query.filter(Person.uuid > rows[-1][0]).limit(batch_size).all()
+    return count
+
 
 class OrganizationType(meta.Model, EntityWithDeletedMixin):
     """A model to define the classifications for Organizations.
@@ -155,6 +390,13 @@ class Organization(Party, CoordinatesMixin):
     for the children relationship gets this working but breaks cascade delete
     for organization type. So working organization type behaviour was settled
     for.
+
+    :hint: the hierarchy can also be maintained as a closure table, holding a
+    row for each ancestor and descendant pair, which allows descendants,
+    ancestors, depth and subtree counts to be fetched in a single indexed
+    query. Maintenance is opt-in through `enable_organization_paths` and
+    paths of existing organizations are built with `rebuild_organization_paths`;
+    those methods return incomplete results otherwise.
     """
     __tablename__ = 'organizations'
     __mapper_args__ = {
@@ -172,3 +414,282 @@ class Organization(Party, CoordinatesMixin):
     type = relationship("OrganizationType", back_populates="organizations")
     children = relationship("Organization", foreign_keys=[parent_id],
                             backref=backref("parent", remote_side=[uuid]))
+
+    @classmethod
+    def descendants(cls, dbsession, org_id, include_self=False, max_depth=None):
+        """Returns a query for the descendants of the organization with the
+        provided id ordered by their depth relative to it, then id.
+        """
+        paths = organization_paths_table
+        query = dbsession.query(cls) \
+                         .join(paths, paths.c.descendant_id == cls.uuid) \
+                         .filter(paths.c.ancestor_id == org_id)
+        if not include_self:
+            query = query.filter(paths.c.depth > 0)
+        if max_depth is not None:
+            query = query.filter(paths.c.depth <= max_depth)
+        return query.order_by(paths.c.depth, cls.id)
+
+    @classmethod
+    def ancestors(cls, dbsession, org_id, include_self=False):
+        """Returns a query for the ancestors of the organization with the
+        provided id ordered from its parent up to the root.
+        """
+        paths = organization_paths_table
+        query = dbsession.query(cls) \
+                         .join(paths, paths.c.ancestor_id == cls.uuid) \
+                         .filter(paths.c.descendant_id == org_id)
+        if not include_self:
+            query = query.filter(paths.c.depth > 0)
+        return query.order_by(paths.c.depth)
+
+    @classmethod
+    def depth(cls, dbsession, org_id):
+        """Returns the depth of the organization with the provided id where
+        root organizations are at depth 0, or None if not found.
+        """
+        paths = organization_paths_table
+        return dbsession.query(func.max(paths.c.depth)) \
+                        .filter(paths.c.descendant_id == org_id) \
+                        .scalar()
+
+    @classmethod
+    def subtree_counts(cls, dbsession, org_ids):
+        """Returns the number of descendants, keyed by organization id, for
+        organizations with the provided ids.
+        """
+        paths = organization_paths_table
+        query = dbsession.query(paths.c.ancestor_id, func.count()) \
+                         .filter(paths.c.ancestor_id.in_(list(org_ids)),
+                                 paths.c.depth > 0) \
+                         .group_by(paths.c.ancestor_id)
+        counts = dict((org_id, 0) for org_id in org_ids)
+        counts.update(query.all())
+        return counts
+
+
+## HIERARCHY
+# closure table for the organization hierarchy; holds a row for every
+# ancestor and descendant pair including one for each organization itself.
+# It is only maintained once enabled with `enable_organization_paths`
+organization_paths_table = Table(
+    'organization_paths',
+    meta.metadata,
+    Column('ancestor_id', types.UUID, ForeignKey('organizations.uuid'),
+           primary_key=True),
+    Column('descendant_id', types.UUID, ForeignKey('organizations.uuid'),
+           primary_key=True),
+    Column('depth', Integer, nullable=False),
+    Index('ix_organization_paths_descendant_id_depth', 'descendant_id', 'depth')
+)
+
+
+def _insert_paths(connection, org_id, parent_id):
+    paths = organization_paths_table
+    connection.execute(paths.insert().values(
+        ancestor_id=org_id, descendant_id=org_id, depth=0))
+    if parent_id is not None:
+        _attach_subtree(connection, org_id, parent_id)
+
+
+def _attach_subtree(connection, org_id, parent_id):
+    # links every ancestor of the parent (inclusive) to every descendant of
+    # the organization (inclusive)
+    paths = organization_paths_table
+    upper, lower = paths.alias('upper'), paths.alias('lower')
+    connection.execute(paths.insert().from_select(
+        ['ancestor_id', 'descendant_id', 'depth'],
+        select([upper.c.ancestor_id, lower.c.descendant_id,
+                upper.c.depth + lower.c.depth + 1])
+            .where(and_(upper.c.descendant_id == parent_id,
+                        lower.c.ancestor_id == org_id))))
+
+
+def _detach_subtree(connection, org_id):
+    # removes the links between ancestors of the organization (exclusive)
+    # and every descendant of the organization (inclusive)
+    paths = organization_paths_table
+    subtree = select([paths.c.descendant_id]).where(paths.c.ancestor_id == org_id)
+    connection.execute(paths.delete().where(and_(
+        paths.c.descendant_id.in_(subtree.alias('subtree').select()),
+        ~paths.c.ancestor_id.in_(subtree.alias('inner').select()))))
+
+
+def _is_descendant(connection, org_id, other_id):
+    paths = organization_paths_table
+    return connection.execute(
+        select([func.count()]).where(and_(paths.c.ancestor_id == org_id,
+                                          paths.c.descendant_id == other_id))
+    ).scalar() > 0
+
+
+def _organization_inserted(mapper, connection, target):
+    _insert_paths(connection, target.uuid, target.parent_id)
+
+
+def _organization_updated(mapper, connection, target):
+    state = inspect(target)
+    if not (state.attrs.parent_id.history.has_changes() or
+            state.attrs.parent.history.has_changes()):
+        return
+
+    parent_id = target.parent_id
+    if parent_id is not None and _is_descendant(connection, target.uuid, parent_id):
+        raise ValueError('Organization cannot be moved under its own subtree')
+    _detach_subtree(connection, target.uuid)
+    if parent_id is not None:
+        _attach_subtree(connection, target.uuid, parent_id)
+
+
+def _organization_deleted(mapper, connection, target):
+    paths = organization_paths_table
+    connection.execute(paths.delete().where(
+        (paths.c.ancestor_id == target.uuid) |
+        (paths.c.descendant_id == target.uuid)))
+
+
+_PATH_LISTENERS = (
+    ('after_insert', _organization_inserted),
+    ('after_update', _organization_updated),
+    ('before_delete', _organization_deleted),
+)
+
+
+def organization_paths_enabled():
+    """Indicates whether the closure table gets maintained on flush.
+    """
+    return event.contains(Organization, *_PATH_LISTENERS[0])
+
+
+def enable_organization_paths():
+    """Enables maintenance of the closure table on insert, reparent and delete
+    of organizations through the ORM, which costs extra statements per flushed
+    organization. Paths of existing organizations are not built, this is done
+    once with `rebuild_organization_paths`.
+    """
+    if not organization_paths_enabled():
+        for identifier, fn in _PATH_LISTENERS:
+            event.listen(Organization, identifier, fn, propagate=True)
+
+
+def disable_organization_paths():
+    """Disables maintenance of the closure table, which then gets out of date.
+    """
+    if organization_paths_enabled():
+        for identifier, fn in _PATH_LISTENERS:
+            event.remove(Organization, identifier, fn)
+
+
+def rebuild_organization_paths(dbsession, org_ids=None, batch_size=500,
+                               parents=None):
+    """Rebuilds the closure table from the parent references of organizations,
+    e.g. after bulk loads or updates which bypass the ORM. Where ids are given
+    only paths for subtrees of the organizations with those ids are rebuilt.
+    The parent references of all organizations are loaded unless provided as
+    `parents`, a dict mapping each organization id to its parent id. Returns
+    the number of paths written.
+    """
+    if parents is None:
+        parents = dict(dbsession.query(Organization.uuid, Organization.parent_id))
+    if org_ids is None:
+        targets = list(parents)
+    else:
+        children = {}
+        for org_id, parent_id in parents.items():
+            children.setdefault(parent_id, []).append(org_id)
+
+        targets, pending = set(), list(org_ids)
+        while pending:
+            org_id = pending.pop()
+            if org_id not in targets:
+                targets.add(org_id)
+                pending.extend(children.get(org_id, []))
+        targets = list(targets)
+
+    rows = []
+    for org_id in targets:
+        node, depth, seen = org_id, 0, set()
+        while node is not None and node not in seen:
+            seen.add(node)
+            rows.append(dict(ancestor_id=node, descendant_id=org_id, depth=depth))
+            node, depth = parents.get(node), depth + 1
+
+    paths = organization_paths_table
+    if org_ids is None:
+        dbsession.execute(paths.delete())
+    else:
+        for idx in range(0, len(targets), batch_size):
+            batch = targets[idx:idx + batch_size]
+            dbsession.execute(paths.delete().where(
+                paths.c.descendant_id.in_(batch)))
+    if rows:
+        dbsession.execute(paths.insert(), rows)
+    return len(rows)
+
+
+## RECURSIVE QUERIES
+def _not_deleted(model):
+    return or_(model.deleted == false(), model.deleted.is_(None))
+
+
+def _handled_deleted(query):
+    # deleted records are handled explicitly by the recursive queries, which
+    # must not get extra criteria from a `SoftDeleteQuery`
+    return query.execution_options(**{_query.INCLUDE_DELETED: True})
+
+
+def _recursive_query(dbsession, org_id, upwards, include_deleted, max_depth):
+    # builds the recursive cte holding (uuid, parent_id, depth) for nodes
+    # reached from the organization walking either up or down the hierarchy
+    base = dbsession.query(Organization.uuid, Organization.parent_id,
+                           literal(0).label('depth')) \
+                    .filter(Organization.uuid == org_id)
+    base = _handled_deleted(base).cte('organization_tree', recursive=True)
+
+    node = aliased(Organization, flat=True)
+    link = (node.uuid == base.c.parent_id) if upwards else \
+           (node.parent_id == base.c.uuid)
+    step = dbsession.query(node.uuid, node.parent_id, base.c.depth + 1) \
+                    .join(base, link)
+    if not include_deleted:
+        step = step.filter(_not_deleted(node))
+    if max_depth is not None:
+        step = step.filter(base.c.depth < max_depth)
+    return base.union_all(_handled_deleted(step))
+
+
+def _recursive_results(dbsession, tree, include_self, type_ids):
+    query = dbsession.query(Organization) \
+                     .join(tree, tree.c.uuid == Organization.uuid) \
+                     .options(selectinload(Organization.type),
+                              selectinload(Organization.contacts))
+    if not include_self:
+        query = query.filter(tree.c.depth > 0)
+    if type_ids is not None:
+        query = query.filter(Organization.type_id.in_(list(type_ids)))
+    return _handled_deleted(query).order_by(tree.c.depth, Organization.id)
+
+
+def organization_descendants(dbsession, org_id, type_ids=None,
+                             include_deleted=False, max_depth=None,
+                             include_self=False):
+    """Returns a query for the descendants of the organization with provided
+    id ordered by their depth relative to it, then id, fetched with a single
+    recursive statement which relies only on parent references. Descendants
+    can be limited to those with given type ids or within `max_depth`; deleted
+    organizations, along with their subtrees, are left out unless requested.
+    Types and contacts of the organizations are loaded along with them.
+    """
+    tree = _recursive_query(dbsession, org_id, False, include_deleted, max_depth)
+    return _recursive_results(dbsession, tree, include_self, type_ids)
+
+
+def organization_ancestors(dbsession, org_id, type_ids=None,
+                           include_deleted=False, max_depth=None,
+                           include_self=False):
+    """Returns a query for the ancestors of the organization with provided
+    id ordered from its parent up to the root, fetched with a single recursive
+    statement. Filters are applied as done by `organization_descendants`.
+    """
+    tree = _recursive_query(dbsession, org_id, True, include_deleted, max_depth)
+    return _recursive_results(dbsession, tree, include_self, type_ids)
@@ -0,0 +1,132 @@
+"""Provides vectorized distance and proximity computations over coordinates
+of models derived from `CoordinatesMixin` using NumPy.
+
+Computations between many points are performed in chunks such that memory
+used for intermediate distance matrices remains bounded.
+
+:hint: requires numpy which can be installed with the `geo` extra.
+"""
+import numpy as np
+from .spatial import EARTH_RADIUS_KM
+
+
+
+# maximum number of cells within intermediate distance matrices
+DEFAULT_CHUNK_CELLS = 2 ** 20
+
+
+class CoordinateSet(object):
+    """Holds ids and coordinates (in degrees) of entities as NumPy arrays.
+    """
+
+    def __init__(self, ids, lat, lng):
+        self.ids = np.asarray(ids, dtype=object)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lng = np.asarray(lng, dtype=np.float64)
+        self._radians = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def radians(self):
+        """Returns the `(lat, lng)` arrays in radians.
+        """
+        if self._radians is None:
+            self._radians = (np.radians(self.lat), np.radians(self.lng))
+        return self._radians
+
+    @classmethod
+    def load(cls, dbsession, model, id_field='uuid', query=None):
+        """Loads the id and coordinate fields of entities of model which have
+        got coordinates. A query selecting the id, latitude and longitude
+        columns in that order can be provided for extra filtering.
+        """
+        if query is None:
+            query = dbsession.query(getattr(model, id_field),
+                                    model.latitude, model.longitude)
+        query = query.filter(model.latitude.isnot(None),
+                             model.longitude.isnot(None))
+
+        ids, lat, lng = [], [], []
+        for row in query:
+            ids.append(row[0])
+            lat.append(row[1])
+            lng.append(row[2])
+        return cls(ids, lat, lng)
+
+
+def _haversine(lat1, lng1, lat2, lng2):
+    # all values in radians; arrays are broadcast against each other
+    a = np.sin((lat2 - lat1) / 2.0) ** 2 \
+      + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _chunks(sources, targets, chunk_cells):
+    size = max(1, chunk_cells // max(1, len(targets)))
+    for start in range(0, len(sources), size):
+        yield start, min(start + size, len(sources))
+
+
+def distances_from(lat, lng, targets):
+    """Returns an array of distances in kilometres from a point to targets.
+    """
+    lat2, lng2 = targets.radians
+    return _haversine(np.radians(lat), np.radians(lng), lat2, lng2)
+
+
+def distance_matrix(sources, targets):
+    """Returns the matrix of distances in kilometres between sources (rows)
+    and targets (columns). Use for moderately sized sets only as the entire
+    matrix is held in memory.
+    """
+    lat1, lng1 = sources.radians
+    lat2, lng2 = targets.radians
+    return _haversine(lat1[:, None], lng1[:, None], lat2[None, :], lng2[None, :])
+
+
+def assign_nearest(sources, targets, chunk_cells=DEFAULT_CHUNK_CELLS):
+    """Assigns each source to its nearest target and returns a list holding
+    `(source_id, target_id, distance)` for each source.
+    """
+    if not len(targets):
+        return []
+
+    lat1, lng1 = sources.radians
+    lat2, lng2 = targets.radians
+    results = []
+    for start, end in _chunks(sources, targets, chunk_cells):
+        matrix = _haversine(lat1[start:end, None], lng1[start:end, None],
+                            lat2[None, :], lng2[None, :])
+        nearest = matrix.argmin(axis=1)
+        distances = matrix[np.arange(end - start), nearest]
+        results.extend(zip(sources.ids[start:end], targets.ids[nearest],
+                           distances.tolist()))
+    return results
+
+
+def pairs_within(sources, targets, km, chunk_cells=DEFAULT_CHUNK_CELLS):
+    """Returns a list holding `(source_id, target_id, distance)` for all pairs
+    of sources and targets within `km` kilometres of each other.
+    """
+    lat1, lng1 = sources.radians
+    lat2, lng2 = targets.radians
+    results = []
+    for start, end in _chunks(sources, targets, chunk_cells):
+        matrix = _haversine(lat1[start:end, None], lng1[start:end, None],
+                            lat2[None, :], lng2[None, :])
+        rows, cols = np.nonzero(matrix <= km)
+        results.extend(zip(sources.ids[rows + start], targets.ids[cols],
+                           matrix[rows, cols].tolist()))
+    return results
+
+
+def within_radius(lat, lng, targets, km):
+    """Returns a list of `(target_id, distance)` for targets within `km`
+    kilometres of a point ordered by distance.
+    """
+    distances = distances_from(lat, lng, targets)
+    found = np.nonzero(distances <= km)[0]
+    found = found[np.argsort(distances[found], kind='stable')]
+    return list(zip(targets.ids[found], distances[found].tolist()))
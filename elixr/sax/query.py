@@ -0,0 +1,345 @@
+"""Provides query helpers which encapsulate efficient data access patterns for
+models built from the mixins defined within elixr.sax.
+"""
+import json
+import base64
+import binascii
+import uuid
+from collections import namedtuple
+from datetime import date, datetime
+from sqlalchemy import DateTime, String, and_, event, false, inspect, or_, \
+        type_coerce
+from sqlalchemy.exc import NoInspectionAvailable
+from sqlalchemy.orm import Query, joinedload, lazyload, noload, raiseload, \
+        selectinload, subqueryload
+from sqlalchemy.util import KeyedTuple
+
+
+
+## ++++++++++++++++++
+## KEYSET PAGINATION
+
+Page = namedtuple('Page', ['items', 'next_cursor', 'prev_cursor'])
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+DATE_FORMAT = '%Y-%m-%d'
+
+
+class CursorError(ValueError):
+    """Exception raised when a pagination cursor cannot be decoded or does not
+    match the ordering of the query it is used with.
+    """
+    pass
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.strftime(DATETIME_FORMAT)}
+    if isinstance(value, date):
+        return {'d': value.strftime(DATE_FORMAT)}
+    if isinstance(value, uuid.UUID):
+        return {'u': value.hex}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        if 'dt' in value:
+            return datetime.strptime(value['dt'], DATETIME_FORMAT)
+        if 'd' in value:
+            return datetime.strptime(value['d'], DATE_FORMAT).date()
+        if 'u' in value:
+            return uuid.UUID(value['u'])
+    return value
+
+
+def encode_cursor(values):
+    """Encodes the values for the ordering columns of a record into an opaque
+    url-safe cursor string.
+    """
+    data = json.dumps([_encode_value(v) for v in values], separators=(',', ':'))
+    cursor = base64.urlsafe_b64encode(data.encode('utf8'))
+    return cursor.decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, size=None):
+    """Decodes a cursor produced by `encode_cursor` back into the list of
+    values for the ordering columns. If provided, `size` is the number of
+    ordering columns the cursor is expected to hold.
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        data = base64.urlsafe_b64decode((cursor + padding).encode('ascii'))
+        values = [_decode_value(v) for v in json.loads(data.decode('utf8'))]
+    except (TypeError, ValueError, binascii.Error):
+        raise CursorError('Invalid pagination cursor: %r' % cursor)
+
+    if not isinstance(values, list) or (size and len(values) != size):
+        raise CursorError('Pagination cursor does not match query ordering')
+    return values
+
+
+def _cursor_column(column):
+    """Returns the expression for an ordering column whose values are held
+    by cursors and compared against in their stored form. Datetimes otherwise
+    may not round-trip, e.g. on SQLite values defaulted by the database lack
+    the microseconds carried by bound datetimes and never compare equal.
+    """
+    if isinstance(column.type, DateTime):
+        return type_coerce(column, String)
+    return column
+
+
+def _seek_criterion(columns, values, forward):
+    """Builds the criterion which selects records positioned after (forward)
+    or before the record whose ordering column values are provided.
+
+    The criterion is expressed as `c1 >= v1 AND (c1 > v1 OR (c1 = v1 AND ...))`
+    so that a range scan over a composite index on the columns can be used.
+    """
+    column, value = _cursor_column(columns[0]), values[0]
+    strict = (column > value) if forward else (column < value)
+    if len(columns) == 1:
+        return strict
+
+    inclusive = (column >= value) if forward else (column <= value)
+    rest = _seek_criterion(columns[1:], values[1:], forward)
+    return and_(inclusive, or_(strict, and_(column == value, rest)))
+
+
+def paginate(query, columns, limit=25, after=None, before=None,
+             descending=False):
+    """Returns a `Page` of records for the provided query using keyset (seek)
+    pagination over the ordering `columns`.
+
+    The last ordering column is expected to be unique (e.g. `id`) so that the
+    ordering is total. Use `after` with the `next_cursor` of a page to move
+    forward and `before` with the `prev_cursor` to move backward.
+    """
+    if after and before:
+        raise ValueError('Only one of after or before cursors can be provided.')
+    if limit < 1:
+        raise ValueError('limit must be a positive integer.')
+
+    # paging backward is performed by reversing the ordering and then
+    # restoring the natural ordering for the fetched records
+    forward = (before is None) != descending
+    cursor = after or before
+    if cursor:
+        values = decode_cursor(cursor, len(columns))
+        query = query.filter(_seek_criterion(columns, values, forward))
+
+    # values for cursors are selected along with records in their stored form
+    descs = query.column_descriptions
+    width, single = len(descs), (len(descs) == 1 and
+                                 descs[0]['expr'] is descs[0]['entity'])
+    keys = [_cursor_column(c).label('cursor_%s' % idx)
+            for idx, c in enumerate(columns)]
+    ordering = [(c.asc() if forward else c.desc()) for c in columns]
+    rows = query.add_columns(*keys).order_by(*ordering).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before:
+        rows.reverse()
+
+    def cursor_for(row):
+        return encode_cursor(row[width:])
+
+    def record_for(row):
+        if single:
+            return row[0]
+        return KeyedTuple(row[:width], row.keys()[:width])
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if (has_more and not before) or before:
+            next_cursor = cursor_for(rows[-1])
+        if (has_more and before) or after:
+            prev_cursor = cursor_for(rows[0])
+    return Page([record_for(r) for r in rows], next_cursor, prev_cursor)
+
+
+
+## ++++++++++++++++++++
+## SOFT-DELETE FILTERING
+
+INCLUDE_DELETED = 'include_deleted'
+
+
+def not_deleted(entity):
+    """Returns the criterion which excludes records of `entity` marked as
+    deleted. The `false()` literal is used instead of a bound parameter so the
+    criterion matches the partial indexes declared for such models.
+    """
+    return entity.deleted == false()
+
+
+def _has_deleted_field(entity):
+    try:
+        mapper = inspect(entity).mapper
+    except NoInspectionAvailable:
+        return False
+    return 'deleted' in mapper.columns
+
+
+def exclude_deleted(query):
+    """Returns the provided query with criteria which exclude records marked
+    as deleted for each of its primary entities having the deleted field.
+    """
+    for desc in query.column_descriptions:
+        entity = desc['entity']
+        if entity is not None and _has_deleted_field(entity):
+            query = query.enable_assertions(False).filter(not_deleted(entity))
+    return query
+
+
+class SoftDeleteQuery(Query):
+    """A Query which transparently excludes records marked as deleted for its
+    primary entities. It is enabled for a Session by passing it as `query_cls`
+    to the `sessionmaker`, this applies to relationship loads as well.
+
+    Use `with_deleted` as an escape hatch where deleted records are required.
+    """
+
+    def with_deleted(self):
+        """Returns a query which does not exclude records marked as deleted.
+        """
+        return self.execution_options(**{INCLUDE_DELETED: True})
+
+
+@event.listens_for(SoftDeleteQuery, 'before_compile', retval=True,
+                   bake_ok=True)
+def _exclude_deleted_on_compile(query):
+    if query._execution_options.get(INCLUDE_DELETED):
+        return query
+    # loads of instances already within the identity map, e.g. refresh of
+    # expired attributes, must find them even if marked as deleted
+    if query._refresh_state is not None or query._populate_existing:
+        return query
+    return exclude_deleted(query)
+
+
+
+## +++++++++
+## STREAMING
+
+DEFAULT_STREAM_BATCH_SIZE = 1000
+
+
+def streaming_options(model):
+    """Returns loader options which replace joined eager loading of collections
+    for the model, incompatible with `yield_per` and multiplying rows fetched,
+    with selectin loading issued once per batch of entities.
+    """
+    options = []
+    for prop in inspect(model).relationships:
+        if prop.lazy == 'joined' and prop.uselist:
+            options.append(selectinload(getattr(model, prop.key)))
+    return options
+
+
+def stream(query, batch_size=DEFAULT_STREAM_BATCH_SIZE):
+    """Iterates over results of the provided query in batches of `batch_size`
+    using a server-side cursor where supported by the database driver, so that
+    memory use is bounded by the size of a batch.
+    """
+    query = query.execution_options(stream_results=True)
+    return iter(query.yield_per(batch_size))
+
+
+## ++++++++++++++++
+## LOADING PROFILES
+
+LOADING_PROFILE = 'loading_profile'
+
+LOADER_STRATEGIES = {
+    'joined': joinedload,
+    'selectin': selectinload,
+    'subquery': subqueryload,
+    'lazy': lazyload,
+    'noload': noload,
+    'raise': raiseload,
+}
+
+# named profiles mapping relationships, either as `Model.relationship` or as
+# a bare relationship name matching any model, to a loader strategy
+_profiles = {}
+
+
+def register_profile(name, strategies):
+    """Registers a loading profile with the provided name. Strategies map
+    relationships, given as `Model.relationship` to target a model and its
+    subclasses or just the relationship name to target all models, to the
+    name of a loader strategy within `LOADER_STRATEGIES`.
+    """
+    for key, strategy in strategies.items():
+        if strategy not in LOADER_STRATEGIES:
+            raise ValueError('Unknown loader strategy for %s: %s' %
+                             (key, strategy))
+    _profiles[name] = dict(strategies)
+
+
+def get_profile(name):
+    """Returns the strategies of the loading profile with the provided name.
+    """
+    try:
+        return _profiles[name]
+    except KeyError:
+        raise ValueError('Unknown loading profile: %s' % name)
+
+
+def _profile_strategy(strategies, mapper, key):
+    for cls in mapper.class_.__mro__:
+        qualified = '%s.%s' % (cls.__name__, key)
+        if qualified in strategies:
+            return strategies[qualified]
+    return strategies.get(key)
+
+
+def profile_options(model, profile):
+    """Returns the loader options for relationships of the model as defined
+    by the loading profile provided by name.
+    """
+    strategies = get_profile(profile)
+    mapper = inspect(model).mapper
+    options = []
+    for prop in mapper.relationships:
+        strategy = _profile_strategy(strategies, mapper, prop.key)
+        if strategy is not None:
+            loader = LOADER_STRATEGIES[strategy]
+            options.append(loader(getattr(model, prop.key)))
+    return options
+
+
+def apply_profile(query, profile=None):
+    """Applies the loader options of the loading profile provided by name to
+    all entities selected by the query. Where no profile is provided the one
+    set as `LOADING_PROFILE` within the session info, if any, is applied.
+
+    :hint: the session info only provides the default profile for queries
+    passed through this function; other queries, and relationship loads they
+    trigger, use the loader strategies configured on the relationships.
+    """
+    if profile is None and query.session is not None:
+        profile = query.session.info.get(LOADING_PROFILE)
+    if profile is None:
+        return query
+
+    options = []
+    for desc in query.column_descriptions:
+        entity = desc['entity']
+        if entity is not None and desc['expr'] is entity:
+            options.extend(profile_options(entity, profile))
+    return query.options(*options) if options else query
+
+
+register_profile('joined', {
+    'Party.contacts': 'joined', 'User.roles': 'joined', 'User.emails': 'joined'
+})
+register_profile('selectin', {
+    'Party.contacts': 'selectin', 'User.roles': 'selectin',
+    'User.emails': 'selectin'
+})
+register_profile('lean', {
+    'Party.contacts': 'raise', 'User.roles': 'raise', 'User.emails': 'raise'
+})
@@ -0,0 +1,223 @@
+"""Provides an immutable in-memory snapshot of reference data, Country, State
+and OrganizationType records, which are small and read-mostly tables that get
+looked up constantly.
+"""
+import uuid
+import threading
+from collections import namedtuple
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from elixr.base._compat import string_types
+
+from .address import Country, State
+from .party import OrganizationType
+
+
+
+CountryRecord = namedtuple('CountryRecord', [
+    'id', 'uuid', 'code', 'name', 'deleted'
+])
+
+StateRecord = namedtuple('StateRecord', [
+    'id', 'uuid', 'code', 'name', 'country_id', 'country_code', 'deleted'
+])
+
+OrganizationTypeRecord = namedtuple('OrganizationTypeRecord', [
+    'id', 'uuid', 'name', 'title', 'is_root', 'deleted'
+])
+
+
+# the fields (or combination of fields) by which records are indexed
+INDEXES = {
+    Country: [('id',), ('uuid',), ('code',), ('name',)],
+    State: [('id',), ('uuid',), ('code',), ('name',), ('code', 'country_id'),
+            ('name', 'country_id'), ('code', 'country_code')],
+    OrganizationType: [('id',), ('uuid',), ('name',)],
+}
+
+UUID_FIELDS = ('uuid', 'country_id')
+
+
+def _key_value(field, value):
+    if field in UUID_FIELDS and isinstance(value, string_types):
+        try:
+            return uuid.UUID(value)
+        except ValueError:
+            return value
+    return value
+
+
+def to_entity(dbsession, model, record):
+    """Returns the persistent entity of model for a snapshot record within the
+    session without querying the database. The instance already within the
+    identity map is returned if any, otherwise one is populated from the
+    record's fields; other fields get loaded on access as usual.
+    """
+    instance = dbsession.identity_map.get(identity_key(model, record.id))
+    if instance is not None:
+        return instance
+
+    columns = model.__mapper__.columns.keys()
+    entity = model(**dict((k, v) for k, v in record._asdict().items()
+                          if k in columns))
+    make_transient_to_detached(entity)
+    return dbsession.merge(entity, load=False)
+
+
+class RefDataSnapshot(object):
+    """An immutable snapshot of reference data records indexed by their keys.
+    Keys which are not unique across records (e.g. State code across countries)
+    are left out of the index so that lookups never return an arbitrary match.
+    """
+
+    def __init__(self, countries=(), states=(), organization_types=()):
+        self._indexes = {}
+        for model, records in ((Country, countries), (State, states),
+                               (OrganizationType, organization_types)):
+            self._indexes[model] = self._build_indexes(model, records)
+
+    @staticmethod
+    def _build_indexes(model, records):
+        indexes = {}
+        for fields in INDEXES[model]:
+            index, duplicates = {}, set()
+            for record in records:
+                key = tuple(getattr(record, f) for f in fields)
+                if key in index:
+                    duplicates.add(key)
+                index[key] = record
+            for key in duplicates:
+                del index[key]
+            indexes[fields] = index
+        return indexes
+
+    @classmethod
+    def load(cls, dbsession):
+        """Creates a snapshot using the records from the database.
+        """
+        countries = [CountryRecord(*r) for r in dbsession.query(
+                        Country.id, Country.uuid, Country.code, Country.name,
+                        Country.deleted)]
+        codes = dict((c.uuid, c.code) for c in countries)
+        states = [StateRecord(r[0], r[1], r[2], r[3], r[4], codes.get(r[4]), r[5])
+                  for r in dbsession.query(
+                        State.id, State.uuid, State.code, State.name,
+                        State.country_id, State.deleted)]
+        org_types = [OrganizationTypeRecord(*r) for r in dbsession.query(
+                        OrganizationType.id, OrganizationType.uuid,
+                        OrganizationType.name, OrganizationType.title,
+                        OrganizationType.is_root, OrganizationType.deleted)]
+        return cls(countries, states, org_types)
+
+    def supports(self, model, *fields):
+        """Indicates whether records of model are indexed by provided fields.
+        """
+        indexes = self._indexes.get(model)
+        return bool(indexes) and tuple(sorted(fields)) in indexes
+
+    def find(self, model, **filters):
+        """Returns the record of model type matching all provided filters or
+        None if not found or filters are not supported.
+        """
+        fields = tuple(sorted(filters))
+        index = self._indexes.get(model, {}).get(fields)
+        if index is None:
+            return None
+        return index.get(tuple(_key_value(f, filters[f]) for f in fields))
+
+    def get(self, model, reference):
+        """Returns the record of model type having an id or uuid matching the
+        provided reference, as done by `EntityMixin.get`.
+        """
+        found = None
+        try:
+            found = self.find(model, id=int(reference))
+        except (TypeError, ValueError):
+            pass
+        return found or self.find(model, uuid=reference)
+
+    def records(self, model):
+        """Returns all records of the model type.
+        """
+        return list(self._indexes[model][('id',)].values())
+
+
+class RefDataService(object):
+    """Maintains the current snapshot of reference data. The snapshot is loaded
+    on first access and reloaded on access after changes to reference data get
+    committed, for sessions being watched. Reloads build a new snapshot which
+    then replaces the current one in a single step.
+    """
+    MODELS = (Country, State, OrganizationType)
+
+    def __init__(self, session_factory):
+        self._session_factory = session_factory
+        self._snapshot = None
+        self._stale = True
+        self._lock = threading.Lock()
+
+    @property
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None or self._stale:
+            snapshot = self.refresh()
+        return snapshot
+
+    def refresh(self):
+        """Loads a new snapshot, replaces the current one with it and returns
+        the new snapshot.
+        """
+        with self._lock:
+            self._stale = False
+            dbsession = self._session_factory()
+            try:
+                snapshot = RefDataSnapshot.load(dbsession)
+            except Exception:
+                self._stale = True
+                raise
+            finally:
+                dbsession.close()
+            self._snapshot = snapshot
+            return snapshot
+
+    def invalidate(self):
+        """Marks the current snapshot as stale so it gets reloaded on access.
+        """
+        self._stale = True
+
+    def watch(self, target=Session):
+        """Watches sessions, a Session class or sessionmaker, for committed
+        changes to reference data to invalidate the snapshot. Besides flushes,
+        this covers bulk `Query.update` and `Query.delete` calls such as
+        those issued by `soft_delete` and `restore`; changes made by other
+        statements executed directly are to be reported with `invalidate`.
+        """
+        event.listen(target, 'after_flush', self._after_flush)
+        event.listen(target, 'after_bulk_update', self._after_bulk_change)
+        event.listen(target, 'after_bulk_delete', self._after_bulk_change)
+        event.listen(target, 'after_commit', self._after_commit)
+
+    def _after_flush(self, dbsession, flush_context):
+        for obj in list(dbsession.new) + list(dbsession.dirty) \
+                 + list(dbsession.deleted):
+            if isinstance(obj, self.MODELS):
+                dbsession.info[self] = True
+                break
+
+    def _after_bulk_change(self, context):
+        if issubclass(context.mapper.class_, self.MODELS):
+            context.session.info[self] = True
+
+    def _after_commit(self, dbsession):
+        if dbsession.info.pop(self, False):
+            self.invalidate()
+
+    def supports(self, model, *fields):
+        return self.snapshot.supports(model, *fields)
+
+    def find(self, model, **filters):
+        return self.snapshot.find(model, **filters)
+
+    def get(self, model, reference):
+        return self.snapshot.get(model, reference)
@@ -0,0 +1,196 @@
+"""Provides a geohash based spatial key along with query helpers for bounding
+box, radius and k-nearest lookups on models derived from `CoordinatesMixin`.
+
+Candidates are pruned using range scans over the indexed geohash column, with
+cells covering the area of interest, before exact distance filtering.
+"""
+import math
+from sqlalchemy import and_, or_
+
+
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 9
+EARTH_RADIUS_KM = 6371.0088
+
+# the maximum number of cells used to cover an area when pruning candidates
+MAX_CELLS = 24
+
+
+def encode_geohash(lat, lng, precision=GEOHASH_PRECISION):
+    """Returns the geohash of the provided coordinates.
+    """
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        rng, coord = (lng_range, lng) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        value <<= 1
+        if coord >= mid:
+            value |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+
+        even, bits = not even, bits + 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits, value = 0, 0
+    return ''.join(chars)
+
+
+def geohash_bbox(geohash):
+    """Returns `(min_lat, min_lng, max_lat, max_lng)` for the geohash cell.
+    """
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = BASE32.index(char)
+        for shift in range(4, -1, -1):
+            rng = lng_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if (value >> shift) & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+    return (lat_range[0], lng_range[0], lat_range[1], lng_range[1])
+
+
+def cell_size(precision):
+    """Returns the `(height, width)` in degrees of cells at given precision.
+    """
+    num_bits = precision * 5
+    lng_bits = (num_bits + 1) // 2
+    lat_bits = num_bits // 2
+    return (180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits))
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Returns the great-circle distance in kilometres between two points.
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 \
+      + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_bbox(lat, lng, km):
+    """Returns the bounding box `(min_lat, min_lng, max_lat, max_lng)` which
+    covers the circle of radius `km` around the provided point. Longitudes
+    may fall outside [-180, 180] where the circle crosses the antimeridian.
+    """
+    dlat = math.degrees(km / EARTH_RADIUS_KM)
+    min_lat, max_lat = max(-90.0, lat - dlat), min(90.0, lat + dlat)
+    if min_lat <= -90.0 or max_lat >= 90.0:
+        return (min_lat, -180.0, max_lat, 180.0)
+
+    dlng = math.degrees(km / (EARTH_RADIUS_KM * math.cos(math.radians(lat))))
+    if dlng >= 180.0:
+        return (min_lat, -180.0, max_lat, 180.0)
+    return (min_lat, lng - dlng, max_lat, lng + dlng)
+
+
+def covering_cells(bbox, max_cells=MAX_CELLS):
+    """Returns the geohash cells, at the highest precision possible without
+    exceeding `max_cells`, which together cover the bounding box.
+    """
+    min_lat, min_lng, max_lat, max_lng = bbox
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        rows = int(math.floor(max_lat / height) - math.floor(min_lat / height)) + 1
+        cols = int(math.floor(max_lng / width) - math.floor(min_lng / width)) + 1
+        if rows * cols <= max_cells:
+            break
+
+    cells = set()
+    for row in range(rows):
+        lat = min(max_lat, min_lat + row * height)
+        for col in range(cols):
+            lng = min(max_lng, min_lng + col * width)
+            lng = ((lng + 180.0) % 360.0) - 180.0
+            cells.add(encode_geohash(lat, lng, precision))
+    return sorted(cells)
+
+
+def _successor(cell):
+    """Returns the smallest geohash which sorts after all geohashes having the
+    provided cell as prefix or None if there is none.
+    """
+    cell = cell.rstrip(BASE32[-1])
+    if not cell:
+        return None
+    return cell[:-1] + BASE32[BASE32.index(cell[-1]) + 1]
+
+
+def _prefix_criterion(column, cells):
+    # a prefix match is expressed as a range so an index on column is usable
+    criteria = []
+    for cell in cells:
+        upper = _successor(cell)
+        criteria.append(column >= cell if upper is None else
+                        and_(column >= cell, column < upper))
+    return or_(*criteria)
+
+
+def within_bbox(dbsession, model, bbox, query=None):
+    """Returns a query for entities of model within the bounding box given as
+    `(min_lat, min_lng, max_lat, max_lng)`.
+    """
+    min_lat, min_lng, max_lat, max_lng = bbox
+    query = query if query is not None else dbsession.query(model)
+    return query.filter(
+        _prefix_criterion(model.geohash, covering_cells(bbox)),
+        model.latitude.between(min_lat, max_lat),
+        model.longitude.between(min_lng, max_lng))
+
+
+def within_radius(dbsession, model, lat, lng, km, query=None):
+    """Returns a list of `(entity, distance)` for entities of model within
+    `km` kilometres of the provided point, ordered by distance.
+    """
+    query = query if query is not None else dbsession.query(model)
+    cells = covering_cells(radius_bbox(lat, lng, km))
+    query = query.filter(_prefix_criterion(model.geohash, cells))
+
+    found = []
+    for entity in query:
+        distance = haversine(lat, lng, entity.latitude, entity.longitude)
+        if distance <= km:
+            found.append((entity, distance))
+    found.sort(key=lambda item: item[1])
+    return found
+
+
+def nearest(dbsession, model, lat, lng, k=1, km=1.0, query=None):
+    """Returns a list of `(entity, distance)` for the `k` entities of model
+    nearest to the provided point. The search starts within `km` kilometres
+    and the radius is doubled until enough entities are found.
+    """
+    max_km = math.pi * EARTH_RADIUS_KM
+    while True:
+        found = within_radius(dbsession, model, lat, lng, km, query)
+        if len(found) >= k or km >= max_km:
+            return found[:k]
+        km = min(km * 2, max_km)
+
+
+def update_geohashes(dbsession, model, precision=GEOHASH_PRECISION):
+    """Computes and stores the geohash for entities of model which have got
+    coordinates but no geohash, e.g. after bulk loads which bypass the ORM.
+    Returns the number of entities updated.
+    """
+    query = dbsession.query(model).filter(
+        model.geohash.is_(None),
+        model.latitude.isnot(None),
+        model.longitude.isnot(None))
+
+    count = 0
+    for entity in query:
+        entity.geohash = encode_geohash(entity.latitude, entity.longitude,
+                                        precision)
+        count += 1
+    dbsession.flush()
+    return count
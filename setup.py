@@ -18,12 +18,18 @@ with open(os.path.join(here, 'CHANGES.md')) as f:
 
 requires = [
     'colander',
+    'futures; python_version < "3"',
     'sqlalchemy',
     'elixr.base==0.4'
 ]
 
+geo_requires = [
+    'numpy'
+]
+
 tests_requires = [
     'bcrypt',
+    'numpy',
     'openpyxl',
     'pytest',
     'pytest-cov'
@@ -45,6 +51,7 @@ setup(
     platforms='any',
     install_requires=requires,
     extras_require={
+        'geo': geo_requires,
         'test': tests_requires
     },
     dependency_links=[
@@ -1,5 +1,6 @@
 import os
 import pytest
+from sqlalchemy import event
 from elixr.sax import utils
 
 DIR_FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
@@ -16,6 +17,37 @@ def db():
     utils.drop_tables(resx.engine)
 
 
+class StatementCounter(object):
+    """Records statements executed through engines or connections, returning
+    for each call a list holding statements executed from then on. Recording
+    ends with `stop` or at the latest when the test ends.
+    """
+    def __init__(self):
+        self._listeners = []
+
+    def __call__(self, bind):
+        statements = []
+        def callback(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(bind, 'before_cursor_execute', callback)
+        self._listeners.append((bind, callback))
+        return statements
+
+    def stop(self):
+        for bind, callback in self._listeners:
+            event.remove(bind, 'before_cursor_execute', callback)
+        self._listeners = []
+
+
+@pytest.fixture(scope='function')
+def count_statements():
+    counter = StatementCounter()
+    yield counter
+
+    # teardown
+    counter.stop()
+
+
 @pytest.fixture(scope='module')
 def db2():
     def initdb(session):
@@ -366,3 +366,96 @@ class TestEntityUpdateAction(TestBase):
                 {'dbsession': db},
                 {'id': org.uuid, 'type_id': None, field: value}
             )
+
+
+class TestOrganizationReparentAction(TestBase):
+    def setup_method(self, method):
+        party.enable_organization_paths()
+
+    def teardown_method(self, method):
+        party.disable_organization_paths()
+
+    def _tree(self, db):
+        root_type = party.OrganizationType(name='hq', title='HQ', is_root=True)
+        branch_type = party.OrganizationType(name='branch', title='Branch')
+        root = party.Organization(code='01', name='Root', type=root_type)
+        orgs = {'01': root}
+        for code, parent in [('011', '01'), ('012', '01'), ('0111', '011'),
+                             ('0121', '012'), ('0122', '012')]:
+            orgs[code] = party.Organization(code=code, name=code,
+                                            type=branch_type, parent=orgs[parent])
+        db.add_all(orgs.values())
+        db.commit()
+        return orgs
+
+    def _move(self, db, *moves):
+        return action.organization_reparent_many({'dbsession': db}, {
+            'moves': [{'id': i, 'parent_id': p} for i, p in moves]})
+
+    def test_subtrees_moved(self, db):
+        orgs = self._tree(db)
+        moved = self._move(db, (orgs['012'].id, str(orgs['011'].uuid)),
+                               (orgs['0111'].uuid, orgs['01'].uuid))
+        db.commit()
+
+        assert moved == 2 \
+           and orgs['012'].parent_id == orgs['011'].uuid \
+           and orgs['0111'].parent is orgs['01']
+        assert party.Organization.depth(db, orgs['0122'].uuid) == 3 \
+           and [o.code for o in party.Organization.ancestors(db, orgs['0121'].uuid)] \
+            == ['012', '011', '01'] \
+           and party.Organization.subtree_counts(db, [orgs['011'].uuid]) \
+            == {orgs['011'].uuid: 3}
+
+    def test_parent_references_loaded_once(self, db, count_statements):
+        orgs = self._tree(db)
+        statements = count_statements(db.bind)
+        self._move(db, (orgs['012'].id, orgs['011'].id))
+        count_statements.stop()
+        scans = [s for s in statements if s.lstrip().startswith('SELECT')
+                 and 'organizations.parent_id' in s and 'WHERE' not in s]
+        assert len(scans) == 1
+
+    def test_cycles_detected(self, db):
+        orgs = self._tree(db)
+        with pytest.raises(logic.ValidationError):
+            self._move(db, (orgs['011'].id, orgs['012'].id),
+                           (orgs['012'].id, orgs['0111'].id))
+        assert orgs['011'].parent_id == orgs['01'].uuid
+
+    @pytest.mark.parametrize('code,parent_code,error', [
+        ('012', None, logic.ValidationError),
+        ('01', '011', logic.ValidationError),
+        ('012', 'unknown', logic.NotFoundError) ])
+    def test_invalid_moves_rejected(self, db, code, parent_code, error):
+        orgs = self._tree(db)
+        parent_id = orgs[parent_code].uuid if parent_code in orgs else parent_code
+        with pytest.raises(error):
+            self._move(db, (orgs[code].uuid, parent_id))
+
+    def test_deleted_parent_rejected(self, db):
+        orgs = self._tree(db)
+        orgs['011'].deleted = True
+        db.commit()
+        with pytest.raises(logic.ValidationError):
+            self._move(db, (orgs['012'].id, orgs['011'].id))
+
+
+class TestPersonSearchAction(TestBase):
+    def _add_people(self, db):
+        db.add_all([party.Person(name='John', last_name='Doe'),
+                    party.Person(name='Jane', last_name='Doe'),
+                    party.Person(name='Ade', last_name='Johnson')])
+        db.commit()
+
+    def test_search_returns_ranked_results(self, db):
+        self._add_people(db)
+        found = action.person_search(db, {'q': 'doe j', 'limit': '1'})
+        assert [p.name for p in found] == ['Jane']
+
+    @pytest.mark.parametrize('data_dict', [
+        {'q': ''}, {'q': 'doe', 'limit': 0}, {'q': 'doe', 'limit': 'x'},
+        {'q': 'doe', 'limit': 1000} ])
+    def test_search_fails_for_invalid_input(self, db, data_dict):
+        with pytest.raises(logic.ValidationError):
+            action.person_search(db, data_dict)
@@ -1,12 +1,15 @@
 import pytest
 from collections import namedtuple
-from sqlalchemy import Column, Integer, String
-from elixr.sax import utils
+from sqlalchemy import Column, ForeignKey, Integer, String
+from elixr.sax import types, utils
 from elixr.sax.meta import Model
 from elixr.sax.mixins import IdMixin
+from elixr.sax.party import Person
 from elixr.sax.address import (
     Country, State, Address, AddressMixin,
-    CoordinatesMixin, Coordinates
+    CoordinatesMixin, Coordinates, AddressFormatter, AddressToken,
+    address_fingerprint, dedupe_addresses, rebuild_address_tokens,
+    tokenize_address, update_address_fingerprints
 )
 
 # why? `db.rollback()`
@@ -27,6 +30,12 @@ class MockLocation(Model, IdMixin, CoordinatesMixin):
     name = Column(String(20), nullable=False)
 
 
+class MockResidence(Model, IdMixin):
+    __tablename__ = 'mock_residences'
+    name = Column(String(20), nullable=False)
+    address_id = Column(types.UUID, ForeignKey('addresses.uuid'))
+
+
 class BaseTest(object):
     _country_ng, _state_ab = (None, None)
 
@@ -267,3 +276,189 @@ class TestLocationMixinMock(BaseTest):
         mock = MockLocation(name='location')
         assert mock != None \
            and mock.coordinates == (0.0, 0.0, None, None)
+
+
+class TestAddressFormatter(object):
+    def _add_records(self, db):
+        ng = Country(code='NG', name='Nigeria')
+        abj = State(code='FC', name='Abuja', country=ng)
+        kno = State(code='KN', name='Kano', country=ng)
+        db.add_all([
+            MockAddress(name='m1', addr_street='1 Bank Road', addr_town='Bwari',
+                        postal_code='720015', addr_landmark='Post Office',
+                        addr_state=abj),
+            MockAddress(name='m2', addr_town='Kano', addr_state=kno),
+            MockAddress(name='m3', addr_raw='Somewhere'),
+            Address(raw='1 Alu Avenue', street='1 Alu Avenue', state=kno),
+        ])
+        db.commit()
+        db.expunge_all()
+
+    def test_output_identical_to_entity_output(self, db):
+        self._add_records(db)
+        mocks = db.query(MockAddress).order_by(MockAddress.id).all()
+        addresses = db.query(Address).all()
+        expected_strs = [m.address_str for m in mocks] \
+                      + [str(a) for a in addresses]
+        expected_dicts = [m.address_dict for m in mocks] \
+                       + [a.as_dict() for a in addresses]
+
+        db.expunge_all()
+        items = db.query(MockAddress).order_by(MockAddress.id).all() \
+              + db.query(Address).all()
+        formatter = AddressFormatter(db)
+        assert formatter.to_str_many(items) == expected_strs \
+           and formatter.to_dict_many(items) == expected_dicts
+
+    def test_states_resolved_in_single_query(self, db, count_statements):
+        self._add_records(db)
+        mocks = db.query(MockAddress).all()
+        statements = count_statements(db.bind)
+        values = AddressFormatter(db).to_str_many(mocks)
+        assert len(statements) == 1 \
+           and values[1] == 'Kano, Kano, Nigeria'
+
+    def test_raw_rows_can_be_formatted(self, db):
+        self._add_records(db)
+        table = MockAddress.__table__
+        rows = db.execute(table.select().order_by(table.c.id)).fetchall()
+        mapping = dict(addr_raw='X', addr_street=None, addr_town=None,
+                       addr_landmark=None, postal_code=None,
+                       addr_state_id=None)
+        values = AddressFormatter(db).to_str_many(rows + [mapping])
+        assert values[0].startswith('1 Bank Road, Bwari 720015, Abuja') \
+           and values[2:] == ['Somewhere', 'X']
+
+    def test_cached_states_not_queried(self, db, count_statements):
+        self._add_records(db)
+        mocks = db.query(MockAddress).all()
+        formatter = AddressFormatter(db)
+        formatter.to_str_many(mocks)
+        statements = count_statements(db.bind)
+        formatter.to_dict_many(mocks)
+        assert len(statements) == 0
+
+
+class TestAddressTokenIndex(object):
+    def _add_addresses(self, db):
+        utils.clear_tables(db)
+        db.add_all([
+            Address(raw='No 1 Bank Rd, Bwari', street='No 1 Bank Rd', town='Bwari'),
+            Address(raw='12 Bank Street, Garki', town='Garki'),
+            Address(raw='5 Ahmadu Bello Way, Garki', town='Garki'),
+        ])
+        db.commit()
+
+    def test_tokens_are_normalized(self):
+        assert tokenize_address('No 1 Bank Rd.', 'BWARI, bank  road') \
+            == ['no', '1', 'bank', 'road', 'bwari']
+
+    def test_search_intersects_terms(self, db):
+        self._add_addresses(db)
+        found = Address.search_address(db, 'garki BANK').all()
+        assert [a.raw for a in found] == ['12 Bank Street, Garki']
+
+    def test_search_expands_abbreviations(self, db):
+        self._add_addresses(db)
+        found = Address.search_address(db, 'bank road').all()
+        assert [a.raw for a in found] == ['No 1 Bank Rd, Bwari']
+
+    def test_index_maintained_on_update_and_delete(self, db):
+        self._add_addresses(db)
+        addr = Address.search_address(db, 'bwari').one()
+        addr.raw, addr.town = '7 Ring Road, Kubwa', 'Kubwa'
+        db.commit()
+        assert Address.search_address(db, 'bwari').count() == 0 \
+           and Address.search_address(db, 'kubwa ring').one() is addr
+
+        db.delete(addr)
+        db.commit()
+        assert db.query(AddressToken).filter_by(token='kubwa').count() == 0
+
+    def test_search_scoped_to_model(self, db):
+        self._add_addresses(db)
+        db.add(Person(name='John', last_name='Doe', addr_raw='Garki'))
+        db.commit()
+        assert Address.search_address(db, 'garki').count() == 2 \
+           and [p.name for p in Person.search_address(db, 'garki')] == ['John']
+
+    def test_index_can_be_rebuilt(self, db):
+        self._add_addresses(db)
+        db.execute(AddressToken.__table__.delete())
+        assert rebuild_address_tokens(db, Address, batch_size=2) == 3
+        db.commit()
+        assert Address.search_address(db, 'garki').count() == 2
+
+
+class TestAddressDedupe(object):
+    def _add_addresses(self, db):
+        utils.clear_tables(db)
+        ng = Country(code='NG', name='Nigeria')
+        fct = State(code='FC', name='Abuja', country=ng)
+        db.add_all([ng, fct])
+        db.flush()
+
+        addrs = [
+            Address(raw='1 Bank Rd', street='1 Bank Rd', town='Bwari', state=fct),
+            Address(raw='1 bank road', street='1 BANK ROAD', town='bwari',
+                    state_id=fct.uuid),
+            Address(raw='1 Bank Road', street='1 Bank Road', town='Bwari'),
+            Address(raw='somewhere'),
+            Address(raw='somewhere'),
+        ]
+        for addr in addrs:
+            db.add(addr)
+            db.flush()
+        db.add_all([MockResidence(name='r%s' % i, address_id=addr.uuid)
+                    for i, addr in enumerate(addrs)])
+        db.commit()
+        return addrs
+
+    def test_fingerprint_ignores_formatting(self):
+        assert address_fingerprint('1 Bank Rd.', 'Bwari', None, None) \
+            == address_fingerprint('1 BANK ROAD', ' bwari', '', None)
+        assert address_fingerprint(None, None, None, None) is None
+
+    def test_fingerprint_maintained(self, db):
+        addrs = self._add_addresses(db)
+        assert addrs[0].fingerprint == addrs[1].fingerprint \
+           and addrs[0].fingerprint != addrs[2].fingerprint \
+           and addrs[3].fingerprint is None
+
+        addrs[2].state_id = addrs[0].state_id
+        db.commit()
+        assert addrs[2].fingerprint == addrs[0].fingerprint
+
+    def test_duplicates_merged(self, db):
+        addrs = self._add_addresses(db)
+        assert dedupe_addresses(db) == 1
+
+        db.expire_all()
+        refs = dict(db.query(MockResidence.name, MockResidence.address_id))
+        assert refs['r0'] == refs['r1'] == addrs[0].uuid \
+           and refs['r2'] == addrs[2].uuid \
+           and addrs[1].deleted and not addrs[0].deleted \
+           and not addrs[3].deleted and not addrs[4].deleted
+        assert dedupe_addresses(db) == 0
+
+    def _clear_fingerprints(self, db):
+        table = Address.__table__
+        db.execute(table.update().values(fingerprint=None))
+        db.commit()
+        db.expire_all()
+
+    def test_missing_fingerprints_backfilled(self, db):
+        addrs = self._add_addresses(db)
+        expected = [a.fingerprint for a in addrs]
+        self._clear_fingerprints(db)
+        assert update_address_fingerprints(db, batch_size=2) == 3
+        db.commit()
+        db.expire_all()
+        assert [a.fingerprint for a in addrs] == expected
+
+    def test_duplicates_without_fingerprints_merged(self, db):
+        addrs = self._add_addresses(db)
+        self._clear_fingerprints(db)
+        assert dedupe_addresses(db) == 1
+        db.expire_all()
+        assert addrs[1].deleted and not addrs[0].deleted
@@ -0,0 +1,142 @@
+import pytest
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from elixr.sax import utils
+from elixr.sax.address import Country, State
+from elixr.sax.party import (
+    EmailContact, Organization, OrganizationType, Party, Person
+)
+from elixr.sax.archive import archive_table, purge_deleted
+
+
+
+class TestBase(object):
+    def _clear_tables(self, db, *table_names):
+        utils.clear_tables(db, *table_names)
+
+    def _backdate(self, db, model, days=40):
+        table = model.__table__
+        past = datetime.utcnow() - timedelta(days=days)
+        db.execute(table.update().values(last_updated=past))
+        db.commit()
+
+    def _archived(self, db, model):
+        table = archive_table(model.__table__)
+        return db.execute(select([table])).fetchall()
+
+
+class TestBulkSoftDelete(TestBase):
+    def test_can_soft_delete_many(self, db):
+        self._clear_tables(db)
+        countries = [Country(code='C%s' % i, name='C%s' % i) for i in range(5)]
+        db.add_all(countries)
+        db.commit()
+
+        count = Country.soft_delete(db, [c.uuid for c in countries[:3]],
+                                    batch_size=2)
+        db.commit()
+        assert count == 3 \
+           and [c.deleted for c in countries] == [True] * 3 + [False] * 2 \
+           and countries[0].last_updated is not None
+
+    def test_soft_delete_skips_already_deleted(self, db):
+        self._clear_tables(db)
+        country = Country(code='NG', name='Nigeria', deleted=True)
+        db.add(country)
+        db.commit()
+        assert Country.soft_delete(db, [country.uuid]) == 0
+
+    def test_can_restore_many(self, db):
+        self._clear_tables(db)
+        countries = [Country(code='C%s' % i, name='C%s' % i, deleted=True)
+                     for i in range(3)]
+        db.add_all(countries)
+        db.commit()
+
+        count = Country.restore(db, [str(c.uuid) for c in countries])
+        db.commit()
+        assert count == 3 and not any(c.deleted for c in countries)
+
+    def test_soft_delete_restricted_to_polymorphic_identity(self, db):
+        self._clear_tables(db)
+        org_type = OrganizationType(name='hq', title='HQ', is_root=True)
+        org = Organization(name='Org', code='ORG', type=org_type)
+        person = Person(name='John')
+        db.add_all([org, person])
+        db.commit()
+
+        count = Person.soft_delete(db, [org.uuid, person.uuid])
+        db.commit()
+        assert count == 1 and person.deleted and not org.deleted
+
+
+class TestPurgeDeleted(TestBase):
+    def test_records_deleted_recently_not_purged(self, db):
+        self._clear_tables(db)
+        country = Country(code='NG', name='Nigeria')
+        db.add(country)
+        db.commit()
+        Country.soft_delete(db, [country.uuid])
+        db.commit()
+
+        results = purge_deleted(db, days=30)
+        assert results['countries'] == 0 \
+           and db.query(Country).count() == 1
+
+    def test_records_deleted_long_ago_moved_in_batches(self, db):
+        self._clear_tables(db)
+        countries = [Country(code='C%s' % i, name='C%s' % i) for i in range(5)]
+        db.add_all(countries)
+        db.commit()
+        Country.soft_delete(db, [c.uuid for c in countries[:4]])
+        self._backdate(db, Country)
+
+        results = purge_deleted(db, days=30, batch_size=3)
+        archived = self._archived(db, Country)
+        assert results['countries'] == 4 \
+           and db.query(Country).count() == 1 \
+           and len(archived) == 4 \
+           and all(r.date_archived is not None for r in archived)
+
+    def test_records_referenced_by_live_rows_not_purged(self, db):
+        self._clear_tables(db)
+        country = Country(code='NG', name='Nigeria', deleted=True)
+        country.states.append(State(code='KN', name='Kano'))
+        db.add(country)
+        db.commit()
+        self._backdate(db, Country)
+
+        results = purge_deleted(db, days=30)
+        assert results['countries'] == 0 \
+           and db.query(Country).count() == 1
+
+    def test_children_purged_before_parents(self, db):
+        self._clear_tables(db)
+        country = Country(code='NG', name='Nigeria', deleted=True)
+        country.states.append(State(code='KN', name='Kano', deleted=True))
+        db.add(country)
+        db.commit()
+        self._backdate(db, Country)
+        self._backdate(db, State)
+
+        results = purge_deleted(db, days=30)
+        assert results['states'] == 1 and results['countries'] == 1 \
+           and db.query(Country).count() == 0
+
+    def test_attached_rows_moved_along(self, db):
+        self._clear_tables(db)
+        person = Person(name='John', deleted=True)
+        person.contacts.append(EmailContact(address='john@doe.ea'))
+        db.add(person)
+        db.commit()
+        db.expunge_all()
+        self._backdate(db, Party)
+
+        results = purge_deleted(db, days=30, table_names=['parties'])
+        links = archive_table(Party.metadata.tables['parties_contact_details'])
+        assert results['parties'] == 1 \
+           and db.query(Person).count() == 0 \
+           and len(self._archived(db, Party)) == 1 \
+           and len(self._archived(db, Person)) == 1 \
+           and len(db.execute(select([links])).fetchall()) == 1 \
+           and db.query(EmailContact).count() == 1
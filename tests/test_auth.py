@@ -1,10 +1,12 @@
+import bcrypt
 import pytest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from elixr.sax import utils
 from elixr.sax.meta import Model
 from elixr.sax.auth import (
-    _hash_password,
-    User, Role, AuthEmail, Authenticator
+    _hash_password, _hash_rounds, calibrate_rounds, models,
+    User, Role, AuthEmail, Authenticator, hash_passwords, provision_users
 )
 
 
@@ -197,3 +199,230 @@ class TestAuthenticator(TestBase):
         authn = Authenticator(db2)
         user = authn('scott', 'tiger')
         assert user != None and user.id != None
+
+    def test_authn_with_thread_pool_executor(self, db2):
+        with ThreadPoolExecutor(2) as executor:
+            authn = Authenticator(db2, executor=executor)
+            user = authn.authenticate('scott', 'tiger')
+            assert user != None and user.username == 'scott' \
+               and authn.authenticate('scott', 'lion') == None
+
+    def test_authn_with_process_pool_executor(self, db2):
+        with ProcessPoolExecutor(1) as executor:
+            authn = Authenticator(db2, executor=executor)
+            assert authn.authenticate('scott', 'tiger') != None \
+               and authn.authenticate('scott', 'lion') == None
+
+    @pytest.mark.parametrize("use_executor", [False, True])
+    def test_authn_future_resolves_to_user(self, db2, use_executor):
+        with ThreadPoolExecutor(2) as executor:
+            authn = Authenticator(db2, executor=executor if use_executor else None)
+            passed = authn.authenticate_future('scott', 'tiger')
+            failed = authn.authenticate_future('scott', 'lion')
+            missing = authn.authenticate_future('allen', 'skit')
+            assert passed.result()[0].username == 'scott' \
+               and passed.result()[1] == None \
+               and failed.result() == None and missing.result() == None
+
+    @pytest.mark.parametrize("use_executor", [False, True])
+    def test_authn_async_resolves_to_user(self, db2, use_executor):
+        asyncio = pytest.importorskip('asyncio')
+        loop = asyncio.new_event_loop()
+        try:
+            with ThreadPoolExecutor(2) as executor:
+                authn = Authenticator(db2, accept_email_as_username=True,
+                                      executor=executor if use_executor else None)
+                users = loop.run_until_complete(asyncio.gather(
+                    authn.authenticate_async('scott@tiger.ora', 'tiger', loop=loop),
+                    authn.authenticate_async('scott', 'lion', loop=loop),
+                    authn.authenticate_async('mike@lion.ora', 'lion', loop=loop)))
+        finally:
+            loop.close()
+        assert users[0].username == 'scott' and users[1:] == [None, None]
+
+    @pytest.mark.parametrize("username", ['scott', 'scott@tiger.ora'])
+    def test_authn_failure_issues_single_narrow_query(self, db2, username,
+                                                     count_statements):
+        db2.expunge_all()
+        authn = Authenticator(db2, accept_email_as_username=True)
+        statements = count_statements(db2.bind)
+        user = authn.authenticate(username, 'lion')
+        count_statements.stop()
+        assert user == None and len(statements) == 1 \
+           and 'first_name' not in statements[0] \
+           and 'auth_users_roles' not in statements[0]
+
+    def test_authn_loads_user_after_password_verified(self, db2,
+                                                      count_statements):
+        db2.expunge_all()
+        authn = Authenticator(db2, accept_email_as_username=True)
+        statements = count_statements(db2.bind)
+        user = authn.authenticate('scott@tiger.ora', 'tiger')
+        count_statements.stop()
+        assert user.username == 'scott' and 'first_name' in statements[1] \
+           and not any('first_name' in s for s in statements[:1])
+
+    def test_authn_prefers_username_over_email_match(self, db2):
+        user = User(username='mike@lion.ora', is_active=True)
+        user.set_password('cub')
+        db2.add(user)
+        db2.commit()
+        try:
+            authn = Authenticator(db2, accept_email_as_username=True)
+            assert authn.authenticate('mike@lion.ora', 'cub') is user \
+               and authn.authenticate('mike@lion.ora', 'lion') == None
+        finally:
+            db2.delete(user)
+            db2.commit()
+
+    @pytest.mark.parametrize("username", ['scott', 'scott@tiger.ora'])
+    def test_credentials_lookup_searches_indexes(self, db2, username):
+        authn = Authenticator(db2, accept_email_as_username=True)
+        query = authn._credentials_query(username)
+        sql = str(query.statement.compile(db2.bind,
+                                          compile_kwargs={'literal_binds': True}))
+        plan = [row[-1] for row in db2.execute('EXPLAIN QUERY PLAN ' + sql)]
+        assert plan and not any(p.startswith('SCAN') for p in plan) \
+           and any('auth_users' in p and 'USING' in p for p in plan)
+
+
+class TestProvisioning(TestBase):
+    def _records(self, count=3):
+        return [{
+            'username': 'user%s' % i, 'password': 'secret%s' % i,
+            'first_name': 'First%s' % i, 'is_active': True,
+            'roles': ['member'] + (['admin'] if i == 0 else []),
+            'emails': ['user%s@tiger.ora' % i,
+                       {'address': 'alt%s@tiger.ora' % i, 'is_preferred': True}]
+        } for i in range(count)]
+
+    def test_hash_passwords(self):
+        hashes = hash_passwords(['tiger', None, 'lion'], processes=2)
+        assert hashes[1] == None \
+           and bcrypt.checkpw(b'tiger', hashes[0].encode('utf8')) \
+           and bcrypt.checkpw(b'lion', hashes[2].encode('utf8'))
+
+    @pytest.mark.parametrize("processes", [1, 2])
+    def test_users_provisioned(self, db, processes):
+        self._clear_tables(db)
+        db.add_all([Role(name='member'), Role(name='admin')])
+        db.commit()
+
+        ids = provision_users(db, self._records(), processes=processes,
+                              batch_size=2)
+        db.commit()
+        users = db.query(User).order_by(User.username).all()
+        assert [u.uuid for u in users] == ids \
+           and users[0].is_admin and not users[1].is_admin \
+           and [r.name for r in users[1].roles] == ['member'] \
+           and users[2].preferred_email.address == 'alt2@tiger.ora' \
+           and users[2].first_name == 'First2' \
+           and all(u.date_joined and u.id for u in users)
+        assert Authenticator(db).authenticate('user1', 'secret1') is users[1]
+
+    def test_date_joined_left_to_column_default(self, db):
+        self._clear_tables(db)
+        provision_users(db, [{'username': 'scott'}])
+        db.commit()
+        user = db.query(User).filter_by(username='scott').one()
+        assert user.date_joined == user.date_created
+
+    def test_provisioning_fails_for_unknown_roles(self, db):
+        self._clear_tables(db)
+        db.add(Role(name='member'))
+        db.commit()
+        with pytest.raises(ValueError):
+            provision_users(db, self._records(), processes=1)
+        assert db.query(User).count() == 0
+
+    def test_provisioning_fails_for_duplicate_usernames(self, db):
+        self._clear_tables(db)
+        with pytest.raises(ValueError):
+            provision_users(db, [{'username': 'scott'}, {'username': 'scott'}])
+
+
+class TestPasswordRehash(TestBase):
+    def _add_user(self, db, rounds):
+        self._clear_tables(db)
+        user = User(username='scott', is_active=True,
+                    password=_hash_password('tiger', rounds))
+        db.add(user)
+        db.commit()
+        db.expunge_all()
+
+    def test_calibrate_rounds(self):
+        assert calibrate_rounds(0.0, min_rounds=4, max_rounds=6) == 4
+        assert calibrate_rounds(10.0, min_rounds=4, max_rounds=6) == 6
+
+    def test_hash_rounds(self):
+        assert _hash_rounds(_hash_password('tiger', 5)) == 5 \
+           and _hash_rounds('plain') == None
+
+    @pytest.mark.parametrize("use_executor", [False, True])
+    def test_outdated_hash_rehashed_on_login(self, db, monkeypatch, use_executor,
+                                             count_statements):
+        self._add_user(db, 4)
+        monkeypatch.setattr(models, 'BCRYPT_ROUNDS', 5)
+        with ThreadPoolExecutor(1) as executor:
+            authn = Authenticator(db, executor=executor if use_executor else None)
+            statements = count_statements(db.bind)
+            user = authn.authenticate('scott', 'tiger')
+            count_statements.stop()
+        assert not any(s.startswith('UPDATE') for s in statements) \
+           and user in db.dirty \
+           and _hash_rounds(user.password) == 5
+
+        db.commit()
+        db.expunge_all()
+        assert Authenticator(db).authenticate('scott', 'tiger') != None
+
+    def test_authn_future_leaves_rehash_to_calling_thread(self, db, monkeypatch):
+        self._add_user(db, 4)
+        monkeypatch.setattr(models, 'BCRYPT_ROUNDS', 5)
+        with ThreadPoolExecutor(1) as executor:
+            authn = Authenticator(db, executor=executor)
+            user, new_hash = authn.authenticate_future('scott', 'tiger').result()
+        assert user not in db.dirty and _hash_rounds(new_hash) == 5
+
+        assert authn.apply_hash(user, new_hash) is user \
+           and user in db.dirty and user.password == new_hash
+
+    def test_authn_async_defaults_to_running_loop(self, db):
+        asyncio = pytest.importorskip('asyncio')
+        self._add_user(db, 5)
+        authn = Authenticator(db)
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.create_future()
+            def login():
+                future = authn.authenticate_async('scott', 'tiger')
+                future.add_done_callback(lambda f: result.set_result(f.result()))
+            loop.call_soon(login)
+            user = loop.run_until_complete(result)
+        finally:
+            loop.close()
+        assert user.username == 'scott'
+
+    def test_current_hash_left_unchanged(self, db, monkeypatch):
+        self._add_user(db, 5)
+        monkeypatch.setattr(models, 'BCRYPT_ROUNDS', 5)
+        user = Authenticator(db).authenticate('scott', 'tiger')
+        assert user not in db.dirty and _hash_rounds(user.password) == 5
+
+    def test_rehash_can_be_disabled(self, db, monkeypatch):
+        self._add_user(db, 4)
+        monkeypatch.setattr(models, 'BCRYPT_ROUNDS', 5)
+        user = Authenticator(db, rehash=False).authenticate('scott', 'tiger')
+        assert user not in db.dirty and _hash_rounds(user.password) == 4
+
+    def test_rehash_on_async_login(self, db, monkeypatch):
+        asyncio = pytest.importorskip('asyncio')
+        self._add_user(db, 4)
+        monkeypatch.setattr(models, 'BCRYPT_ROUNDS', 5)
+        loop = asyncio.new_event_loop()
+        try:
+            user = loop.run_until_complete(
+                Authenticator(db).authenticate_async('scott', 'tiger', loop=loop))
+        finally:
+            loop.close()
+        assert user in db.dirty and _hash_rounds(user.password) == 5
@@ -0,0 +1,128 @@
+import json
+import pytest
+from elixr.sax import utils
+from elixr.sax.address import Country, State
+from elixr.sax.party import Organization, OrganizationType
+from elixr.sax.boundaries import (
+    BoundaryIndex, StateLocator, assign_states, validate_states
+)
+
+
+def _square(min_lng, min_lat, max_lng, max_lat):
+    return [[min_lng, min_lat], [max_lng, min_lat], [max_lng, max_lat],
+            [min_lng, max_lat], [min_lng, min_lat]]
+
+
+GEOJSON = {
+    'type': 'FeatureCollection',
+    'features': [{
+        'type': 'Feature',
+        'properties': {'name': 'Kano', 'code': 'KN'},
+        'geometry': {
+            'type': 'Polygon',
+            'coordinates': [_square(7.5, 11.0, 9.5, 13.0)]
+        }
+    }, {
+        'type': 'Feature',
+        'properties': {'name': 'Lagos', 'code': 'LA'},
+        'geometry': {
+            'type': 'MultiPolygon',
+            'coordinates': [
+                [_square(2.5, 6.0, 4.5, 7.0), _square(3.0, 6.2, 3.2, 6.4)],
+                [_square(5.0, 5.0, 5.5, 5.5)]
+            ]
+        }
+    }]
+}
+
+
+@pytest.fixture(scope='module')
+def geojson_path(tmpdir_factory):
+    path = tmpdir_factory.mktemp('boundaries').join('states.geojson')
+    path.write(json.dumps(GEOJSON))
+    return str(path)
+
+
+class TestBoundaryIndex(object):
+    def test_locate_within_polygon(self, geojson_path):
+        index = BoundaryIndex.from_geojson(geojson_path)
+        assert index.locate(12.0022, 8.5920) == 'Kano' \
+           and index.locate(6.5244, 3.3792) == 'Lagos'
+
+    def test_locate_within_multipolygon_part(self, geojson_path):
+        index = BoundaryIndex.from_geojson(geojson_path)
+        assert index.locate(5.25, 5.25) == 'Lagos'
+
+    def test_locate_excludes_holes_and_outside(self, geojson_path):
+        index = BoundaryIndex.from_geojson(geojson_path)
+        assert index.locate(6.3, 3.1) is None \
+           and index.locate(9.0765, 7.3986) is None
+
+    def test_key_property_can_be_changed(self, geojson_path):
+        with open(geojson_path) as f:
+            index = BoundaryIndex.from_geojson(f, key_property='code',
+                                               cell_size=0.1)
+        assert index.keys == set(['KN', 'LA']) \
+           and index.locate(12.0022, 8.5920) == 'KN'
+
+
+class TestStateAssignment(object):
+    def _setup(self, db):
+        utils.clear_tables(db)
+        ng = Country(code='NG', name='Nigeria')
+        kano = State(code='KN', name='Kano', country=ng)
+        lagos = State(code='LA', name='Lagos', country=ng)
+        otype = OrganizationType(name='branch', title='Branch')
+        db.add_all([ng, kano, lagos, otype])
+        db.flush()
+
+        def org(code, lat, lng, state=None):
+            return Organization(code=code, name=code, type_id=otype.uuid,
+                                latitude=lat, longitude=lng,
+                                addr_state_id=state.uuid if state else None)
+
+        db.add_all([
+            org('kn-1', 12.0022, 8.5920),
+            org('kn-2', 11.5, 8.0, lagos),          # wrong state
+            org('la-1', 6.5244, 3.3792, lagos),
+            org('la-2', 6.6, 4.0),
+            org('abj', 9.0765, 7.3986),             # outside boundaries
+            org('none', None, None),
+        ])
+        db.commit()
+        return kano, lagos
+
+    def _states(self, db):
+        return dict(db.query(Organization.code, Organization.addr_state_id))
+
+    def _locator(self, db, path):
+        index = BoundaryIndex.from_geojson(path, key_property='code')
+        return StateLocator.create(db, index, key_field='code',
+                                   country_code='NG')
+
+    def test_assign_missing_states(self, db, geojson_path):
+        kano, lagos = self._setup(db)
+        locator = self._locator(db, geojson_path)
+
+        assert assign_states(db, Organization, locator) == 2
+        db.commit()
+        states = self._states(db)
+        assert states['kn-1'] == kano.uuid and states['la-2'] == lagos.uuid \
+           and states['kn-2'] == lagos.uuid and states['abj'] is None
+
+    def test_assign_overwrites_wrong_states(self, db, geojson_path):
+        kano, lagos = self._setup(db)
+        locator = self._locator(db, geojson_path)
+
+        assert assign_states(db, Organization, locator, overwrite=True,
+                             batch_size=1) == 3
+        db.commit()
+        assert self._states(db)['kn-2'] == kano.uuid
+
+    def test_validate_states(self, db, geojson_path):
+        kano, lagos = self._setup(db)
+        locator = self._locator(db, geojson_path)
+
+        found = validate_states(db, Organization, locator)
+        assert set((c, l) for _, c, l in found) == set([
+            (None, kano.uuid), (lagos.uuid, kano.uuid), (None, lagos.uuid)])
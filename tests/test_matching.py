@@ -0,0 +1,93 @@
+import pytest
+from datetime import date
+from elixr.sax import utils
+from elixr.sax.address import Country, State
+from elixr.sax.party import Gender, Person
+from elixr.sax.matching import (
+    PersonRecord, build_blocks, default_similarity, duplicate_candidates,
+    find_duplicate_people, soundex
+)
+
+
+def _record(name, last_name, date_born=None, state=None, gender=None, **kwargs):
+    return PersonRecord(kwargs.get('uuid'), name, kwargs.get('middle_name'),
+                        last_name, gender, date_born, state)
+
+
+def _first_initial_similarity(a, b):
+    return 1.0 if a.name[0] == b.name[0] else 0.0
+
+
+class TestBlocking(object):
+    @pytest.mark.parametrize('value,code', [
+        ('Robert', 'R163'), ('Rupert', 'R163'), ('Ashcraft', 'A261'),
+        ('Tymczak', 'T522'), ('Pfister', 'P236'), ('Olú', 'O400'),
+        ('', '') ])
+    def test_soundex(self, value, code):
+        assert soundex(value) == code
+
+    def test_blocks_group_by_key(self):
+        records = [
+            _record('John', 'Smith', date(1980, 1, 1), 1),
+            _record('Jon', 'Smyth', date(1980, 6, 1), 1),
+            _record('John', 'Smith', date(1981, 1, 1), 1),
+            _record('John', 'Smith', date(1980, 1, 1), 2),
+            _record('John', None),
+        ]
+        blocks = build_blocks(records)
+        assert len(blocks) == 1 and len(blocks[0]) == 2
+
+    def test_large_blocks_split_by_first_name(self):
+        records = [_record(name, 'Smith') for name in
+                   ['John', 'Jon', 'Mary', 'Marie', 'Ade']]
+        blocks = build_blocks(records, max_block_size=3)
+        assert sorted(len(b) for b in blocks) == [2, 2]
+
+    def test_default_similarity(self):
+        a = _record('John', 'Smith', date(1980, 1, 1), gender=Gender.MALE)
+        b = _record('Jon', 'Smyth', date(1980, 1, 1), gender=Gender.MALE)
+        c = _record('Jon', 'Smyth', date(1980, 1, 1), gender=Gender.FEMALE)
+        assert default_similarity(a, a) == 1.0 \
+           and 0.85 < default_similarity(a, b) < 1.0 \
+           and default_similarity(a, c) < 0.5
+
+
+class TestFindDuplicates(object):
+    def _add_people(self, db):
+        utils.clear_tables(db)
+        ng = Country(code='NG', name='Nigeria')
+        kano = State(code='KN', name='Kano', country=ng)
+        db.add_all([ng, kano])
+        db.flush()
+        people = [
+            Person(name='John', last_name='Smith', date_born=date(1980, 1, 1),
+                   state_origin_id=kano.uuid),
+            Person(name='Jon', last_name='Smyth', date_born=date(1980, 1, 1),
+                   state_origin_id=kano.uuid),
+            Person(name='Mary', last_name='Smith', date_born=date(1980, 3, 1),
+                   state_origin_id=kano.uuid),
+            Person(name='Jane', last_name='Doe', date_born=date(1990, 3, 1)),
+            Person(name='Jayne', last_name='Doe', date_born=date(1990, 3, 1)),
+        ]
+        db.add_all(people)
+        db.commit()
+        return people
+
+    def test_candidates_ranked(self, db):
+        people = self._add_people(db)
+        pairs = find_duplicate_people(db, processes=1)
+        db.commit()
+
+        assert [sorted([p, c]) for _, p, c in pairs] == [
+            sorted([people[3].uuid, people[4].uuid]),
+            sorted([people[0].uuid, people[1].uuid])]
+        found = duplicate_candidates(db).all()
+        assert [round(s, 6) for s, _, _ in found] == [round(s, 6) for s, _, _ in pairs] \
+           and set([found[0][1].name, found[0][2].name]) == set(['Jane', 'Jayne'])
+
+    def test_similarity_and_threshold_configurable(self, db):
+        people = self._add_people(db)
+        pairs = find_duplicate_people(db, similarity=_first_initial_similarity,
+                                      threshold=1.0, processes=2)
+        assert len(pairs) == 2 \
+           and duplicate_candidates(db, limit=1).count() == 1
@@ -0,0 +1,108 @@
+from sqlalchemy.orm import sessionmaker
+from elixr.sax import utils
+from elixr.sax.party import Organization, OrganizationType
+from elixr.sax.export.importer import XRefResolver
+from elixr.sax.orgindex import OrganizationIndexService, OrganizationPrefixIndex
+
+
+
+class TestBase(object):
+    def _add_organizations(self, db):
+        utils.clear_tables(db)
+        org_type = OrganizationType(name='branch', title='Branch')
+        orgs = [
+            Organization(code='KN-001', short_name='Kano', name='Kano Office',
+                         type=org_type),
+            Organization(code='KN-002', short_name='Kaduna', name='Kaduna Office',
+                         type=org_type),
+            Organization(code='LA-001', short_name='kat', name='Katsina Office',
+                         type=org_type),
+            Organization(code='AB-001', name='Abuja Office', type=org_type),
+        ]
+        db.add_all(orgs)
+        db.commit()
+        return orgs
+
+
+class TestOrganizationPrefixIndex(TestBase):
+    def test_complete_by_field(self, db):
+        self._add_organizations(db)
+        index = OrganizationPrefixIndex.load(db)
+        assert len(index) == 4 \
+           and [r.code for r in index.complete('kn-', 'code')] \
+               == ['KN-001', 'KN-002'] \
+           and [r.short_name for r in index.complete('KA', 'short_name')] \
+               == ['Kaduna', 'Kano', 'kat'] \
+           and index.complete('x') == []
+
+    def test_complete_across_fields(self, db):
+        self._add_organizations(db)
+        index = OrganizationPrefixIndex.load(db)
+        assert [r.code for r in index.complete('k')] \
+            == ['KN-002', 'KN-001', 'LA-001'] \
+           and [r.code for r in index.complete('k', limit=2)] \
+               == ['KN-002', 'KN-001']
+
+    def test_find_is_exact(self, db):
+        orgs = self._add_organizations(db)
+        index = OrganizationPrefixIndex.load(db)
+        assert index.find(Organization, short_name='Kano').uuid == orgs[0].uuid \
+           and index.find(Organization, code='AB-001').uuid == orgs[3].uuid \
+           and index.find(Organization, short_name='kano') is None \
+           and index.find(Organization, short_name='Kan') is None \
+           and index.find(Organization, name='Kano Office') is None \
+           and index.find(OrganizationType, name='branch') is None
+
+    def test_deleted_organizations_left_out(self, db):
+        orgs = self._add_organizations(db)
+        orgs[0].deleted = True
+        db.commit()
+        index = OrganizationPrefixIndex.load(db)
+        assert [r.code for r in index.complete('kn-')] == ['KN-002'] \
+           and index.find(Organization, code='KN-001') is None
+
+    def test_updated_reloads_changed_organizations(self, db):
+        orgs = self._add_organizations(db)
+        index = OrganizationPrefixIndex.load(db)
+        orgs[0].short_name = 'Kumbotso'
+        orgs[1].deleted = True
+        db.commit()
+
+        updated = index.updated(db, [orgs[0].uuid, orgs[1].uuid])
+        assert [r.short_name for r in updated.complete('ka', 'short_name')] \
+            == ['kat'] \
+           and updated.find(Organization, short_name='Kumbotso').uuid \
+               == orgs[0].uuid \
+           and index.find(Organization, short_name='Kano') is not None
+
+
+class TestOrganizationIndexService(TestBase):
+    def _service(self, db):
+        service = OrganizationIndexService(sessionmaker(bind=db.bind))
+        service.watch(db)
+        return service
+
+    def test_index_updated_after_commit(self, db):
+        orgs = self._add_organizations(db)
+        service = self._service(db)
+        index = service.index
+        db.add(Organization(code='KN-003', name='Kano Annex',
+                            type_id=orgs[0].type_id))
+        db.flush()
+        assert service.index is index
+
+        db.commit()
+        assert service.index is not index \
+           and [r.code for r in service.complete('kn-')] \
+               == ['KN-001', 'KN-002', 'KN-003']
+
+    def test_xref_resolver_consults_index(self, db, count_statements):
+        orgs = self._add_organizations(db)
+        service = self._service(db)
+        service.index
+        resolver = XRefResolver(db, org_index=service)
+
+        statements = count_statements(db.bind)
+        parent_id = resolver.resolve(Organization, short_name='Kaduna')
+        count_statements.stop()
+        assert parent_id == orgs[1].uuid and len(statements) == 0
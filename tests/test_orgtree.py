@@ -0,0 +1,132 @@
+import json
+from sqlalchemy.orm import sessionmaker
+from elixr.sax import utils
+from elixr.sax.party import Organization, OrganizationType
+from elixr.sax.orgtree import OrganizationTree, OrganizationTreeService
+
+
+
+class TestBase(object):
+    def _tree(self, db):
+        utils.clear_tables(db)
+        hq = OrganizationType(name='hq', title='Headquarters', is_root=True)
+        branch = OrganizationType(name='branch', title='Branch')
+        root = Organization(code='01', name='Root', type=hq)
+        child1 = Organization(code='011', name='Child1', parent=root, type=branch)
+        child2 = Organization(code='012', name='Child2', parent=root, type=hq)
+        gc1 = Organization(code='0111', name='GrandChild1', parent=child1, type=branch)
+        gc2 = Organization(code='0121', name='GrandChild2', parent=child2, type=branch)
+        db.add_all([gc1, gc2])
+        db.commit()
+        return (hq, branch), (root, child1, child2, gc1, gc2)
+
+
+class TestOrganizationTree(TestBase):
+    def test_load_uses_single_query(self, db, count_statements):
+        self._tree(db)
+        statements = count_statements(db.bind)
+        tree = OrganizationTree.load(db)
+        count_statements.stop()
+        assert len(tree) == 5 and len(statements) == 1
+
+    def test_layout_and_aggregates(self, db):
+        (hq, branch), (root, child1, child2, gc1, gc2) = self._tree(db)
+        tree = OrganizationTree.load(db)
+        assert [r.code for r in tree.roots()] == ['01'] \
+           and [r.code for r in tree.children(root.uuid)] == ['011', '012'] \
+           and [r.code for r in tree.descendants(root.uuid)] \
+               == ['011', '0111', '012', '0121']
+        assert tree.descendant_count(root.uuid) == 4 \
+           and tree.descendant_count(child2.uuid) == 1 \
+           and tree.descendant_count(gc1.uuid) == 0
+        assert tree.type_counts(root.uuid) == {hq.uuid: 1, branch.uuid: 3} \
+           and tree.type_counts(child2.uuid) == {branch.uuid: 1} \
+           and tree.type_counts(gc2.uuid) == {}
+
+    def test_deleted_organizations_left_out(self, db):
+        _, (root, child1, child2, gc1, gc2) = self._tree(db)
+        child2.deleted = True
+        db.commit()
+        tree = OrganizationTree.load(db)
+        assert child2.uuid not in tree \
+           and tree.descendant_count(root.uuid) == 2 \
+           and [r.code for r in tree.roots()] == ['01', '0121']
+
+    def test_serializes_to_nested_json(self, db):
+        (hq, branch), (root, child1, child2, gc1, gc2) = self._tree(db)
+        tree = OrganizationTree.load(db)
+        data = json.loads(tree.to_json())
+        assert len(data) == 1 and data[0]['code'] == '01' \
+           and data[0]['descendant_count'] == 4 \
+           and data[0]['type_counts'] == {str(hq.uuid): 1, str(branch.uuid): 3}
+        assert [c['code'] for c in data[0]['children']] == ['011', '012'] \
+           and [c['code'] for c in data[0]['children'][1]['children']] == ['0121'] \
+           and data[0]['children'][1]['children'][0]['children'] == []
+        assert tree.to_dict(child1.uuid)['children'][0]['id'] == str(gc1.uuid)
+
+    def test_updated_reloads_changed_organizations(self, db):
+        (hq, branch), (root, child1, child2, gc1, gc2) = self._tree(db)
+        tree = OrganizationTree.load(db)
+        gc2.parent = child1
+        gc1.deleted = True
+        db.commit()
+
+        updated = tree.updated(db, [gc1.uuid, gc2.uuid])
+        assert tree.descendant_count(child1.uuid) == 1 \
+           and updated.descendant_count(child1.uuid) == 1 \
+           and [r.code for r in updated.children(child1.uuid)] == ['0121'] \
+           and updated.descendant_count(child2.uuid) == 0 \
+           and gc1.uuid not in updated
+
+
+class TestOrganizationTreeService(TestBase):
+    def _service(self, db):
+        service = OrganizationTreeService(sessionmaker(bind=db.bind))
+        service.watch(db)
+        return service
+
+    def test_tree_loaded_once(self, db):
+        _, (root, child1, child2, gc1, gc2) = self._tree(db)
+        service = self._service(db)
+        tree = service.tree
+        assert tree.descendant_count(root.uuid) == 4 \
+           and service.tree is tree
+
+    def test_tree_updated_after_commit(self, db):
+        _, (root, child1, child2, gc1, gc2) = self._tree(db)
+        service = self._service(db)
+        tree = service.tree
+
+        child2.parent = child1
+        db.flush()
+        assert service.tree is tree
+        db.commit()
+        assert service.tree is not tree \
+           and service.tree.descendant_count(child1.uuid) == 3
+
+    def test_rolled_back_changes_ignored(self, db):
+        _, (root, child1, child2, gc1, gc2) = self._tree(db)
+        service = self._service(db)
+        tree = service.tree
+
+        child2.parent = child1
+        db.flush()
+        db.rollback()
+        assert service.tree is tree
+
+    def test_invalidate(self, db):
+        _, (root, child1, child2, gc1, gc2) = self._tree(db)
+        service = self._service(db)
+        tree = service.tree
+
+        table = Organization.__table__
+        db.execute(table.update().where(table.c.uuid == gc2.uuid)
+                        .values(parent_id=root.uuid))
+        db.commit()
+        assert service.tree is tree
+
+        service.invalidate([gc2.uuid])
+        assert service.tree.descendant_count(child2.uuid) == 0 \
+           and service.tree.descendant_count(root.uuid) == 4
+        service.invalidate()
+        assert len(service.tree) == 5
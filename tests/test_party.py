@@ -6,7 +6,10 @@ from elixr.sax import utils
 from elixr.sax.party import (
     Gender, MaritalStatus, ContactType, PartyType,
     EmailContact, PhoneContact, Party, Person, Organization,
-    OrganizationType
+    OrganizationType, organization_paths_table, rebuild_organization_paths,
+    disable_organization_paths, enable_organization_paths,
+    organization_ancestors, organization_descendants, normalize_email,
+    normalize_name, normalize_phone, update_contact_keys, update_name_keys
 )
 
 
@@ -64,6 +67,116 @@ class TestContactDetail(TestBase):
         assert found2 and found2.id == contact2.id
 
 
+class TestContactLookup(TestBase):
+    def _add_parties(self, db):
+        self._clear_tables(db)
+        john = Person(name='John', last_name='Doe')
+        john.contacts.extend([EmailContact(address=' John@Doe.EA '),
+                              PhoneContact(number='0802 000 1000')])
+        jane = Person(name='Jane', last_name='Doe')
+        jane.contacts.extend([EmailContact(address='jane@doe.ea'),
+                              PhoneContact(number='+234 (802) 000-2000')])
+        db.add_all([john, jane])
+        db.commit()
+        return john, jane
+
+    def test_contacts_normalized(self):
+        assert normalize_email(' John@Doe.EA ') == 'john@doe.ea' \
+           and normalize_phone('+234 (802) 000-2000') == '+2348020002000' \
+           and normalize_phone('00234-802-000-2000') == '+2348020002000' \
+           and normalize_phone('0802 000 2000', '234') == '+2348020002000' \
+           and normalize_phone('0802 000 2000') == '08020002000'
+
+    def test_phone_keys_fit_column(self):
+        number = '0' + '1' * 14
+        key = normalize_phone(number, '234')
+        assert len(number) == PhoneContact.number.type.length \
+           and len(key) == PhoneContact.number_key.type.length
+
+    def test_find_by_emails(self, db):
+        john, jane = self._add_parties(db)
+        found = Party.find_by_emails(db, ['JOHN@doe.ea', 'jane@doe.ea', 'x@y.z'])
+        assert found == {'JOHN@doe.ea': [john], 'jane@doe.ea': [jane],
+                         'x@y.z': []}
+
+    def test_find_by_phones(self, db):
+        john, jane = self._add_parties(db)
+        found = Person.find_by_phones(db, ['08020001000', '+2348020002000'])
+        assert found == {'08020001000': [john], '+2348020002000': [jane]}
+
+    def test_keys_maintained_on_update(self, db):
+        john, jane = self._add_parties(db)
+        email = [c for c in john.contacts if isinstance(c, EmailContact)][0]
+        email.address = 'J.Doe@Doe.ea'
+        db.commit()
+        assert email.address_key == 'j.doe@doe.ea' \
+           and Party.find_by_emails(db, ['j.doe@doe.ea'])['j.doe@doe.ea'] == [john]
+
+    def test_keys_can_be_backfilled(self, db):
+        self._add_parties(db)
+        db.execute(EmailContact.__table__.update().values(
+            address_key=None, number_key=None))
+        db.expire_all()
+        assert update_contact_keys(db) == 4 \
+           and len(Party.find_by_phones(db, ['+2348020002000'])['+2348020002000']) == 1
+
+
+class TestPersonNameSearch(TestBase):
+    def _add_people(self, db):
+        self._clear_tables(db)
+        db.add_all([
+            Person(name='Joh\u00e9', last_name='Doe'),
+            Person(name='John', middle_name='Ade', last_name='Doe'),
+            Person(name='Ade', last_name='Johnson'),
+            Person(name='Mary', last_name='Jones'),
+        ])
+        db.commit()
+
+    def _names(self, query):
+        return [(p.name, p.last_name) for p in query]
+
+    def test_name_normalized(self, db):
+        self._add_people(db)
+        person = db.query(Person).filter_by(name='Joh\u00e9').one()
+        assert normalize_name(" O'Brien-\u00c9ze ") == 'o brien eze' \
+           and person.name_key == 'johe' and person.last_name_key == 'doe'
+
+    def test_missing_name_keys_backfilled(self, db):
+        self._add_people(db)
+        table = Person.__table__
+        db.execute(table.update().values(name_key=None, middle_name_key=None,
+                                         last_name_key=None))
+        db.commit()
+        assert self._names(Person.search_name(db, 'john')) == []
+
+        assert update_name_keys(db, batch_size=3) == 4
+        db.commit()
+        db.expire_all()
+        found = self._names(Person.search_name(db, 'john'))
+        assert found == [('John', 'Doe'), ('Ade', 'Johnson')] \
+           and update_name_keys(db) == 0
+
+    def test_prefix_search_ranked(self, db):
+        self._add_people(db)
+        found = self._names(Person.search_name(db, 'JOHN'))
+        assert found == [('John', 'Doe'), ('Ade', 'Johnson')]
+
+        found = self._names(Person.search_name(db, 'jo'))
+        assert found == [('Ade', 'Johnson'), ('Mary', 'Jones'),
+                         ('Joh\u00e9', 'Doe'), ('John', 'Doe')]
+
+    def test_multi_token_search(self, db):
+        self._add_people(db)
+        assert self._names(Person.search_name(db, 'doe ad')) == [('John', 'Doe')] \
+           and self._names(Person.search_name(db, 'Ade John')) \
+            == [('John', 'Doe'), ('Ade', 'Johnson')]
+
+    def test_search_limited(self, db):
+        self._add_people(db)
+        assert len(Person.search_name(db, 'j', limit=2).all()) == 2 \
+           and Person.search_name(db, ' - ').count() == 0
+
+
 class TestPerson(TestBase):
     def _get_person_dict(self):
         return Person(
@@ -189,6 +302,190 @@ class TestOrganization(TestBase):
         #assert db.query(Organization).count() == 3
 
 
+class TestPolymorphicListing(TestBase):
+    def _add_parties(self, db):
+        self._clear_tables(db)
+        org_type = self._get_organization_type(db)
+        db.add_all([
+            Person(name='John', last_name='Doe', title='Mr'),
+            Person(name='Jane', last_name='Doe', title='Mrs'),
+            Organization(name='Hazeltek', code='01', description='HQ',
+                         type=org_type),
+        ])
+        db.commit()
+        db.expunge_all()
+
+    def test_subtype_fields_loaded_in_single_statement(self, db, count_statements):
+        self._add_parties(db)
+        statements = count_statements(db.bind)
+        parties = Party.polymorphic_query(db).order_by(Party.name).all()
+        fields = [(p.name, p.last_name) if isinstance(p, Person)
+                  else (p.name, p.code) for p in parties]
+        assert fields == [('Hazeltek', '01'), ('Jane', 'Doe'), ('John', 'Doe')] \
+           and len([s for s in statements if 'contact_details' not in s]) == 1
+
+    def test_listing_limited_to_subtypes(self, db):
+        self._add_parties(db)
+        parties = Party.polymorphic_query(db, subtypes=[Organization]).all()
+        assert [p.name for p in parties] == ['Hazeltek']
+
+    def test_subtype_criteria(self, db):
+        self._add_parties(db)
+        query = Party.polymorphic_query(db).filter(Person.title == 'Mrs')
+        assert [p.name for p in query] == ['Jane']
+
+    def test_only_selected_subtype_columns_loaded(self, db):
+        self._add_parties(db)
+        query = Party.polymorphic_query(db, columns={
+            Person: ['last_name'], Organization: ['code']})
+        sql = str(query)
+        assert 'people.last_name' in sql and 'organizations.code' in sql \
+           and 'people.title' not in sql \
+           and 'organizations.description' not in sql
+
+
+class TestOrganizationHierarchy(TestBase):
+    def setup_method(self, method):
+        enable_organization_paths()
+
+    def teardown_method(self, method):
+        disable_organization_paths()
+
+    def _tree(self, db):
+        self._clear_tables(db)
+        org_type = self._get_organization_type(db)
+        root = Organization(code='01', name='Root', type=org_type)
+        child1 = Organization(code='011', name='Child1', parent=root, type=org_type)
+        child2 = Organization(code='012', name='Child2', parent=root, type=org_type)
+        grand_child1 = Organization(code='0111', name='GrandChild1', parent=child1, type=org_type)
+        grand_child2 = Organization(code='0121', name='GrandChild2', parent=child2, type=org_type)
+        db.add_all([grand_child1, grand_child2])
+        db.commit()
+        return root, child1, child2, grand_child1, grand_child2
+
+    def _paths(self, db):
+        table = organization_paths_table
+        return set(tuple(row) for row in db.execute(table.select()))
+
+    def test_paths_not_maintained_unless_enabled(self, db):
+        disable_organization_paths()
+        self._tree(db)
+        assert self._paths(db) == set()
+
+        count = rebuild_organization_paths(db)
+        db.commit()
+        assert count == 11 and len(self._paths(db)) == 11
+
+    def test_descendants_and_ancestors(self, db):
+        root, child1, child2, gc1, gc2 = self._tree(db)
+        assert [o.code for o in Organization.descendants(db, root.uuid)] \
+            == ['011', '012', '0111', '0121']
+        assert [o.code for o in Organization.descendants(db, root.uuid, max_depth=1)] \
+            == ['011', '012']
+        assert [o.code for o in Organization.ancestors(db, gc1.uuid)] == ['011', '01'] \
+           and [o.code for o in Organization.descendants(db, gc1.uuid, include_self=True)] == ['0111']
+
+    def test_depth_and_subtree_counts(self, db):
+        root, child1, child2, gc1, gc2 = self._tree(db)
+        assert Organization.depth(db, root.uuid) == 0 \
+           and Organization.depth(db, gc2.uuid) == 2
+        assert Organization.subtree_counts(db, [root.uuid, child1.uuid, gc1.uuid]) \
+            == {root.uuid: 4, child1.uuid: 1, gc1.uuid: 0}
+
+    def test_paths_maintained_on_reparent(self, db):
+        root, child1, child2, gc1, gc2 = self._tree(db)
+        child2.parent = child1
+        db.commit()
+        assert Organization.depth(db, gc2.uuid) == 3 \
+           and [o.code for o in Organization.ancestors(db, gc2.uuid)] == ['012', '011', '01'] \
+           and Organization.subtree_counts(db, [child1.uuid])[child1.uuid] == 3
+
+        child2.parent_id = None
+        db.commit()
+        assert Organization.depth(db, gc2.uuid) == 1 \
+           and Organization.subtree_counts(db, [root.uuid])[root.uuid] == 2
+
+    def test_reparent_under_own_subtree_fails(self, db):
+        root, child1, child2, gc1, gc2 = self._tree(db)
+        child1.parent_id = gc1.uuid
+        with pytest.raises(ValueError):
+            db.commit()
+        db.rollback()
+
+    def test_paths_maintained_on_delete(self, db):
+        root, child1, child2, gc1, gc2 = self._tree(db)
+        db.delete(gc1)
+        db.commit()
+        assert Organization.subtree_counts(db, [root.uuid, child1.uuid]) \
+            == {root.uuid: 3, child1.uuid: 0}
+
+    def test_paths_can_be_rebuilt(self, db):
+        self._tree(db)
+        paths = self._paths(db)
+        db.execute(organization_paths_table.delete())
+        assert rebuild_organization_paths(db) == len(paths) == 5 + 4 + 2
+        assert self._paths(db) == paths
+
+
+class TestOrganizationRecursiveQueries(TestOrganizationHierarchy):
+    def _codes(self, query):
+        return [o.code for o in query]
+
+    def test_descendants(self, db):
+        root, child1, child2, gc1, gc2 = self._tree(db)
+        assert self._codes(organization_descendants(db, root.uuid)) \
+            == ['011', '012', '0111', '0121']
+        assert self._codes(organization_descendants(db, root.uuid, max_depth=1,
+                                                    include_self=True)) \
+            == ['01', '011', '012']
+
+    def test_ancestors(self, db):
+        root, child1, child2, gc1, gc2 = self._tree(db)
+        assert self._codes(organization_ancestors(db, gc2.uuid)) == ['012', '01'] \
+           and self._codes(organization_ancestors(db, gc2.uuid, max_depth=1)) == ['012']
+
+    def test_filters_by_type_and_deleted(self, db):
+        root, child1, child2, gc1, gc2 = self._tree(db)
+        other_type = self._get_organization_type(db, name='other', title='Other')
+        gc1.type = other_type
+        child2.deleted = True
+        db.commit()
+
+        assert self._codes(organization_descendants(db, root.uuid)) == ['011', '0111'] \
+           and self._codes(organization_descendants(db, root.uuid, include_deleted=True,
+                                                    type_ids=[other_type.uuid])) == ['0111']
+
+    def test_deleted_handled_alike_for_soft_delete_query(self, db):
+        from elixr.sax import meta
+        from elixr.sax.query import SoftDeleteQuery
+        root, child1, child2, gc1, gc2 = self._tree(db)
+        root.deleted = child2.deleted = True
+        db.commit()
+
+        sdb = meta.sessionmaker(bind=db.bind, query_cls=SoftDeleteQuery)()
+        try:
+            for session in (db, sdb):
+                assert self._codes(organization_descendants(
+                    session, root.uuid, include_deleted=True,
+                    include_self=True)) == ['01', '011', '012', '0111', '0121'] \
+                   and self._codes(organization_descendants(session, root.uuid)) \
+                    == ['011', '0111'] \
+                   and self._codes(organization_ancestors(
+                    session, gc2.uuid, include_deleted=True)) == ['012', '01']
+        finally:
+            sdb.close()
+
+    def test_types_loaded_without_lazy_loads(self, db, count_statements):
+        root_id = self._tree(db)[0].uuid
+        db.expire_all()
+
+        statements = count_statements(db.bind)
+        orgs = organization_descendants(db, root_id).all()
+        names = [o.type.name for o in orgs] + [len(o.contacts) for o in orgs]
+        count_statements.stop()
+        assert len(orgs) == 4 and len(statements) == 3
+
+
 class TestOrganizationType(object):
 
     def test_organization_type_has_organizations_property(self, db):
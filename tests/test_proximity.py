@@ -0,0 +1,72 @@
+import pytest
+np = pytest.importorskip('numpy')
+
+from elixr.sax import utils
+from elixr.sax.address import Address
+from elixr.sax.party import Organization, OrganizationType
+from elixr.sax.spatial import haversine
+from elixr.sax.proximity import (
+    CoordinateSet, assign_nearest, distance_matrix, pairs_within,
+    within_radius
+)
+
+
+SERVICE_POINTS = [('abuja', 9.0765, 7.3986), ('kano', 12.0022, 8.5920),
+                  ('lagos', 6.5244, 3.3792)]
+CUSTOMERS = [('c1', 9.2833, 7.3833), ('c2', 6.6018, 3.3515),
+             ('c3', 11.9, 8.5), ('c4', 10.5105, 7.4165)]
+
+
+class TestBase(object):
+    def _set(self, places):
+        names, lat, lng = zip(*places)
+        return CoordinateSet(names, lat, lng)
+
+
+class TestComputations(TestBase):
+    def test_distance_matrix_matches_scalar_haversine(self):
+        sources, targets = self._set(CUSTOMERS), self._set(SERVICE_POINTS)
+        matrix = distance_matrix(sources, targets)
+        assert matrix.shape == (4, 3)
+        for i, (_, lat1, lng1) in enumerate(CUSTOMERS):
+            for j, (_, lat2, lng2) in enumerate(SERVICE_POINTS):
+                assert abs(matrix[i, j] - haversine(lat1, lng1, lat2, lng2)) < 1e-6
+
+    @pytest.mark.parametrize("chunk_cells", [1, 5, 2 ** 20])
+    def test_assign_nearest_independent_of_chunking(self, chunk_cells):
+        sources, targets = self._set(CUSTOMERS), self._set(SERVICE_POINTS)
+        found = assign_nearest(sources, targets, chunk_cells)
+        assert [(s, t) for s, t, _ in found] == [
+            ('c1', 'abuja'), ('c2', 'lagos'), ('c3', 'kano'), ('c4', 'abuja')]
+
+    @pytest.mark.parametrize("chunk_cells", [1, 2 ** 20])
+    def test_pairs_within_radius(self, chunk_cells):
+        sources, targets = self._set(CUSTOMERS), self._set(SERVICE_POINTS)
+        found = pairs_within(sources, targets, 50, chunk_cells)
+        assert sorted((s, t) for s, t, _ in found) == [
+            ('c1', 'abuja'), ('c2', 'lagos'), ('c3', 'kano')]
+
+    def test_within_radius_ordered_by_distance(self):
+        targets = self._set(CUSTOMERS)
+        found = within_radius(9.0765, 7.3986, targets, 200)
+        assert [t for t, _ in found] == ['c1', 'c4']
+
+
+class TestCoordinateSet(TestBase):
+    def test_can_load_from_model(self, db):
+        utils.clear_tables(db)
+        org_type = OrganizationType(name='hq', title='HQ', is_root=True)
+        db.add_all([
+            Organization(name=n, code=n, type=org_type, latitude=lat,
+                         longitude=lng) for n, lat, lng in SERVICE_POINTS
+        ] + [Organization(name='none', code='none', type=org_type)])
+        db.add_all([Address(raw=n, latitude=lat, longitude=lng)
+                    for n, lat, lng in CUSTOMERS])
+        db.commit()
+
+        targets = CoordinateSet.load(db, Organization)
+        sources = CoordinateSet.load(db, Address, id_field='raw')
+        found = dict((s, t) for s, t, _ in assign_nearest(sources, targets))
+        kano = db.query(Organization).filter_by(code='kano').one()
+        assert len(targets) == 3 and len(sources) == 4 \
+           and found['c3'] == kano.uuid
@@ -0,0 +1,308 @@
+import pytest
+from datetime import datetime, timedelta
+from sqlalchemy import exc
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.schema import CreateIndex
+from elixr.sax import meta, utils
+from elixr.sax.meta import Model
+from elixr.sax.address import Country, State
+from elixr.sax.auth import User
+from elixr.sax.party import EmailContact, Person
+from elixr.sax.query import (
+    LOADING_PROFILE, CursorError, apply_profile, decode_cursor, encode_cursor,
+    exclude_deleted, get_profile, register_profile
+)
+
+
+
+class TestBase(object):
+    def _clear_tables(self, db, *table_names):
+        utils.clear_tables(db, *table_names)
+
+    def _add_countries(self, db, count=7):
+        base_date = datetime(2017, 1, 1)
+        countries = [
+            Country(code='C%s' % i, name='Country %s' % i,
+                    date_created=base_date + timedelta(days=i // 2))
+            for i in range(count)
+        ]
+        db.add_all(countries)
+        db.commit()
+        return countries
+
+
+class TestCursor(object):
+    def test_encoded_cursor_decodes_to_same_values(self):
+        values = [datetime(2017, 1, 2, 3, 4, 5, 6), 42, 'abc']
+        assert decode_cursor(encode_cursor(values)) == values
+
+    def test_decoding_fails_for_malformed_cursor(self):
+        with pytest.raises(CursorError):
+            decode_cursor('not-a-cursor!')
+
+    def test_decoding_fails_for_mismatched_ordering(self):
+        with pytest.raises(CursorError):
+            decode_cursor(encode_cursor([1, 2]), 3)
+
+
+class TestKeysetPagination(TestBase):
+    def test_keyset_indexes_declared_for_entity_tables(self):
+        tables = dict((t.name, t) for t in Model.metadata.sorted_tables)
+        names = [i.name for i in tables['countries'].indexes]
+        assert 'ix_countries_date_created_id' in names \
+           and 'ix_countries_deleted_date_created_id' in names
+
+    def test_first_page_has_only_next_cursor(self, db):
+        self._clear_tables(db)
+        countries = self._add_countries(db)
+        page = Country.paginate(db, limit=3)
+        assert [c.id for c in page.items] == [c.id for c in countries[:3]] \
+           and page.next_cursor is not None \
+           and page.prev_cursor is None
+
+    def test_can_page_forward_through_all_records(self, db):
+        self._clear_tables(db)
+        countries = self._add_countries(db)
+        page = Country.paginate(db, limit=3)
+        found = list(page.items)
+        while page.next_cursor:
+            page = Country.paginate(db, limit=3, after=page.next_cursor)
+            found.extend(page.items)
+        assert [c.id for c in found] == [c.id for c in countries] \
+           and page.prev_cursor is not None
+
+    def test_can_page_through_records_created_by_column_default(self, db):
+        self._clear_tables(db)
+        countries = [Country(code='C%s' % i, name='Country %s' % i)
+                     for i in range(10)]
+        db.add_all(countries)
+        db.commit()
+
+        page = Country.paginate(db, limit=3)
+        found = list(page.items)
+        while page.next_cursor:
+            page = Country.paginate(db, limit=3, after=page.next_cursor)
+            found.extend(page.items)
+        assert sorted(c.id for c in found) == sorted(c.id for c in countries) \
+           and len(found) == 10
+
+    def test_can_page_backward(self, db):
+        self._clear_tables(db)
+        countries = self._add_countries(db)
+        page1 = Country.paginate(db, limit=3)
+        page2 = Country.paginate(db, limit=3, after=page1.next_cursor)
+        back = Country.paginate(db, limit=3, before=page2.prev_cursor)
+        assert [c.id for c in back.items] == [c.id for c in page1.items] \
+           and back.prev_cursor is None \
+           and back.next_cursor is not None
+
+    def test_can_page_in_descending_order(self, db):
+        self._clear_tables(db)
+        countries = self._add_countries(db)
+        page1 = Country.paginate(db, limit=4, descending=True)
+        page2 = Country.paginate(db, limit=4, descending=True,
+                                 after=page1.next_cursor)
+        ids = [c.id for c in page1.items + page2.items]
+        assert ids == [c.id for c in reversed(countries)] \
+           and page2.next_cursor is None
+
+    def test_deleted_records_excluded_by_default(self, db):
+        self._clear_tables(db)
+        countries = self._add_countries(db, 4)
+        countries[1].deleted = True
+        db.commit()
+
+        page = Country.paginate(db, limit=10)
+        page2 = Country.paginate(db, limit=10, include_deleted=True)
+        assert len(page.items) == 3 and countries[1] not in page.items \
+           and len(page2.items) == 4
+
+    def test_can_order_by_other_columns(self, db):
+        self._clear_tables(db)
+        db.add_all([User(username=name) for name in ('mike', 'ann', 'zed')])
+        db.commit()
+
+        page = User.paginate(db, limit=2, order_by=('username',))
+        page2 = User.paginate(db, limit=2, order_by=('username',),
+                              after=page.next_cursor)
+        names = [u.username for u in page.items + page2.items]
+        assert names == ['ann', 'mike', 'zed']
+
+    def test_using_both_cursors_fails(self, db):
+        with pytest.raises(ValueError):
+            Country.paginate(db, after='x', before='y')
+
+
+@pytest.fixture(scope='function')
+def sdb():
+    from elixr.sax.query import SoftDeleteQuery
+    resx = utils.make_session()
+    SASession = meta.sessionmaker(bind=resx.engine, query_cls=SoftDeleteQuery)
+    yield SASession()
+
+    # teardown
+    utils.drop_tables(resx.engine)
+
+
+class TestSoftDeleteFiltering(TestBase):
+    def _add_records(self, db):
+        ng = Country(code='NG', name='Nigeria')
+        gh = Country(code='GH', name='Ghana', deleted=True)
+        ng.states.extend([
+            State(code='KN', name='Kano'),
+            State(code='LA', name='Lagos', deleted=True)
+        ])
+        db.add_all([ng, gh])
+        db.commit()
+        db.expunge_all()
+
+    def test_deleted_records_excluded_transparently(self, sdb):
+        self._add_records(sdb)
+        countries = sdb.query(Country).all()
+        assert [c.name for c in countries] == ['Nigeria'] \
+           and sdb.query(Country).count() == 1
+
+    def test_deleted_records_excluded_for_relationship_loads(self, sdb):
+        self._add_records(sdb)
+        country = sdb.query(Country).one()
+        assert [s.name for s in country.states] == ['Kano']
+
+    def test_deleted_records_included_using_escape_hatch(self, sdb):
+        self._add_records(sdb)
+        countries = sdb.query(Country).with_deleted().all()
+        assert len(countries) == 2
+
+    def test_deleted_records_excluded_for_column_queries(self, sdb):
+        self._add_records(sdb)
+        names = sdb.query(State.name).order_by(State.name).all()
+        assert [n for (n,) in names] == ['Kano']
+
+    def test_expired_soft_deleted_instance_can_be_loaded(self, sdb):
+        country = Country(code='NG', name='Nigeria')
+        sdb.add(country)
+        sdb.commit()
+        country.deleted = True
+        sdb.commit()
+        assert country.name == 'Nigeria'
+
+        state = State(code='KN', name='Kano', country=country)
+        sdb.add(state)
+        sdb.commit()
+        State.soft_delete(sdb, [state.uuid])
+        sdb.expire_all()
+        assert state.name == 'Kano' and state.deleted \
+           and sdb.query(State).with_deleted().get(state.id) is state \
+           and sdb.query(State).count() == 0
+
+    def test_can_exclude_deleted_for_plain_query(self, db):
+        self._add_records(db)
+        query = db.query(Country)
+        assert query.count() == 2 \
+           and exclude_deleted(query).count() == 1
+
+    def test_pagination_honours_include_deleted(self, sdb):
+        self._add_records(sdb)
+        page = Country.paginate(sdb, include_deleted=True)
+        assert len(page.items) == 2
+
+    def test_partial_indexes_declared_for_natural_keys(self):
+        tables = dict((t.name, t) for t in Model.metadata.sorted_tables)
+        indexes = dict((i.name, i) for i in tables['states'].indexes)
+        index = indexes.get('ix_states_name_country_id_live')
+        assert index is not None \
+           and index.dialect_options['sqlite']['where'] is not None \
+           and index.dialect_options['postgresql']['where'] is not None
+
+    @pytest.mark.parametrize("dialect, expected", [
+        (sqlite.dialect(), 'WHERE deleted = 0'),
+        (postgresql.dialect(), 'WHERE deleted = false')])
+    def test_partial_index_rendered_for_dialect(self, dialect, expected):
+        table = Country.__table__
+        index = [i for i in table.indexes if i.name == 'ix_countries_name_live']
+        ddl = str(CreateIndex(index[0]).compile(dialect=dialect))
+        assert ddl.endswith(expected)
+
+
+class TestStreaming(TestBase):
+    def _add_people(self, db, count=10):
+        people = []
+        for i in range(count):
+            person = Person(name='P%s' % i, deleted=(i == 0))
+            person.contacts.append(EmailContact(address='p%s@doe.ea' % i))
+            people.append(person)
+        db.add_all(people)
+        db.commit()
+        db.expunge_all()
+
+    def test_joined_collections_loaded_per_batch(self, db, count_statements):
+        self._clear_tables(db)
+        self._add_people(db)
+        statements = count_statements(db.bind)
+        found = [(p.name, len(p.contacts)) for p in Person.stream(db, 3)]
+        assert len(found) == 9 \
+           and all(n == 1 for _, n in found) \
+           and len(statements) == 1 + 3 \
+           and 'JOIN contact_details' not in statements[0]
+
+    def test_can_stream_rows_only(self, db):
+        self._clear_tables(db)
+        self._add_people(db, 3)
+        rows = list(Person.stream(db, rows_only=True))
+        assert len(rows) == 2 \
+           and not isinstance(rows[0], Person) \
+           and rows[0].name == 'P1' and rows[0].uuid is not None
+
+    def test_can_stream_selected_columns(self, db):
+        self._clear_tables(db)
+        self._add_people(db, 3)
+        rows = list(Person.stream(db, columns=['name', Person.last_name],
+                                  include_deleted=True))
+        assert sorted(rows) == [('P0', None), ('P1', None), ('P2', None)]
+
+
+class TestLoadingProfiles(TestStreaming):
+    def test_default_does_not_multiply_rows(self, db, count_statements):
+        self._clear_tables(db)
+        self._add_people(db, 3)
+        statements = count_statements(db.bind)
+        people = db.query(Person).all()
+        assert all(len(p.contacts) == 1 for p in people) \
+           and len(statements) == 2 \
+           and 'JOIN contact_details' not in statements[0]
+
+    def test_joined_profile(self, db, count_statements):
+        self._clear_tables(db)
+        self._add_people(db, 3)
+        statements = count_statements(db.bind)
+        people = apply_profile(db.query(Person), 'joined').all()
+        assert all(len(p.contacts) == 1 for p in people) \
+           and len(statements) == 1
+
+    def test_lean_profile_raises_on_access(self, db):
+        self._clear_tables(db)
+        self._add_people(db, 1)
+        person = apply_profile(db.query(Person), 'lean').one()
+        with pytest.raises(exc.InvalidRequestError):
+            person.contacts
+
+    def test_session_profile_is_default_for_apply_profile(self, db):
+        self._clear_tables(db)
+        self._add_people(db, 1)
+        db.info[LOADING_PROFILE] = 'lean'
+        try:
+            person = apply_profile(db.query(Person)).one()
+            with pytest.raises(exc.InvalidRequestError):
+                person.contacts
+
+            # queries not passed through apply_profile are left as is
+            db.expunge_all()
+            person = db.query(Person).one()
+            assert len(person.contacts) == 1
+        finally:
+            del db.info[LOADING_PROFILE]
+
+    def test_profile_strategies_validated(self):
+        with pytest.raises(ValueError):
+            register_profile('invalid', {'contacts': 'eager'})
+        with pytest.raises(ValueError):
+            get_profile('unknown')
@@ -0,0 +1,147 @@
+import pytest
+from elixr.sax import meta, utils
+from elixr.sax.address import AddressFormatter, Country, State
+from elixr.sax.party import OrganizationType
+from elixr.sax.export.importer import XRefResolver
+from elixr.sax.logic import action
+from elixr.sax.refdata import RefDataService, RefDataSnapshot
+
+
+
+@pytest.fixture(scope='function')
+def resx():
+    def initdb(db):
+        ng = Country(code='NG', name='Nigeria')
+        ca = Country(code='CA', name='Canada')
+        db.add_all([
+            State(code='KN', name='Kano', country=ng),
+            State(code='BC', name='Bauchi', country=ng),
+            State(code='BC', name='British Columbia', country=ca),
+            OrganizationType(name='hq', title='Headquarters', is_root=True),
+            OrganizationType(name='branch', title='Branch'),
+        ])
+        db.commit()
+
+    # setup
+    resx = utils.make_session(initdb_callback=initdb)
+    yield resx
+
+    # teardown
+    utils.drop_tables(resx.engine)
+
+
+class TestRefDataSnapshot(object):
+    def test_records_found_by_unique_keys(self, resx):
+        snapshot = RefDataSnapshot.load(resx.session)
+        kano = snapshot.find(State, code='KN')
+        assert snapshot.find(Country, code='NG').name == 'Nigeria' \
+           and kano.name == 'Kano' and kano.country_code == 'NG' \
+           and snapshot.find(State, uuid=str(kano.uuid)) == kano \
+           and snapshot.find(OrganizationType, name='hq').is_root
+
+    def test_ambiguous_keys_not_indexed(self, resx):
+        snapshot = RefDataSnapshot.load(resx.session)
+        assert snapshot.find(State, code='BC') is None \
+           and snapshot.find(State, code='BC', country_code='CA').name \
+                == 'British Columbia'
+
+    def test_unsupported_filters_return_none(self, resx):
+        snapshot = RefDataSnapshot.load(resx.session)
+        assert snapshot.find(State, country_code='NG') is None \
+           and not snapshot.supports(State, 'country_code') \
+           and snapshot.supports(State, 'country_id', 'code')
+
+    def test_can_get_by_id_or_uuid(self, resx):
+        snapshot = RefDataSnapshot.load(resx.session)
+        hq = snapshot.find(OrganizationType, name='hq')
+        assert snapshot.get(OrganizationType, hq.id) == hq \
+           and snapshot.get(OrganizationType, str(hq.uuid)) == hq
+
+
+class TestRefDataService(object):
+    def _service(self, resx):
+        factory = meta.sessionmaker(bind=resx.engine)
+        service = RefDataService(factory)
+        service.watch(resx.session)
+        return service
+
+    def test_snapshot_loaded_once(self, resx, count_statements):
+        service = self._service(resx)
+        snapshot = service.snapshot
+        statements = count_statements(resx.engine)
+        assert service.snapshot is snapshot \
+           and service.find(Country, code='NG') is not None \
+           and len(statements) == 0
+
+    def test_snapshot_replaced_after_committed_changes(self, resx):
+        service = self._service(resx)
+        snapshot = service.snapshot
+        resx.session.add(Country(code='GH', name='Ghana'))
+        resx.session.flush()
+        assert service.snapshot is snapshot
+
+        resx.session.commit()
+        assert service.snapshot is not snapshot \
+           and service.find(Country, code='GH').name == 'Ghana'
+
+    def test_xref_resolver_consults_snapshot(self, resx, count_statements):
+        service = self._service(resx)
+        service.snapshot
+        resolver = XRefResolver(resx.session, refdata=service)
+        statements = count_statements(resx.engine)
+        state_id = resolver.resolve(State, code='KN')
+        type_id = resolver.resolve(OrganizationType, name='branch')
+        assert state_id is not None and type_id is not None \
+           and len(statements) == 0
+
+    def test_xref_resolver_falls_back_to_database(self, resx):
+        service = self._service(resx)
+        resolver = XRefResolver(resx.session, refdata=service)
+        resx.session.add(Country(code='GH', name='Ghana'))
+        resx.session.flush()
+        assert resolver.resolve(Country, code='GH') is not None
+
+    def test_organization_create_consults_snapshot(self, resx, count_statements):
+        service = self._service(resx)
+        hq = service.find(OrganizationType, name='hq')
+        statements = count_statements(resx.engine)
+        context = {'dbsession': resx.session, 'refdata': service}
+        org = action.organization_create(context, {
+            'code': 'HQ', 'name': 'Head Office', 'type_id': str(hq.uuid)
+        })
+        assert org.type_id == hq.uuid \
+           and not any('organization_types' in s for s in statements)
+
+    def test_organization_create_keeps_type_an_entity(self, resx):
+        service = self._service(resx)
+        hq = service.find(OrganizationType, name='hq')
+        context = {'dbsession': resx.session, 'refdata': service}
+        action.organization_create(context, {
+            'code': 'HQ', 'name': 'Head Office', 'type_id': str(hq.uuid)
+        })
+        org_type = context['type']
+        assert isinstance(org_type, OrganizationType) \
+           and org_type in resx.session and org_type not in resx.session.dirty \
+           and [o.code for o in org_type.organizations] == ['HQ'] \
+           and org_type.date_created is not None
+
+    def test_snapshot_replaced_after_bulk_soft_delete(self, resx):
+        service = self._service(resx)
+        snapshot = service.snapshot
+        kano = service.find(State, code='KN')
+        State.soft_delete(resx.session, [kano.uuid])
+        assert service.snapshot is snapshot
+
+        resx.session.commit()
+        assert service.snapshot is not snapshot \
+           and service.find(State, code='KN').deleted
+
+    def test_address_formatter_consults_snapshot(self, resx, count_statements):
+        service = self._service(resx)
+        kano = service.find(State, code='KN')
+        row = {'addr_raw': None, 'addr_street': None, 'addr_town': 'Dala',
+               'addr_landmark': None, 'postal_code': None,
+               'addr_state_id': kano.uuid}
+        statements = count_statements(resx.engine)
+        values = AddressFormatter(resx.session, refdata=service).to_str_many([row])
+        assert values == ['Dala, Kano, Nigeria'] and len(statements) == 0
@@ -0,0 +1,98 @@
+import pytest
+from elixr.sax import utils
+from elixr.sax.address import Address
+from elixr.sax.spatial import (
+    covering_cells, encode_geohash, geohash_bbox, haversine, radius_bbox,
+    update_geohashes
+)
+
+
+# (name, latitude, longitude)
+PLACES = [
+    ('abuja', 9.0765, 7.3986),
+    ('bwari', 9.2833, 7.3833),
+    ('kaduna', 10.5105, 7.4165),
+    ('kano', 12.0022, 8.5920),
+    ('lagos', 6.5244, 3.3792),
+]
+
+
+class TestBase(object):
+    def _clear_tables(self, db, *table_names):
+        utils.clear_tables(db, *table_names)
+
+    def _add_places(self, db):
+        self._clear_tables(db)
+        db.add_all([Address(raw=name, latitude=lat, longitude=lng)
+                    for name, lat, lng in PLACES])
+        db.add(Address(raw='nowhere'))
+        db.commit()
+
+
+class TestGeohash(object):
+    def test_encoding_matches_reference_value(self):
+        assert encode_geohash(57.64911, 10.40744, 11) == 'u4pruydqqvj'
+
+    def test_cell_contains_encoded_point(self):
+        min_lat, min_lng, max_lat, max_lng = geohash_bbox(encode_geohash(9.0765, 7.3986))
+        assert min_lat <= 9.0765 <= max_lat \
+           and min_lng <= 7.3986 <= max_lng
+
+    def test_haversine_distance(self):
+        distance = haversine(9.0765, 7.3986, 6.5244, 3.3792)
+        assert 520 < distance < 540
+
+    def test_covering_cells_contain_bbox_corners(self):
+        bbox = radius_bbox(9.0765, 7.3986, 25)
+        cells = covering_cells(bbox)
+        min_lat, min_lng, max_lat, max_lng = bbox
+        for lat, lng in [(min_lat, min_lng), (max_lat, max_lng),
+                         (min_lat, max_lng), (max_lat, min_lng)]:
+            assert any(encode_geohash(lat, lng).startswith(c) for c in cells)
+        assert len(cells) <= 24
+
+
+class TestSpatialLookups(TestBase):
+    def test_geohash_maintained_on_insert_and_update(self, db):
+        self._add_places(db)
+        addr = db.query(Address).filter_by(raw='abuja').one()
+        assert addr.geohash == encode_geohash(9.0765, 7.3986)
+
+        addr.latitude, addr.longitude = 6.5244, 3.3792
+        db.commit()
+        assert addr.geohash == encode_geohash(6.5244, 3.3792)
+
+        addr.latitude = None
+        db.commit()
+        assert addr.geohash is None
+
+    def test_within_bbox(self, db):
+        self._add_places(db)
+        found = Address.within_bbox(db, (8.5, 7.0, 11.0, 8.0)).all()
+        assert sorted(a.raw for a in found) == ['abuja', 'bwari', 'kaduna']
+
+    def test_within_radius(self, db):
+        self._add_places(db)
+        found = Address.within_radius(db, 9.0765, 7.3986, 50)
+        assert [a.raw for a, _ in found] == ['abuja', 'bwari'] \
+           and found[0][1] == 0.0
+
+    def test_nearest(self, db):
+        self._add_places(db)
+        found = Address.nearest(db, 9.1, 7.4, k=3)
+        assert [a.raw for a, _ in found] == ['abuja', 'bwari', 'kaduna']
+
+    def test_nearest_returns_available_when_fewer_than_k(self, db):
+        self._add_places(db)
+        found = Address.nearest(db, 9.1, 7.4, k=10)
+        assert len(found) == len(PLACES)
+
+    def test_geohashes_can_be_backfilled(self, db):
+        self._add_places(db)
+        table = Address.__table__
+        db.execute(table.update().values(geohash=None))
+        db.commit()
+        db.expire_all()
+
+        assert update_geohashes(db, Address) == len(PLACES) \
+           and len(Address.within_radius(db, 9.0765, 7.3986, 50)) == 2